@@ -168,19 +168,13 @@ class Identifier():
     def generate_objective_funcs(self):
         print('Forming the objective function.')
 
-        self.obj_func = pi.wrap_objective(pi.objective_function,
-                                          self.num_time_steps,
-                                          self.num_states,
-                                          self.discretization_interval,
-                                          self.time,
-                                          self.y_noise if self.sensor_noise else self.y)
-
-        self.obj_grad_func = pi.wrap_objective(pi.objective_function_gradient,
-                                               self.num_time_steps,
-                                               self.num_states,
-                                               self.discretization_interval,
-                                               self.time,
-                                               self.y_noise if self.sensor_noise else self.y)
+        objective = pi.ParameterIdentificationObjective(
+            self.num_time_steps, self.num_states,
+            self.discretization_interval, self.time,
+            self.y_noise if self.sensor_noise else self.y)
+
+        self.obj_func = objective.objective
+        self.obj_grad_func = objective.gradient
 
     def generate_constraint_funcs(self):
 
@@ -0,0 +1,379 @@
+#!/usr/bin/env python
+
+import os
+import traceback
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from timeit import default_timer
+
+import numpy as np
+import sympy as sm
+
+from .direct_collocation import Problem
+
+__all__ = ['BatchSolver']
+
+# The keys that a job dictionary may contain, see BatchSolver.solve().
+JOB_KEYS = ('initial_guess', 'known_parameter_map', 'known_trajectory_map',
+            'num_collocation_nodes', 'node_time_interval', 'bounds', 'obj',
+            'obj_grad')
+
+
+class _SymPyObject(object):
+    """Holds a SymPy object as its srepr() string, as undefined functions of
+    time can not be pickled to send them to the worker processes."""
+
+    def __init__(self, expr):
+        self.srepr = sm.srepr(expr)
+
+    def restore(self):
+        return sm.sympify(self.srepr)
+
+
+def _serialize(obj):
+    """Returns a copy of the object with all SymPy objects, including
+    dictionary keys, replaced by picklable _SymPyObject objects."""
+    if isinstance(obj, (sm.Basic, sm.MatrixBase)):
+        return _SymPyObject(obj)
+    elif isinstance(obj, dict):
+        return OrderedDict([(_serialize(k), _serialize(v))
+                            for k, v in obj.items()])
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)([_serialize(o) for o in obj])
+    else:
+        return obj
+
+
+def _deserialize(obj):
+    """Reverses _serialize()."""
+    if isinstance(obj, _SymPyObject):
+        return obj.restore()
+    elif isinstance(obj, dict):
+        return OrderedDict([(_deserialize(k), _deserialize(v))
+                            for k, v in obj.items()])
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)([_deserialize(o) for o in obj])
+    else:
+        return obj
+
+
+# The problem template and the problems built from it in a worker process.
+# The problems are keyed by the number of nodes and the node time interval
+# and are kept for all of the jobs the worker runs, so each variation is
+# only compiled once per worker.
+_worker_template = None
+_worker_token = None
+_worker_problems = {}
+
+
+def _init_worker(token, template):
+    """Sets the template of the worker process if it differs from the one
+    the worker has, i.e. on the worker's first job."""
+    global _worker_template, _worker_token
+    if token != _worker_token:
+        _worker_template = _deserialize(template)
+        _worker_token = token
+        _worker_problems.clear()
+
+
+def _problem_with_bounds(problem, bounds):
+    """Returns a new Problem with different bounds that shares the
+    collocator and the compiled constraint functions of the given
+    problem."""
+    new = Problem.__new__(Problem)
+    new.bounds = bounds
+    new.path_constraint_bounds = problem.path_constraint_bounds
+    new.scaling = problem.scaling
+    new.constraint_scaling = problem.constraint_scaling
+    new.objective_scaling = problem.objective_scaling
+    new.collocator = problem.collocator
+    new._init_nlp(problem.obj, problem.obj_grad, con=problem.con,
+                  con_jac=problem.con_jac, obj_hess=problem.obj_hess,
+                  obj_hess_indices=(problem.obj_hess_rows,
+                                    problem.obj_hess_cols))
+    return new
+
+
+def _job_maps(template, job, N):
+    """Returns the known parameter and trajectory maps of a job, i.e. the
+    template's maps updated with the values in the job."""
+
+    par_map = OrderedDict(template['known_parameter_map'])
+    for k, v in job.get('known_parameter_map', {}).items():
+        if k not in par_map:
+            raise ValueError('{} is not a known parameter.'.format(k))
+        par_map[k] = v
+
+    if N == template['num_collocation_nodes']:
+        traj_map = OrderedDict(template['known_trajectory_map'])
+    else:
+        traj_map = OrderedDict()
+    for k, v in job.get('known_trajectory_map', {}).items():
+        if k not in template['known_trajectory_map']:
+            raise ValueError('{} is not a known trajectory.'.format(k))
+        traj_map[k] = v
+
+    for k in template['known_trajectory_map'].keys():
+        if k not in traj_map:
+            msg = 'The known trajectory {} must be given for {} nodes.'
+            raise ValueError(msg.format(k, N))
+        if len(traj_map[k]) != N:
+            msg = 'The known trajectory {} is not length {}.'
+            raise ValueError(msg.format(k, N))
+
+    return par_map, traj_map
+
+
+def _solve_job(token, template, index, job):
+    """Solves a single job in a worker process and returns its result. Any
+    exception is stored in the result instead of being raised."""
+
+    start = default_timer()
+
+    result = {'index': index,
+              'solution': None,
+              'info': None,
+              'num_iterations': 0,
+              'setup_time': 0.0,
+              'solve_time': 0.0,
+              'wall_time': 0.0,
+              'worker': os.getpid(),
+              'error': None}
+
+    try:
+        _init_worker(token, template)
+        template = _worker_template
+        job = _deserialize(job)
+
+        for k in job.keys():
+            if k not in JOB_KEYS:
+                raise ValueError('{} is not a valid job key.'.format(k))
+
+        N = job.get('num_collocation_nodes',
+                    template['num_collocation_nodes'])
+        h = job.get('node_time_interval', template['node_time_interval'])
+
+        par_map, traj_map = _job_maps(template, job, N)
+
+        setup_start = default_timer()
+
+        key = (N, h)
+        if key not in _worker_problems:
+            prob = Problem(template['obj'], template['obj_grad'],
+                           template['equations_of_motion'],
+                           template['state_symbols'], N, h,
+                           known_parameter_map=par_map,
+                           known_trajectory_map=traj_map,
+                           **template['kwargs'])
+            for name, value in template['ipopt_options'].items():
+                prob.addOption(name, value)
+            _worker_problems[key] = prob
+        prob = _worker_problems[key]
+
+        # The known values are read by the compiled functions on each call,
+        # so they are updated in place.
+        collocator = prob.collocator
+        for k in collocator.known_parameter_map.keys():
+            collocator.known_parameter_map[k] = par_map[k]
+        for k in collocator.known_trajectory_map.keys():
+            collocator.known_trajectory_map[k] = np.asarray(traj_map[k],
+                                                            dtype=float)
+
+        prob.obj = job.get('obj', template['obj'])
+        prob.obj_grad = job.get('obj_grad', template['obj_grad'])
+
+        if 'bounds' in job:
+            prob = _problem_with_bounds(prob, job['bounds'])
+            for name, value in template['ipopt_options'].items():
+                prob.addOption(name, value)
+
+        result['setup_time'] = default_timer() - setup_start
+
+        del prob.obj_value[:]
+
+        solve_start = default_timer()
+        solution, info = prob.solve(job['initial_guess'])
+        result['solve_time'] = default_timer() - solve_start
+
+        result['solution'] = solution
+        result['info'] = info
+        # The intermediate callback is also called for iteration 0.
+        result['num_iterations'] = len(prob.obj_value) - 1
+    except Exception:
+        result['error'] = traceback.format_exc()
+
+    result['wall_time'] = default_timer() - start
+
+    return result
+
+
+class BatchSolver(object):
+    """This class solves many variations of a problem template in parallel
+    worker processes. Each worker compiles the problem once per number of
+    nodes and node time interval and reuses it for all of its jobs, only
+    updating the known values, objective, and bounds between solves.
+
+    The worker processes are started on the first call to ``solve()`` and
+    are kept, with their compiled problems, for later calls until
+    ``close()`` is called. The solver can also be used as a context
+    manager, which closes it on exit::
+
+        with BatchSolver(obj, obj_grad, eom, states, N, h) as solver:
+            results = list(solver.solve(jobs))
+
+    """
+
+    def __init__(self, obj, obj_grad, equations_of_motion, state_symbols,
+                 num_collocation_nodes, node_time_interval, max_workers=None,
+                 ipopt_options=None, **kwargs):
+        """Instantiates a BatchSolver object.
+
+        Parameters
+        ==========
+        obj : function
+            Returns the value of the objective function given the free
+            vector. It must be picklable, e.g. a module level function.
+        obj_grad : function
+            Returns the gradient of the objective function given the free
+            vector. It must be picklable, e.g. a module level function.
+        equations_of_motion : sympy.Matrix, shape(n, 1), or tuple
+            A column matrix of SymPy expressions defining the right hand
+            side of the equations of motion when the left hand side is zero
+            or a tuple of their mass matrix and forcing vector, see
+            ConstraintCollocator.
+        state_symbols : iterable
+            An iterable containing all of the SymPy functions of time which
+            represent the states in the equations of motion.
+        num_collocation_nodes : integer
+            The default number of collocation nodes, N.
+        node_time_interval : float
+            The default time interval between collocation nodes.
+        max_workers : integer, optional
+            The number of worker processes. Defaults to the number of
+            processors.
+        ipopt_options : dictionary, optional
+            A mapping from IPOPT option names to values that are set on
+            every problem, e.g. ``{'print_level': 0}``.
+        **kwargs
+            Any other keyword arguments to ``Problem``, e.g.
+            ``known_parameter_map``, ``known_trajectory_map``,
+            ``instance_constraints``, or ``bounds``. These are the defaults
+            for all jobs.
+
+        """
+
+        self.max_workers = max_workers
+
+        self._executor = None
+
+        # Identifies the template in the worker processes.
+        self._token = uuid.uuid4().hex
+
+        if ipopt_options is None:
+            ipopt_options = {}
+
+        self._template = {
+            'obj': obj,
+            'obj_grad': obj_grad,
+            'equations_of_motion': equations_of_motion,
+            'state_symbols': tuple(state_symbols),
+            'num_collocation_nodes': num_collocation_nodes,
+            'node_time_interval': node_time_interval,
+            'known_parameter_map': kwargs.pop('known_parameter_map', {}),
+            'known_trajectory_map': kwargs.pop('known_trajectory_map', {}),
+            'ipopt_options': dict(ipopt_options),
+            'kwargs': kwargs}
+
+    def solve(self, jobs):
+        """Solves the jobs in the worker processes and yields the results
+        as they finish, which is not necessarily in the order of the jobs.
+
+        Parameters
+        ==========
+        jobs : iterable of dictionaries
+            Each job is a dictionary that must contain ``initial_guess``,
+            the initial guess for the free vector, and may contain any of:
+
+            - ``known_parameter_map``: new values for any of the known
+              parameters.
+            - ``known_trajectory_map``: new values for any of the known
+              trajectories. All of the known trajectories must be given if
+              the number of nodes differs from the template's.
+            - ``num_collocation_nodes`` and ``node_time_interval``.
+            - ``bounds``: replaces the template's bounds.
+            - ``obj`` and ``obj_grad``: replace the template's objective.
+
+        Yields
+        ======
+        result : dictionary
+            The result of a job with the keys:
+
+            - ``index``: the index of the job in ``jobs``.
+            - ``solution``: the solution or None if the job failed.
+            - ``info``: the IPOPT solution information, including
+              ``status``, ``status_msg``, and ``obj_val``, or None if the
+              job failed.
+            - ``num_iterations``: the number of IPOPT iterations.
+            - ``setup_time``: the time in seconds spent building or
+              updating the problem, which includes compilation if the
+              worker had not yet built a problem with this number of nodes
+              and node time interval.
+            - ``solve_time``: the time in seconds spent in IPOPT.
+            - ``wall_time``: the total time in seconds of the job in the
+              worker.
+            - ``worker``: the process id of the worker.
+            - ``error``: None or the traceback of the exception that the
+              job raised. A failed job does not stop the other jobs.
+
+        """
+
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers)
+        executor = self._executor
+
+        # The template is sent with each job, as the executor's initializer
+        # requires Python 3.7, and each worker only deserializes it on its
+        # first job.
+        template = _serialize(self._template)
+
+        futures = OrderedDict()
+        for i, job in enumerate(jobs):
+            future = executor.submit(_solve_job, self._token, template, i,
+                                     _serialize(job))
+            futures[future] = i
+
+        for future in as_completed(futures):
+            try:
+                result = future.result()
+            except Exception as e:
+                if isinstance(e, BrokenProcessPool):
+                    # A worker died, so new workers are started on the next
+                    # call.
+                    self._executor = None
+                # e.g. the job could not be pickled or the worker died
+                result = {'index': futures[future],
+                          'solution': None,
+                          'info': None,
+                          'num_iterations': 0,
+                          'setup_time': 0.0,
+                          'solve_time': 0.0,
+                          'wall_time': 0.0,
+                          'worker': None,
+                          'error': traceback.format_exc()}
+            yield result
+
+    def close(self):
+        """Shuts down the worker processes and discards their compiled
+        problems. A later call to ``solve()`` starts new workers."""
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
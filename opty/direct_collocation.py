@@ -1,18 +1,19 @@
 #!/usr/bin/env python
 
+from collections import OrderedDict
 from functools import wraps
+import warnings
 
 import numpy as np
-import sympy as sm
-from sympy.physics import mechanics as me
-import ipopt
-plt = sm.external.import_module('matplotlib.pyplot',
-                                __import__kwargs={'fromlist': ['']},
-                                catch=(RuntimeError,))
 
-from .utils import ufuncify_matrix, parse_free, _optional_plt_dep
+from .utils import (ufuncify_matrix, forward_jacobian, parse_free,
+                    interpolate_free, f_minus_ma, parallel_options,
+                    tune_parallel_options, _optional_plt_dep,
+                    _import_pyplot, _memmap_array, _writable_by_others,
+                    ufuncify_nlp)
 
-__all__ = ['Problem', 'ConstraintCollocator']
+__all__ = ['Problem', 'ConstraintCollocator', 'MultiExperimentCollocator',
+           'MultiExperimentProblem']
 
 
 class _DocInherit(object):
@@ -69,20 +70,56 @@ class _DocInherit(object):
 
     @staticmethod
     def _combine_docs(prob_doc, coll_doc):
-        beg, end = prob_doc.split('bounds')
+        beg, end = prob_doc.split('bounds', 1)
         _, middle = coll_doc.split('Parameters\n        ==========\n        ')
         return beg + middle[:-9] + '        bounds' + end
 
 _doc_inherit = _DocInherit
 
 
-class Problem(ipopt.problem):
+class Problem(object):
     """This class allows the user to instantiate a problem object with the
     essential data required to solve a direct collocation optinal control or
-    parameter identification problem."""
+    parameter identification problem. IPOPT is only imported when a problem
+    is instantiated and the methods of the underlying ``ipopt.problem``,
+    e.g. ``addOption()``, are available on this class."""
 
     INF = 10e19
 
+    # IPOPT options used when solving from a previous solution and its
+    # multipliers, see Problem.solve().
+    WARM_START_OPTIONS = {'warm_start_init_point': 'yes',
+                          'warm_start_bound_push': 1e-9,
+                          'warm_start_bound_frac': 1e-9,
+                          'warm_start_slack_bound_push': 1e-9,
+                          'warm_start_slack_bound_frac': 1e-9,
+                          'warm_start_mult_bound_push': 1e-9,
+                          'mu_init': 1e-6}
+
+    # The version of the file format written by Problem.save().
+    SAVE_FORMAT_VERSION = 1
+
+    # An IterateRecorder that records the solves, see opty.recorder.
+    recorder = None
+
+    # The file that the solve's current iterate is periodically written to
+    # and the number of iterations between checkpoints, see resume().
+    checkpoint_path = None
+    checkpoint_interval = 10
+
+    # The number of iterations completed before the current solve when it
+    # was resumed from a checkpoint.
+    _iteration_offset = 0
+
+    # The last free vector passed to the objective, i.e. IPOPT's current
+    # iterate when the intermediate callback is called.
+    _last_evaluated_free = None
+
+    # The compiled extension module and known values that IPOPT's C
+    # interface solves the problem with if it is given by objective_expr.
+    _nlp_module = None
+    _nlp_known = None
+
     @_doc_inherit
     def __init__(self, obj, obj_grad, *args, **kwargs):
         """
@@ -91,50 +128,223 @@ class Problem(ipopt.problem):
         ==========
         obj : function
             Returns the value of the objective function given the free vector.
+            None if objective_expr is given.
         obj_grad : function
             Returns the gradient of the objective function given the free
-            vector.
+            vector. None if objective_expr is given.
         bounds : dictionary, optional
             This dictionary should contain a mapping from any of the
             symbolic states, unknown trajectories, or unknown parameters to
             a 2-tuple of floats, the first being the lower bound and the
             second the upper bound for that free variable, e.g. ``{x(t):
             (-1.0, 5.0)}``.
+        scaling : dictionary or string, optional
+            A mapping from any of the symbolic states, unknown
+            trajectories, or unknown parameters to a positive float, the
+            nominal magnitude of that free variable, e.g. ``{theta(t): 0.1,
+            k: 500.0}``. IPOPT solves for the free variables divided by
+            their nominal magnitudes. If ``'bounds'``, the nominal
+            magnitude of each free variable with finite bounds is the
+            largest absolute value of its bounds. Free variables that are
+            not given are not scaled.
+        constraint_scaling : sequence of floats, shape(n,), optional
+            The positive nominal magnitudes of the residuals of each of the
+            equations of motion, which the constraints of each equation are
+            divided by. The instance constraints are not scaled.
+        objective_scaling : float, optional
+            The positive nominal magnitude of the objective function.
+        path_constraint_bounds : sequence of 2-tuples of floats, optional
+            The lower and upper bound of each of the path constraints, e.g.
+            ``[(-100.0, 100.0)]``. Use ``Problem.INF`` for no bound. If not
+            given, each path constraint is bounded by ``(-INF, 0.0)``.
+        recorder : IterateRecorder, optional
+            Streams the iterations and results of each solve to a file, see
+            ``opty.recorder``.
+        checkpoint_path : string, optional
+            If given, the current iterate, iteration count, and IPOPT
+            options are written to this ``.npz`` file every
+            ``checkpoint_interval`` iterations of a solve, so that an
+            interrupted solve can be continued with ``resume()``.
+        checkpoint_interval : integer, optional
+            The number of iterations between checkpoints, 10 by default.
+        obj_hess : function, optional
+            Returns the non-zero values of the Hessian of the objective
+            function, or of an approximation of it, given the free vector.
+            If given, IPOPT uses it as the Hessian of the Lagrangian instead
+            of its limited-memory quasi-Newton approximation. The curvature
+            of the constraints is neglected, which is the Gauss-Newton
+            method for least squares objectives, see
+            ``opty.parameter_identification.LeastSquaresObjective``.
+        obj_hess_indices : 2-tuple of integer ndarrays, optional
+            The row and column indices of the values returned by
+            ``obj_hess`` in the lower triangle of the Hessian, i.e. each row
+            index is greater than or equal to its column index. Required if
+            ``obj_hess`` is given.
+        objective_expr : SymPy expression, optional
+            The integrand of the objective function, an expression of the
+            states, input trajectories, and parameters, e.g. ``f(t)**2``.
+            The objective is the sum of its values at the nodes times the
+            node time interval. If given, obj and obj_grad must be None and
+            the objective, the constraints, their non-zero partial
+            derivatives, and the exact Hessian of the Lagrangian are
+            compiled into one extension module that solves the problem with
+            IPOPT's C interface, so IPOPT's callbacks do not call Python.
+            This requires IPOPT's headers and library, found with
+            pkg-config. The objective values of the iterations are added to
+            ``obj_value`` after the solve, so the recorder and checkpoints,
+            which are written during a solve, are not supported. The
+            Hessian is differentiated symbolically per node, so this is
+            meant for small problems that are solved many times.
 
         """
 
+        self.recorder = kwargs.pop('recorder', None)
+        self.checkpoint_path = kwargs.pop('checkpoint_path', None)
+        self.checkpoint_interval = kwargs.pop('checkpoint_interval', 10)
         self.bounds = kwargs.pop('bounds', None)
+        self.scaling = kwargs.pop('scaling', None)
+        self.constraint_scaling = kwargs.pop('constraint_scaling', None)
+        self.objective_scaling = kwargs.pop('objective_scaling', None)
+        self.path_constraint_bounds = kwargs.pop('path_constraint_bounds',
+                                                 None)
+        obj_hess = kwargs.pop('obj_hess', None)
+        obj_hess_indices = kwargs.pop('obj_hess_indices', None)
+        objective_expr = kwargs.pop('objective_expr', None)
 
         self.collocator = ConstraintCollocator(*args, **kwargs)
 
+        if objective_expr is not None:
+            obj, obj_grad = self._compile_nlp(objective_expr, obj, obj_grad,
+                                              obj_hess)
+
+        self._init_nlp(obj, obj_grad, obj_hess=obj_hess,
+                       obj_hess_indices=obj_hess_indices)
+
+    def _compile_nlp(self, objective_expr, obj, obj_grad, obj_hess):
+        """Compiles the extension module that solves the problem with the
+        objective given by objective_expr and returns the functions that
+        evaluate the compiled objective and its gradient."""
+
+        if obj is not None or obj_grad is not None or obj_hess is not None:
+            raise ValueError('obj, obj_grad, and obj_hess must be None if '
+                             'objective_expr is given.')
+        if self.recorder is not None or self.checkpoint_path is not None:
+            raise ValueError('A recorder and checkpoints are not supported '
+                             'with objective_expr.')
+
+        module = self.collocator._generate_compiled_nlp(objective_expr)
+        known = self.collocator._compiled_nlp_known_values()
+
+        self._nlp_module = module
+        self._nlp_known = known
+
+        return (lambda free: module.objective(known, free),
+                lambda free: module.gradient(known, free))
+
+    def _init_nlp(self, obj, obj_grad, con=None, con_jac=None, obj_hess=None,
+                  obj_hess_indices=None):
+        """Generates the constraint functions, Jacobian indices, and bounds
+        from the collocator and initializes the IPOPT problem. Constraint
+        and Jacobian functions already generated from the same collocator
+        can be passed in to skip compiling new ones."""
+
         self.obj = obj
         self.obj_grad = obj_grad
-        self.con = self.collocator.generate_constraint_function()
-        self.con_jac = self.collocator.generate_jacobian_function()
+        self._set_obj_hess(obj_hess, obj_hess_indices)
+        if con is None:
+            con = self.collocator.generate_constraint_function()
+        if con_jac is None:
+            con_jac = self.collocator.generate_jacobian_function()
+        self.con = con
+        self.con_jac = con_jac
 
         self.con_jac_rows, self.con_jac_cols = \
             self.collocator.jacobian_indices()
 
+        memmap_dir = self.collocator.memmap_dir
+        if memmap_dir is not None:
+            self.con_jac_rows = _memmap_array(self.con_jac_rows, memmap_dir,
+                                              'con_jac_rows')
+            self.con_jac_cols = _memmap_array(self.con_jac_cols, memmap_dir,
+                                              'con_jac_cols')
+
         self.num_free = self.collocator.num_free
         self.num_constraints = self.collocator.num_constraints
 
         self._generate_bound_arrays()
+        self._generate_constraint_bound_arrays()
+
+        self._nominal_values = self._generate_nominal_values()
+
+        self._init_ipopt()
+
+    def _set_obj_hess(self, obj_hess, obj_hess_indices):
+        """Stores the function that evaluates the Hessian of the objective
+        and the indices of its values."""
+
+        self.obj_hess = obj_hess
+
+        if obj_hess is None:
+            self.obj_hess_rows, self.obj_hess_cols = None, None
+            return
+
+        if obj_hess_indices is None:
+            raise ValueError('The indices of the Hessian values, '
+                             'obj_hess_indices, must be given with obj_hess.')
+
+        rows, cols = [np.asarray(i, dtype=int) for i in obj_hess_indices]
 
-        # All constraints are expected to be equal to zero.
-        con_bounds = np.zeros(self.num_constraints)
+        if rows.shape != cols.shape:
+            raise ValueError('There must be as many row as column indices '
+                             'of the Hessian values.')
+        if np.any(rows < cols):
+            raise ValueError('The Hessian values must be in its lower '
+                             'triangle.')
 
-        super(Problem, self).__init__(n=self.num_free,
+        self.obj_hess_rows, self.obj_hess_cols = rows, cols
+
+    def _init_ipopt(self):
+        """Instantiates the IPOPT problem from the number of free variables
+        and constraints, the bounds, and the nominal magnitudes."""
+
+        if self._nlp_module is not None:
+            self._nlp = _CompiledIpoptProblem(self._nlp_module,
+                                              self._nlp_known, self,
+                                              self.lower_bound,
+                                              self.upper_bound,
+                                              self.con_lower_bound,
+                                              self.con_upper_bound)
+        else:
+            import ipopt
+
+            self._nlp = ipopt.problem(n=self.num_free,
                                       m=self.num_constraints,
+                                      problem_obj=self,
                                       lb=self.lower_bound,
                                       ub=self.upper_bound,
-                                      cl=con_bounds,
-                                      cu=con_bounds)
+                                      cl=self.con_lower_bound,
+                                      cu=self.con_upper_bound)
+
+        # The options set with addOption(), which are stored in checkpoints.
+        self._options = OrderedDict()
+
+        self._set_scaling()
 
         self.obj_value = []
 
-    def _generate_bound_arrays(self):
-        lb = -self.INF * np.ones(self.num_free)
-        ub = self.INF * np.ones(self.num_free)
+        self.last_solution = None
+        self.last_constraint_multipliers = None
+        self.last_lower_bound_multipliers = None
+        self.last_upper_bound_multipliers = None
+        self._warm_start_options_set = False
+
+    def _free_variable_array(self, values, default):
+        """Returns an array shaped as the free vector filled with the
+        default value except for the free variables in values, a mapping
+        from any of the symbolic states, unknown trajectories, or unknown
+        parameters to a float."""
+
+        array = default * np.ones(self.num_free)
 
         N = self.collocator.num_collocation_nodes
         num_state_nodes = N * self.collocator.num_states
@@ -144,28 +354,143 @@ class Problem(ipopt.problem):
         unk_traj = self.collocator.unknown_input_trajectories
         unk_par = self.collocator.unknown_parameters
 
-        if self.bounds is not None:
-            for var, bounds in self.bounds.items():
-                if var in state_syms:
-                    i = state_syms.index(var)
-                    start = i * N
-                    stop = start + N
-                    lb[start:stop] = bounds[0] * np.ones(N)
-                    ub[start:stop] = bounds[1] * np.ones(N)
-                elif var in unk_traj:
-                    i = unk_traj.index(var)
-                    start = num_state_nodes + i * N
-                    stop = start + N
-                    lb[start:stop] = bounds[0] * np.ones(N)
-                    ub[start:stop] = bounds[1] * np.ones(N)
-                elif var in unk_par:
-                    i = unk_par.index(var)
-                    idx = num_non_par_nodes + i
-                    lb[idx] = bounds[0]
-                    ub[idx] = bounds[1]
-
-        self.lower_bound = lb
-        self.upper_bound = ub
+        for var, value in values.items():
+            if var in state_syms:
+                i = state_syms.index(var)
+                start = i * N
+                stop = start + N
+                array[start:stop] = value * np.ones(N)
+            elif var in unk_traj:
+                i = unk_traj.index(var)
+                start = num_state_nodes + i * N
+                stop = start + N
+                array[start:stop] = value * np.ones(N)
+            elif var in unk_par:
+                i = unk_par.index(var)
+                idx = num_non_par_nodes + i
+                array[idx] = value
+
+        return array
+
+    def _constraint_array(self, eom_values, default):
+        """Returns an array shaped as the constraints with the constraints
+        of each equation of motion set to that equation's value in
+        eom_values and the instance constraints set to the default
+        value."""
+
+        N = self.collocator.num_collocation_nodes
+        num_eom_constraints = self.collocator.num_states * (N - 1)
+
+        array = default * np.ones(self.num_constraints)
+        array[:num_eom_constraints] = np.repeat(eom_values, N - 1)
+
+        return array
+
+    def _generate_bound_arrays(self):
+        if self.bounds is None:
+            bounds = {}
+        else:
+            bounds = self.bounds
+
+        self.lower_bound = self._free_variable_array(
+            dict([(k, v[0]) for k, v in bounds.items()]), -self.INF)
+        self.upper_bound = self._free_variable_array(
+            dict([(k, v[1]) for k, v in bounds.items()]), self.INF)
+
+    def _generate_constraint_bound_arrays(self):
+        """Instantiates the lower and upper bounds of the constraints. The
+        equations of motion and instance constraints are equal to zero and
+        the path constraints are bounded by path_constraint_bounds."""
+
+        self.con_lower_bound = np.zeros(self.num_constraints)
+        self.con_upper_bound = np.zeros(self.num_constraints)
+
+        s = self.collocator.num_path_constraints
+
+        if s == 0:
+            if self.path_constraint_bounds is not None:
+                raise ValueError('There are no path constraints to bound.')
+            return
+
+        bounds = self.path_constraint_bounds
+        if bounds is None:
+            bounds = [(-self.INF, 0.0)] * s
+        elif len(bounds) != s:
+            msg = 'There must be bounds for each of the {} path constraints.'
+            raise ValueError(msg.format(s))
+
+        N = self.collocator.num_collocation_nodes
+        start = self.num_constraints - s * N
+
+        for i, (lower, upper) in enumerate(bounds):
+            if lower > upper:
+                msg = 'The lower bound of path constraint {} is larger than '
+                msg += 'the upper bound.'
+                raise ValueError(msg.format(i))
+            self.con_lower_bound[start + i * N:start + (i + 1) * N] = lower
+            self.con_upper_bound[start + i * N:start + (i + 1) * N] = upper
+
+    def _generate_scaling_arrays(self):
+        """Returns the nominal magnitudes of the free variables and the
+        constraints."""
+
+        if self.scaling is None:
+            free_nominal = np.ones(self.num_free)
+        elif self.scaling == 'bounds':
+            lb, ub = self.lower_bound, self.upper_bound
+            free_nominal = np.maximum(np.abs(lb), np.abs(ub))
+            unbounded = ((np.abs(lb) >= self.INF) | (np.abs(ub) >= self.INF) |
+                         (free_nominal == 0.0))
+            free_nominal[unbounded] = 1.0
+        else:
+            free_nominal = self._free_variable_array(self.scaling, 1.0)
+
+        if self.constraint_scaling is None:
+            con_nominal = np.ones(self.num_constraints)
+        else:
+            eom_nominal = np.asarray(self.constraint_scaling, dtype=float)
+            if eom_nominal.shape != (self.collocator.num_states,):
+                msg = 'There must be {} constraint scaling values.'
+                raise ValueError(msg.format(self.collocator.num_states))
+            con_nominal = self._constraint_array(eom_nominal, 1.0)
+
+        if np.any(free_nominal <= 0.0) or np.any(con_nominal <= 0.0):
+            raise ValueError('The nominal magnitudes must be positive.')
+
+        return free_nominal, con_nominal
+
+    def _generate_nominal_values(self):
+        """Returns None if no scaling is given, otherwise the nominal
+        magnitudes of the objective, free variables, and constraints."""
+
+        if (self.scaling is None and self.constraint_scaling is None and
+                self.objective_scaling is None):
+            return None
+
+        free_nominal, con_nominal = self._generate_scaling_arrays()
+
+        if self.objective_scaling is None:
+            obj_nominal = 1.0
+        elif self.objective_scaling <= 0.0:
+            raise ValueError('The nominal magnitudes must be positive.')
+        else:
+            obj_nominal = float(self.objective_scaling)
+
+        return obj_nominal, free_nominal, con_nominal
+
+    def _set_scaling(self):
+        """Sets IPOPT's user scaling from the nominal magnitudes of the free
+        variables, constraints, and objective if any are given."""
+
+        if self._nominal_values is None:
+            return
+
+        obj_nominal, free_nominal, con_nominal = self._nominal_values
+
+        self.addOption('nlp_scaling_method', 'user-scaling')
+        self.setProblemScaling(obj_scaling=1.0 / obj_nominal,
+                               x_scaling=1.0 / free_nominal,
+                               g_scaling=1.0 / con_nominal)
 
     def objective(self, free):
         """Returns the value of the objective function given a solution to the
@@ -182,6 +507,7 @@ class Problem(ipopt.problem):
             The value of the objective function.
 
         """
+        self._last_evaluated_free = free
         return self.obj(free)
 
     def gradient(self, free):
@@ -245,10 +571,449 @@ class Problem(ipopt.problem):
         """
         return self.con_jac(free)
 
+    def _hessianstructure(self):
+        """Returns the row and column indices of the non-zero values in the
+        lower triangle of the Hessian of the Lagrangian."""
+        return (self.obj_hess_rows, self.obj_hess_cols)
+
+    def _hessian(self, free, lagrange, obj_factor):
+        """Returns the non-zero values of the Hessian of the Lagrangian,
+        which is approximated by the Hessian of the objective function, i.e.
+        the curvature of the constraints is neglected."""
+        return obj_factor * self.obj_hess(free)
+
     def intermediate(self, *args):
         """This method is called at every optimization iteration. Not for pubic
         use."""
         self.obj_value.append(args[2])
+        if self.recorder is not None:
+            self.recorder.record_iteration(self, args)
+        iteration = args[1]
+        if (self.checkpoint_path is not None and iteration > 0 and
+                iteration % self.checkpoint_interval == 0):
+            self._write_checkpoint(iteration, args[5])
+
+    def solve(self, free=None, lagrange=[], zl=[], zu=[], warm_start=False):
+        """Returns the optimal solution and an info dictionary. The solution
+        and its multipliers are stored for a subsequent warm start.
+
+        Parameters
+        ==========
+        free : ndarray, (n * N + m * M + q, ), optional
+            The initial guess in the canonical form. This is required unless
+            ``warm_start`` is True, in which case the last stored solution is
+            used if not given.
+        lagrange : ndarray, shape(number of constraints, ), optional
+            Initial values of the constraint multipliers.
+        zl : ndarray, (n * N + m * M + q, ), optional
+            Initial values of the lower bound multipliers.
+        zu : ndarray, (n * N + m * M + q, ), optional
+            Initial values of the upper bound multipliers.
+        warm_start : boolean, optional
+            If True, the multipliers stored from the last solve (or set with
+            ``warm_start_from()``) are used for any of ``lagrange``, ``zl``,
+            and ``zu`` that are not given and IPOPT's warm start options,
+            ``WARM_START_OPTIONS``, are set for this solve.
+
+        Returns
+        =======
+        solution : ndarray, (n * N + m * M + q, )
+            The optimal solution in the canonical form.
+        info : dictionary
+            The IPOPT solution information, see ``ipopt.problem.solve``.
+
+        """
+
+        if warm_start:
+            if self.last_solution is None:
+                msg = ('There is no stored solution to warm start from, run '
+                       'solve() or warm_start_from() first.')
+                raise ValueError(msg)
+            if free is None:
+                free = self.last_solution
+            if len(lagrange) == 0:
+                lagrange = self.last_constraint_multipliers
+            if len(zl) == 0:
+                zl = self.last_lower_bound_multipliers
+            if len(zu) == 0:
+                zu = self.last_upper_bound_multipliers
+            for option, value in self.WARM_START_OPTIONS.items():
+                self._nlp.addOption(option, value)
+            self._warm_start_options_set = True
+        else:
+            if free is None:
+                raise ValueError('An initial guess must be provided.')
+            if self._warm_start_options_set:
+                # Revert to the user's options or IPOPT's defaults for a
+                # cold start.
+                self._nlp.addOption('warm_start_init_point',
+                                    self._options.get('warm_start_init_point',
+                                                      'no'))
+                self._nlp.addOption('mu_init',
+                                    self._options.get('mu_init', 0.1))
+                self._warm_start_options_set = False
+
+        if self.recorder is not None:
+            self.recorder.start()
+
+        try:
+            # Some versions of cyipopt check for missing multipliers with
+            # ``lagrange == []``, which fails for ndarrays, so pass lists.
+            solution, info = self._nlp.solve(free, lagrange=list(lagrange),
+                                             zl=list(zl), zu=list(zu))
+        finally:
+            self._last_evaluated_free = None
+            if self.recorder is not None:
+                self.recorder.flush()
+
+        if self.recorder is not None:
+            self.recorder.record_result(self, info)
+
+        self.last_solution = info['x']
+        self.last_constraint_multipliers = info['mult_g']
+        self.last_lower_bound_multipliers = info['mult_x_L']
+        self.last_upper_bound_multipliers = info['mult_x_U']
+
+        memmap_dir = self.collocator.memmap_dir
+        if memmap_dir is not None:
+            # Only the memory maps of the last solution and its multipliers
+            # are kept instead of the arrays.
+            for name in ('last_solution', 'last_constraint_multipliers',
+                         'last_lower_bound_multipliers',
+                         'last_upper_bound_multipliers'):
+                setattr(self, name, _memmap_array(getattr(self, name),
+                                                  memmap_dir, name))
+
+        return solution, info
+
+    def addOption(self, name, value):
+        """Sets an IPOPT option, see ``ipopt.problem.addOption``. The
+        options are stored in checkpoints."""
+        self._nlp.addOption(name, value)
+        self._options[name] = value
+
+    def _write_checkpoint(self, iteration, mu):
+        """Writes the current iterate, the total number of iterations, the
+        barrier parameter, and the options to the checkpoint file."""
+
+        import json
+        import os
+
+        free = self._last_evaluated_free
+        if free is None:
+            return
+
+        meta = {'iteration': int(self._iteration_offset + iteration),
+                'mu': float(mu),
+                'num_free': int(self.num_free),
+                'num_constraints': int(self.num_constraints),
+                'options': list(self._options.items())}
+
+        # The previous checkpoint is replaced only once the new one is
+        # completely written.
+        tmp_path = self.checkpoint_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, free=np.array(free, dtype=float),
+                     metadata=np.array(json.dumps(meta)))
+        getattr(os, 'replace', os.rename)(tmp_path, self.checkpoint_path)
+
+    def resume(self, path=None):
+        """Continues a solve from a checkpoint written during an earlier,
+        interrupted solve of this problem, e.g. in a new process. The
+        checkpoint's IPOPT options are set and IPOPT starts from the
+        checkpoint's iterate with its barrier parameter and without pushing
+        the iterate away from the bounds. The remaining number of
+        iterations is reduced by the iterations already done. Checkpoints
+        continue to be written if ``checkpoint_path`` is set.
+
+        Parameters
+        ==========
+        path : string, optional
+            The checkpoint file. Defaults to ``checkpoint_path``.
+
+        Returns
+        =======
+        solution : ndarray, (n * N + m * M + q, )
+            The optimal solution in the canonical form.
+        info : dictionary
+            The IPOPT solution information, see ``ipopt.problem.solve``.
+
+        Notes
+        =====
+        The multipliers are not available to the intermediate callback, so
+        they are not stored in the checkpoints and IPOPT initializes them as
+        for a cold start.
+
+        """
+        import json
+
+        if path is None:
+            path = self.checkpoint_path
+        if path is None:
+            raise ValueError('A checkpoint path must be given.')
+
+        with np.load(path) as data:
+            free = data['free']
+            meta = json.loads(str(data['metadata']))
+
+        if (meta['num_free'] != self.num_free or
+                meta['num_constraints'] != self.num_constraints):
+            msg = 'The checkpoint does not match the size of this problem.'
+            raise ValueError(msg)
+
+        for name, value in meta['options']:
+            self.addOption(name, value)
+
+        max_iter = self._options.get('max_iter', 3000)
+
+        resume_options = {'warm_start_init_point': 'no',
+                          'mu_init': meta['mu'],
+                          'bound_push': 1e-9,
+                          'bound_frac': 1e-9,
+                          'max_iter': max(max_iter - meta['iteration'], 0)}
+        defaults = {'warm_start_init_point': 'no',
+                    'mu_init': 0.1,
+                    'bound_push': 1e-2,
+                    'bound_frac': 1e-2,
+                    'max_iter': 3000}
+
+        for name, value in resume_options.items():
+            self._nlp.addOption(name, value)
+        self._warm_start_options_set = False
+        self._iteration_offset = meta['iteration']
+
+        try:
+            return self.solve(free)
+        finally:
+            self._iteration_offset = 0
+            for name, default in defaults.items():
+                self._nlp.addOption(name, self._options.get(name, default))
+
+    @staticmethod
+    def _node_times(collocator):
+        """Returns the times of the collocation nodes of a collocator and the
+        times of the nodes at which the equations of motion constraints are
+        evaluated."""
+        N = collocator.num_collocation_nodes
+        h = collocator.node_time_interval
+        time = h * np.arange(N)
+        if collocator.integration_method == 'backward euler':
+            con_time = time[1:]
+        elif collocator.integration_method == 'midpoint':
+            con_time = time[:-1] + h / 2.0
+        return time, con_time
+
+    def warm_start_from(self, other):
+        """Stores the last solution and multipliers of another problem as
+        this problem's warm start values so that ``solve(warm_start=True)``
+        starts from them. If the number of collocation nodes or the node
+        time interval differ, the trajectories and the equations of motion
+        constraint multipliers are linearly interpolated onto this problem's
+        nodes.
+
+        Parameters
+        ==========
+        other : Problem
+            A problem with the same states, unknown input trajectories,
+            unknown parameters, and number of instance constraints which has
+            been solved.
+
+        """
+
+        if other.last_solution is None:
+            raise ValueError('The other problem has not been solved.')
+
+        other_values = (other.last_solution,
+                        other.last_constraint_multipliers,
+                        other.last_lower_bound_multipliers,
+                        other.last_upper_bound_multipliers)
+
+        (self.last_solution, self.last_constraint_multipliers,
+         self.last_lower_bound_multipliers,
+         self.last_upper_bound_multipliers) = \
+            self._interpolate_warm_start(self.collocator, other.collocator,
+                                         other_values)
+
+    @classmethod
+    def _interpolate_warm_start(cls, this, that, values):
+        """Returns the solution, constraint multipliers, and lower and upper
+        bound multipliers of the collocator ``that``, given as the tuple
+        ``values``, interpolated onto the nodes of the collocator ``this``,
+        see warm_start_from()."""
+
+        def num_instance_constraints(c):
+            return (c.num_constraints -
+                    c.num_states * (c.num_collocation_nodes - 1) -
+                    c.num_path_constraints * c.num_collocation_nodes)
+
+        if (this.num_states != that.num_states or
+                this.num_unknown_input_trajectories !=
+                that.num_unknown_input_trajectories or
+                this.num_unknown_parameters != that.num_unknown_parameters or
+                this.num_path_constraints != that.num_path_constraints or
+                num_instance_constraints(this) !=
+                num_instance_constraints(that)):
+            msg = ('The free variables and constraints of the other problem '
+                   'do not match this problem.')
+            raise ValueError(msg)
+
+        time, con_time = cls._node_times(this)
+        other_time, other_con_time = cls._node_times(that)
+
+        n = this.num_states
+        q = this.num_unknown_input_trajectories
+
+        solution, multipliers, lower, upper = values
+
+        solution = interpolate_free(solution, n, q, other_time, time)
+        lower = interpolate_free(lower, n, q, other_time, time)
+        upper = interpolate_free(upper, n, q, other_time, time)
+        # The constraint multipliers are laid out like a free vector with n
+        # trajectories at the constraint nodes followed by the instance
+        # constraint multipliers in place of the constants, and then the
+        # path constraint multipliers, s trajectories at the nodes.
+        s = that.num_path_constraints
+        num_path = s * that.num_collocation_nodes
+        interpolated = interpolate_free(multipliers[:len(multipliers) -
+                                                    num_path],
+                                        n, 0, other_con_time, con_time)
+        if s > 0:
+            interpolated = np.hstack(
+                (interpolated, interpolate_free(multipliers[-num_path:], s,
+                                                0, other_time, time)))
+
+        return solution, interpolated, lower, upper
+
+    def generate_initial_guess(self, initial_state,
+                               unknown_trajectory_map=None,
+                               unknown_parameter_map=None, tolerance=1e-10,
+                               max_iterations=20):
+        """Returns a dynamically consistent initial guess of the free vector
+        by solving the discretized equations of motion forward in time from
+        the initial state, given guesses of the unknown input trajectories
+        and unknown parameters. The states at each node are found with
+        Newton's method using the compiled constraint and Jacobian
+        functions. The instance constraints are not enforced.
+
+        Parameters
+        ==========
+        initial_state : array_like, shape(n,)
+            The states at the first node ordered as the state symbols.
+        unknown_trajectory_map : dictionary, optional
+            A mapping from any of the unknown input trajectories to
+            ndarrays of shape(N,). The unknown input trajectories not given
+            are zero.
+        unknown_parameter_map : dictionary, optional
+            A mapping from each of the unknown parameters to a float. This
+            is required if there are unknown parameters.
+        tolerance : float, optional
+            The Newton iterations at a node stop when the absolute values of
+            the constraints at that node are less than this.
+        max_iterations : integer, optional
+            The maximum number of Newton iterations per node. A warning is
+            issued if the iterations do not converge at any node.
+
+        Returns
+        =======
+        initial_guess : ndarray, (n * N + q * N + r, )
+            The states, the unknown input trajectories, and the unknown
+            parameters in the canonical form.
+
+        """
+
+        free, unconverged = self._initial_guess(
+            self.collocator, initial_state, unknown_trajectory_map,
+            unknown_parameter_map, tolerance, max_iterations)
+
+        if unconverged:
+            msg = ('The Newton iterations did not converge at the nodes '
+                   '{}.'.format(unconverged))
+            warnings.warn(msg)
+
+        return free
+
+    @staticmethod
+    def _initial_guess(c, initial_state, unknown_trajectory_map,
+                       unknown_parameter_map, tolerance, max_iterations):
+        """Returns the initial guess of the free vector of the collocator
+        and the nodes at which the Newton iterations did not converge, see
+        generate_initial_guess()."""
+
+        n = c.num_states
+        q = c.num_unknown_input_trajectories
+        N = c.num_collocation_nodes
+
+        initial_state = np.asarray(initial_state, dtype=float)
+        if initial_state.shape != (n,):
+            raise ValueError('The initial state must be shape({},).'.format(n))
+
+        if unknown_trajectory_map is None:
+            unknown_trajectory_map = {}
+        unknown_trajectories = np.zeros((q, N))
+        for k, v in unknown_trajectory_map.items():
+            if k not in c.unknown_input_trajectories:
+                msg = '{} is not an unknown input trajectory.'
+                raise ValueError(msg.format(k))
+            unknown_trajectories[c.unknown_input_trajectories.index(k)] = v
+
+        if unknown_parameter_map is None:
+            unknown_parameter_map = {}
+        missing = [p for p in c.unknown_parameters
+                   if p not in unknown_parameter_map]
+        if missing:
+            msg = 'Values of the unknown parameters {} are required.'
+            raise ValueError(msg.format(missing))
+        unknown_parameters = [unknown_parameter_map[p]
+                              for p in c.unknown_parameters]
+
+        free = np.hstack((np.zeros(n * N), unknown_trajectories.flatten(),
+                          unknown_parameters)).astype(float)
+
+        states, free_specified, free_constants = parse_free(free, n, q, N)
+
+        all_specified = c._merge_fixed_free(c.input_trajectories,
+                                            c.known_trajectory_map,
+                                            free_specified, 'traj')
+        all_constants = c._merge_fixed_free(c.parameters,
+                                            c.known_parameter_map,
+                                            free_constants, 'par')
+
+        # The columns of the Jacobian with respect to the states at the
+        # node being solved for.
+        if c.integration_method == 'backward euler':
+            cols = slice(0, n)
+        else:
+            cols = slice(n, 2 * n)
+
+        unconverged = []
+
+        # states is a view of free, so this fills in the free vector.
+        states[:, 0] = initial_state
+        for k in range(1, N):
+            states[:, k] = states[:, k - 1]
+            node_states = states[:, k - 1:k + 1]
+            node_specified = all_specified[..., k - 1:k + 1]
+            for i in range(max_iterations + 1):
+                residual = c._multi_arg_con_func(node_states, node_specified,
+                                                 all_constants,
+                                                 c.node_time_interval)
+                if np.max(np.abs(residual)) < tolerance:
+                    break
+                elif i == max_iterations:
+                    unconverged.append(k)
+                    break
+                jacobian = c._multi_arg_con_jac_func(node_states,
+                                                     node_specified,
+                                                     all_constants,
+                                                     c.node_time_interval)
+                if c._explicit_backward_euler:
+                    # The partials with respect to the previous states
+                    # follow those with respect to the current states.
+                    jacobian = jacobian[:-n]
+                jacobian = jacobian.reshape((n, -1))[:, cols]
+                states[:, k] -= np.linalg.solve(jacobian, residual)
+
+        return free, unconverged
 
     @_optional_plt_dep
     def plot_trajectories(self, vector, axes=None):
@@ -270,31 +1035,38 @@ class Problem(ipopt.problem):
             A matplotlib axes with the state and input trajectories plotted.
 
         """
+        return self._plot_trajectories(self.collocator, vector, axes)
+
+    @staticmethod
+    def _plot_trajectories(collocator, vector, axes):
+        """Plots the trajectories of the free vector of the collocator, see
+        plot_trajectories()."""
+        import sympy as sm
 
         state_traj, input_traj, constants = \
-            parse_free(vector, self.collocator.num_states,
-                       self.collocator.num_unknown_input_trajectories,
-                       self.collocator.num_collocation_nodes)
+            parse_free(vector, collocator.num_states,
+                       collocator.num_unknown_input_trajectories,
+                       collocator.num_collocation_nodes)
         time = np.arange(0,
-                         self.collocator.num_collocation_nodes *
-                         self.collocator.node_time_interval,
-                         self.collocator.node_time_interval)[:-1]
-
-        num_axes = (self.collocator.num_states +
-                    self.collocator.num_input_trajectories)
-        traj_syms = (self.collocator.state_symbols +
-                     self.collocator.input_trajectories)
+                         collocator.num_collocation_nodes *
+                         collocator.node_time_interval,
+                         collocator.node_time_interval)[:-1]
+
+        num_axes = (collocator.num_states +
+                    collocator.num_input_trajectories)
+        traj_syms = (collocator.state_symbols +
+                     collocator.input_trajectories)
         trajectories = np.vstack((state_traj, input_traj))
 
         if axes is None:
-            fig, axes = plt.subplots(num_axes, 1, sharex=True)
+            fig, axes = _import_pyplot().subplots(num_axes, 1, sharex=True)
 
         for ax, traj, symbol in zip(axes, trajectories, traj_syms):
             ax.plot(time, traj)
             ax.set_ylabel(sm.latex(symbol, mode='inline'))
         ax.set_xlabel('Time')
         axes[0].set_title('State Trajectories')
-        axes[self.collocator.num_states].set_title('Input Trajectories')
+        axes[collocator.num_states].set_title('Input Trajectories')
 
         return axes
 
@@ -315,25 +1087,38 @@ class Problem(ipopt.problem):
             A matplotlib axes with the constraint violations plotted.
 
         """
+        return self._plot_constraint_violations(self.collocator,
+                                                self.con(vector))
+
+    @staticmethod
+    def _plot_constraint_violations(collocator, con_violations):
+        """Plots the constraint values of the collocator, see
+        plot_constraint_violations()."""
+        import sympy as sm
 
-        con_violations = self.con(vector)
-        con_nodes = range(self.collocator.num_states,
-                          self.collocator.num_collocation_nodes + 1)
+        con_nodes = range(collocator.num_states,
+                          collocator.num_collocation_nodes + 1)
         N = len(con_nodes)
-        fig, axes = plt.subplots(self.collocator.num_states + 1)
+        fig, axes = _import_pyplot().subplots(collocator.num_states + 1)
 
         for i, (ax, symbol) in enumerate(zip(axes[:-1],
-                                             self.collocator.state_symbols)):
+                                             collocator.state_symbols)):
             ax.plot(con_nodes, con_violations[i * N:i * N + N])
             ax.set_ylabel(sm.latex(symbol, mode='inline'))
 
         axes[0].set_title('Constraint Violations')
         axes[-2].set_xlabel('Node Number')
 
-        left = range(len(con_violations[self.collocator.num_states * N:]))
-        axes[-1].bar(left, con_violations[self.collocator.num_states * N:],
+        # The path constraints are not plotted.
+        num_path = (collocator.num_path_constraints *
+                    collocator.num_collocation_nodes)
+        instance_violations = \
+            con_violations[collocator.num_states * N:
+                           len(con_violations) - num_path]
+        left = range(len(instance_violations))
+        axes[-1].bar(left, instance_violations,
                      tick_label=[sm.latex(s, mode='inline')
-                                 for s in self.collocator.instance_constraints])
+                                 for s in collocator.instance_constraints])
         axes[-1].set_ylabel('Instance')
         axes[-1].set_xticklabels(axes[-1].get_xticklabels(), rotation=-10)
 
@@ -344,7 +1129,7 @@ class Problem(ipopt.problem):
         """Returns an axis with the objective value plotted versus the
         optimization iteration. solve() must be run first."""
 
-        fig, ax = plt.subplots(1)
+        fig, ax = _import_pyplot().subplots(1)
         ax.set_title('Objective Value')
         ax.plot(self.obj_value)
         ax.set_ylabel('Objective Value')
@@ -352,6 +1137,275 @@ class Problem(ipopt.problem):
 
         return ax
 
+    def save(self, path):
+        """Saves the compiled problem to a single NumPy ``.npz`` file that
+        ``Problem.load()`` restores without SymPy or a compiler. The file
+        holds the compiled constraint and Jacobian functions, the Jacobian
+        indices, the bounds, the scaling, the known parameter and
+        trajectory values, the metadata describing the free vector, and the
+        last solution and multipliers if the problem has been solved. The
+        objective and its gradient are not saved.
+
+        Parameters
+        ==========
+        path : string
+            The path of the file. NumPy appends ``.npz`` if it is missing.
+
+        Notes
+        =====
+        The compiled functions can only be loaded on the same platform with
+        the same Python and opty versions.
+
+        The file holds the compiled extension modules and the Python source
+        of the instance constraint functions, which ``Problem.load()``
+        loads and executes, so loading a file is as safe as running its
+        author's code.
+
+        """
+        import json
+
+        meta, arrays = self.collocator._saved_data()
+
+        meta['format_version'] = self.SAVE_FORMAT_VERSION
+        meta['num_free'] = int(self.num_free)
+        meta['num_constraints'] = int(self.num_constraints)
+
+        arrays['lower_bound'] = self.lower_bound
+        arrays['upper_bound'] = self.upper_bound
+        arrays['con_lower_bound'] = self.con_lower_bound
+        arrays['con_upper_bound'] = self.con_upper_bound
+        arrays['con_jac_rows'] = self.con_jac_rows
+        arrays['con_jac_cols'] = self.con_jac_cols
+
+        if self._nominal_values is None:
+            meta['objective_nominal'] = None
+        else:
+            obj_nominal, free_nominal, con_nominal = self._nominal_values
+            meta['objective_nominal'] = obj_nominal
+            arrays['free_nominal'] = free_nominal
+            arrays['constraint_nominal'] = con_nominal
+
+        if self.last_solution is not None:
+            arrays['last_solution'] = self.last_solution
+            arrays['last_constraint_multipliers'] = \
+                self.last_constraint_multipliers
+            arrays['last_lower_bound_multipliers'] = \
+                self.last_lower_bound_multipliers
+            arrays['last_upper_bound_multipliers'] = \
+                self.last_upper_bound_multipliers
+
+        np.savez(path, metadata=np.array(json.dumps(meta)), **arrays)
+
+    @classmethod
+    def load(cls, path, obj, obj_grad, obj_hess=None,
+             obj_hess_indices=None):
+        """Returns a problem, ready to solve, from a file written by
+        ``Problem.save()``. Neither SymPy nor a compiler is used.
+
+        Parameters
+        ==========
+        path : string
+            The path of the ``.npz`` file.
+        obj : function
+            Returns the value of the objective function given the free vector.
+        obj_grad : function
+            Returns the gradient of the objective function given the free
+            vector.
+        obj_hess : function, optional
+            Returns the non-zero values of the Hessian of the objective
+            function given the free vector, see Problem.
+        obj_hess_indices : 2-tuple of integer ndarrays, optional
+            The row and column indices of the values returned by
+            ``obj_hess``.
+
+        Notes
+        =====
+        Loading a file executes the code that it holds: the compiled
+        extension modules are loaded and the source of the instance
+        constraint functions is executed. Only load files from trusted
+        sources. A ValueError is raised before any of it is executed if the
+        file was saved with a different version of opty or for a different
+        platform.
+
+        The symbols of the loaded problem's collocator, e.g.
+        ``state_symbols`` and the keys of ``known_parameter_map``, are
+        replaced by their names, e.g. ``'x(t)'``. The known values can be
+        changed in these maps before solving. Methods that need the
+        symbolic equations of motion, e.g. ``generate_initial_guess()``,
+        are not available.
+
+        """
+        import json
+
+        with np.load(path) as data:
+            arrays = {k: data[k] for k in data.files}
+
+        meta = json.loads(str(arrays.pop('metadata')))
+
+        if meta['format_version'] != cls.SAVE_FORMAT_VERSION:
+            msg = '{} is not a supported file format version.'
+            raise ValueError(msg.format(meta['format_version']))
+
+        self = cls.__new__(cls)
+
+        self.bounds = None
+        self.path_constraint_bounds = None
+        self.scaling = None
+        self.constraint_scaling = None
+        self.objective_scaling = None
+
+        self.collocator = cls._collocator_from_saved(meta, arrays)
+
+        self.obj = obj
+        self.obj_grad = obj_grad
+        self._set_obj_hess(obj_hess, obj_hess_indices)
+        self.con, self.con_jac = self.collocator._saved_functions()
+
+        self.con_jac_rows = arrays['con_jac_rows']
+        self.con_jac_cols = arrays['con_jac_cols']
+
+        self.num_free = meta['num_free']
+        self.num_constraints = meta['num_constraints']
+
+        self.lower_bound = arrays['lower_bound']
+        self.upper_bound = arrays['upper_bound']
+        self.con_lower_bound = arrays['con_lower_bound']
+        self.con_upper_bound = arrays['con_upper_bound']
+
+        if meta['objective_nominal'] is None:
+            self._nominal_values = None
+        else:
+            self._nominal_values = (meta['objective_nominal'],
+                                    arrays['free_nominal'],
+                                    arrays['constraint_nominal'])
+
+        self._init_ipopt()
+
+        if 'last_solution' in arrays:
+            self.last_solution = arrays['last_solution']
+            self.last_constraint_multipliers = \
+                arrays['last_constraint_multipliers']
+            self.last_lower_bound_multipliers = \
+                arrays['last_lower_bound_multipliers']
+            self.last_upper_bound_multipliers = \
+                arrays['last_upper_bound_multipliers']
+
+        return self
+
+    @staticmethod
+    def _collocator_from_saved(meta, arrays):
+        return ConstraintCollocator._from_saved(meta, arrays)
+
+    def __getattr__(self, name):
+        # IPOPT uses its limited-memory approximation of the Hessian unless
+        # the problem has hessian() and hessianstructure() methods, so they
+        # are only available if the Hessian of the objective is given.
+        if name in ('hessian', 'hessianstructure'):
+            if self.__dict__.get('obj_hess') is None:
+                raise AttributeError(name)
+            return getattr(self, '_' + name)
+        # Only called for attributes not found on this class, e.g. IPOPT's
+        # addOption(), which are looked up on the underlying IPOPT problem.
+        try:
+            nlp = self.__dict__['_nlp']
+        except KeyError:
+            raise AttributeError(name)
+        return getattr(nlp, name)
+
+
+class _CompiledIpoptProblem(object):
+    """Solves a problem with IPOPT's C interface, which calls the compiled
+    objective, constraints, and derivatives of the extension module made by
+    utils.ufuncify_nlp() without Python. It has the methods of
+    ``ipopt.problem`` that Problem uses. The objective values of the
+    iterations are appended to the problem's ``obj_value`` after a
+    solve."""
+
+    # The messages of IPOPT's return statuses.
+    STATUS_MESSAGES = {
+        0: 'Optimal solution found.',
+        1: 'Solved to acceptable level.',
+        2: 'Converged to a point of local infeasibility. Problem may be '
+           'infeasible.',
+        3: 'Search direction is becoming too small.',
+        4: 'Iterates diverging; problem might be unbounded.',
+        5: 'Stopping optimization at current point as requested by user.',
+        6: 'Feasible point for square problem found.',
+        -1: 'Maximum number of iterations exceeded.',
+        -2: 'Restoration phase failed, algorithm doesn\'t know how to '
+            'proceed.',
+        -3: 'Error in step computation.',
+        -4: 'Maximum CPU time exceeded.',
+        -5: 'Maximum wallclock time exceeded.',
+        -10: 'Problem has too few degrees of freedom.',
+        -11: 'Problem has inconsistent variable bounds or constraint '
+             'sides.',
+        -12: 'Invalid option encountered.',
+        -13: 'Invalid number in NLP function or derivative detected.',
+        -100: 'Unrecoverable exception.',
+        -101: 'Unknown exception caught in Ipopt.',
+        -102: 'Not enough memory.',
+        -199: 'Internal error in Ipopt.'}
+
+    def __init__(self, module, known, problem_obj, lb, ub, cl, cu):
+        self._module = module
+        self._known = known
+        self._problem_obj = problem_obj
+        self._bounds = [np.asarray(b, dtype=float) for b in (lb, ub, cl, cu)]
+        self._options = OrderedDict()
+        self._scaling = None
+
+    def addOption(self, name, value):
+        self._options[name] = value
+
+    def setProblemScaling(self, obj_scaling=1.0, x_scaling=None,
+                          g_scaling=None):
+        if x_scaling is None:
+            x_scaling = np.ones(self._module.num_free)
+        if g_scaling is None:
+            g_scaling = np.ones(self._module.num_constraints)
+        self._scaling = (obj_scaling, x_scaling, g_scaling)
+
+    def solve(self, x, lagrange=[], zl=[], zu=[]):
+        """Returns the solution and the information dictionary of
+        ``ipopt.problem.solve`` given the initial guess and optionally the
+        initial multipliers."""
+
+        def initial(values, size):
+            if len(values) == 0:
+                return np.zeros(size)
+            return np.array(values, dtype=float)
+
+        n = self._module.num_free
+        m = self._module.num_constraints
+
+        x = np.array(x, dtype=float)
+        mult_g = initial(lagrange, m)
+        mult_x_L = initial(zl, n)
+        mult_x_U = initial(zu, n)
+
+        lb, ub, cl, cu = self._bounds
+
+        # The initial guess and multipliers are overwritten with the
+        # solution and its multipliers.
+        status, obj_val, g, obj_values = self._module.solve(
+            self._known, x, lb, ub, cl, cu, mult_g, mult_x_L, mult_x_U,
+            options=list(self._options.items()), scaling=self._scaling)
+
+        self._problem_obj.obj_value.extend(obj_values)
+
+        info = {'x': x,
+                'g': g,
+                'obj_val': obj_val,
+                'mult_g': mult_g,
+                'mult_x_L': mult_x_L,
+                'mult_x_U': mult_x_U,
+                'status': status,
+                'status_msg': self.STATUS_MESSAGES.get(
+                    status, 'Unknown return status.').encode('ascii')}
+
+        return x, info
+
 
 class ConstraintCollocator(object):
     """This class is responsible for generating the constraint function and
@@ -372,23 +1426,31 @@ class ConstraintCollocator(object):
 
     """
 
-    time_interval_symbol = sm.Symbol('h', real=True)
 
     def __init__(self, equations_of_motion, state_symbols,
                  num_collocation_nodes, node_time_interval,
                  known_parameter_map={}, known_trajectory_map={},
                  instance_constraints=None, time_symbol=None, tmp_dir=None,
-                 integration_method='backward euler', parallel=False):
+                 integration_method='backward euler', parallel=False,
+                 memmap_dir=None, path_constraints=None,
+                 explicit_form=False, cache_dir=None, max_workers=None,
+                 split_size=None, num_threads=None, schedule=None):
         """Instantiates a ConstraintCollocator object.
 
         Parameters
         ==========
-        equations_of_motion : sympy.Matrix, shape(n, 1)
+        equations_of_motion : sympy.Matrix, shape(n, 1), or tuple
             A column matrix of SymPy expressions defining the right hand
             side of the equations of motion when the left hand side is zero,
             e.g. 0 = x'(t) - f(x(t), u(t), p) or 0 = f(x'(t), x(t), u(t),
             p). These should be in first order form but not necessairly
-            explicit.
+            explicit. Or a tuple of the mass matrix, shape(n, n), and the
+            forcing vector, shape(n, 1), of the first order equations of
+            motion M(x(t), u(t), p) x'(t) = F(x(t), u(t), p), e.g.
+            ``mass_matrix_full`` and ``forcing_full`` from
+            sympy.physics.mechanics. The constraint Jacobian is then
+            assembled numerically from M and the partial derivatives of
+            M v - F instead of differentiating the discretized product.
         state_symbols : iterable
             An iterable containing all of the SymPy functions of time which
             represent the states in the equations of motion.
@@ -408,14 +1470,15 @@ class ConstraintCollocator(object):
             the equations of motion not provided in this dictionary will
             become free trajectories optimization variables.
         instance_constraints : iterable of SymPy expressions, optional
-            These expressions are for constraints on the states at specific
-            time points. They can be expressions with any state instance and
-            any of the known parameters found in the equations of motion.
-            All states should be evaluated at a specific instant of time.
-            For example, the constraint x(0) = 5.0 would be specified as
-            x(0) - 5.0 and the constraint x(0) = x(5.0) would be specified
-            as  x(0) - x(5.0). Unknown parameters and time varying
-            parameters other than the states are currently not supported.
+            These expressions are for constraints on the states and unknown
+            input trajectories at specific time points. They can be
+            expressions with any state or unknown input trajectory instance
+            and any of the known or unknown parameters found in the
+            equations of motion. All states and input trajectories should be
+            evaluated at a specific instant of time. For example, the
+            constraint x(0) = 5.0 would be specified as x(0) - 5.0 and the
+            constraint x(0) = x(5.0) would be specified as  x(0) - x(5.0).
+            Instances of the known input trajectories are not supported.
         time_symbol : SymPy Symbol, optional
             The symbol representating time in the equations of motion. If
             not given, it is assumed to be the default stored in
@@ -427,18 +1490,97 @@ class ConstraintCollocator(object):
         integration_method : string, optional
             The integration method to use, either `backward euler` or
             `midpoint`.
-        parallel : boolean, optional
+        parallel : boolean or string, optional
             If true and openmp is installed, constraints and the Jacobian of
             the constraints will be executed across multiple threads. This is
-            only useful when the equations of motion are extremely large.
+            only useful when the equations of motion are extremely large. If
+            ``'auto'``, the compiled functions are timed with one thread,
+            which evaluates the nodes serially, and with several numbers of
+            threads and loop schedules for the number of nodes and the
+            fastest is used, see ``utils.tune_parallel_options()``. The
+            chosen options are stored in the cache, see cache_dir.
+        memmap_dir : string, optional
+            A path to a directory in which the known trajectories are
+            stored as memory mapped ``.npy`` files, which the compiled
+            functions read without copying. A ``Problem`` with this
+            collocator also stores the Jacobian indices and the last
+            solution and multipliers there. This bounds the memory used by
+            problems with very many collocation nodes.
+        path_constraints : iterable of SymPy expressions, optional
+            Expressions g(x(t), r(t), p) of the states, input trajectories,
+            and parameters found in the equations of motion that are
+            constrained at every collocation node, e.g. an actuator power
+            limit ``f(t) * v(t)``. The bounds of each are given to
+            ``Problem`` with ``path_constraint_bounds`` and default to
+            g <= 0. Derivatives are not supported.
+        explicit_form : boolean, optional
+            If true, the equations of motion must be in the explicit form
+            x'(t) - f(x(t), u(t), p) with the state derivatives in the order
+            of the states. Only f and its partial derivatives are compiled
+            for the constraint Jacobian and the known -1/h and 1/h entries
+            of the state derivative approximation are filled in directly.
+            With backward Euler the Jacobian then only holds the diagonal
+            of the partial derivatives with respect to the previous states.
+        cache_dir : string, optional
+            A path to a directory in which the compiled constraint and
+            Jacobian functions are cached, keyed by a hash of the equations
+            of motion, the states, the known and unknown inputs and
+            parameters, the path constraints, the integration method and
+            form, and the Python platform. Later collocators with the same
+            key load the compiled functions instead of discretizing,
+            differentiating, and compiling the equations of motion again.
+            The sorted symbols and the lambdified instance constraints are
+            cached too, so a hit also skips sorting the symbols of the
+            equations of motion and lambdifying the instance constraints.
+            The cache is not invalidated otherwise, so clear it after
+            changing the code generation. Loading from the cache runs the
+            compiled functions and instance constraint code in it, so the
+            directory is created only writable by the user and a
+            ValueError is raised if it is owned by another user or
+            writable by its group or others. Entries with such owners or
+            permissions are ignored.
+        max_workers : integer, optional
+            If greater than one, the partial derivatives of the equations
+            of motion and path constraints are taken and printed to C code
+            in a pool of this many processes. The generated code is the same
+            for any number of processes.
+        split_size : integer, optional
+            If given, the generated C code of the constraints and their
+            Jacobian is split into functions of at most this many
+            assignments, each compiled from its own file, which bounds the
+            memory the compiler needs for very large models.
+        num_threads : integer, optional
+            The number of threads of the parallel compiled functions.
+            Defaults to OpenMP's default or, if parallel is ``'auto'``, the
+            fastest.
+        schedule : string, optional
+            The OpenMP schedule of the loop over the nodes of the parallel
+            compiled functions, e.g. ``'static'`` or ``'dynamic,16'``, see
+            ``utils.parallel_options()``. Defaults to static scheduling
+            or, if parallel is ``'auto'``, the fastest.
 
         """
-        self.eom = equations_of_motion
+        import sympy as sm
+
+        if isinstance(equations_of_motion, tuple):
+            self.mass_matrix, self.forcing_vector = equations_of_motion
+            self._check_mass_forcing(state_symbols)
+            self.eom = f_minus_ma(self.mass_matrix, self.forcing_vector,
+                                  state_symbols)
+        else:
+            self.mass_matrix = None
+            self.forcing_vector = None
+            self.eom = equations_of_motion
+        self._mass_forcing_jacobian = self.mass_matrix is not None
+        self.explicit_form = explicit_form
+
+        self.time_interval_symbol = sm.Symbol('h', real=True)
 
         if time_symbol is not None:
             self.time_symbol = time_symbol
         else:
-            self.time_symbol = me.dynamicsymbols._t
+            from sympy.physics.mechanics import dynamicsymbols
+            self.time_symbol = dynamicsymbols._t
 
         self.state_symbols = tuple(state_symbols)
         self.state_derivative_symbols = tuple([s.diff(self.time_symbol) for
@@ -457,10 +1599,39 @@ class ConstraintCollocator(object):
 
         self.tmp_dir = tmp_dir
         self.parallel = parallel
-
-        self._sort_parameters()
+        self.memmap_dir = memmap_dir
+        self.cache_dir = cache_dir
+        self._check_cache_dir()
+        self.max_workers = max_workers
+        self.split_size = split_size
+        self.num_threads = num_threads
+        self.schedule = schedule
+
+        # The number of threads and the schedule of each parallel compiled
+        # function and the keyword arguments that set them when it is
+        # called, see _set_parallel_options().
+        self._kernel_options = {}
+        self._kernel_kwargs = {}
+
+        if explicit_form:
+            self._check_explicit_form()
+
+        # The symbols and instance constraints that are sorted and
+        # lambdified below, if they are cached, see cache_dir.
+        cached = self._read_cached_symbols()
+
+        if cached is None:
+            self._sort_parameters()
+            self._sort_trajectories()
+        else:
+            self._sorted_symbols_from_cache(cached)
         self._check_known_trajectories()
-        self._sort_trajectories()
+
+        if memmap_dir is not None:
+            self.known_trajectory_map = OrderedDict(
+                [(k, _memmap_array(np.asarray(v, dtype=float), memmap_dir,
+                                   'known_trajectory_{}'.format(i)))
+                 for i, (k, v) in enumerate(known_trajectory_map.items())])
         self.num_free = ((self.num_states +
                           self.num_unknown_input_trajectories) *
                          self.num_collocation_nodes +
@@ -471,12 +1642,66 @@ class ConstraintCollocator(object):
         if instance_constraints is not None:
             self.num_instance_constraints = len(instance_constraints)
             self.num_constraints += self.num_instance_constraints
-            self._identify_functions_in_instance_constraints()
-            self._find_closest_free_index()
-            self.eval_instance_constraints = \
-                self._instance_constraints_func()
-            self.eval_instance_constraints_jacobian_values = \
-                self._instance_constraints_jacobian_values_func()
+            if cached is None:
+                self._identify_functions_in_instance_constraints()
+                self._find_closest_free_index()
+                self.eval_instance_constraints = \
+                    self._instance_constraints_func()
+                self.eval_instance_constraints_jacobian_values = \
+                    self._instance_constraints_jacobian_values_func()
+            else:
+                self._instance_constraints_from_sources(cached)
+
+        # The constraint and variable indices of the non-zero partial
+        # derivatives of the path constraints, see
+        # _path_constraints_jacobian_pattern().
+        self._path_con_jac_pattern = None
+
+        if path_constraints is None:
+            self.path_constraints = None
+            self.num_path_constraints = 0
+        else:
+            self.path_constraints = tuple(path_constraints)
+            self.num_path_constraints = len(self.path_constraints)
+            self.num_constraints += (self.num_path_constraints *
+                                     num_collocation_nodes)
+            self._check_path_constraints()
+
+        if cached is None:
+            self._write_cached_symbols()
+
+    def _check_mass_forcing(self, state_symbols):
+        """Raises a ValueError if the mass matrix and forcing vector do not
+        have the shapes of the n first order equations of motion or contain
+        derivatives."""
+        import sympy as sm
+
+        n = len(state_symbols)
+
+        if (self.mass_matrix.shape != (n, n) or
+                self.forcing_vector.shape != (n, 1)):
+            msg = ('The mass matrix must be shape({0}, {0}) and the forcing '
+                   'vector shape({0}, 1) for {0} states.')
+            raise ValueError(msg.format(n))
+
+        if (self.mass_matrix.atoms(sm.Derivative) or
+                self.forcing_vector.atoms(sm.Derivative)):
+            msg = ('The mass matrix and forcing vector can not contain '
+                   'derivatives.')
+            raise ValueError(msg)
+
+    def _check_explicit_form(self):
+        """Raises a ValueError if the equations of motion are not in the
+        explicit form x' - f(x, u, p)."""
+        import sympy as sm
+
+        rhs = sm.Matrix(self.state_derivative_symbols) - self.eom
+
+        if rhs.atoms(sm.Derivative):
+            msg = ("The equations of motion must be in the explicit form "
+                   "x' - f(x, u, p) with the derivatives in the order of "
+                   "the states.")
+            raise ValueError(msg)
 
     @property
     def integration_method(self):
@@ -491,7 +1716,16 @@ class ConstraintCollocator(object):
         else:
             self._integration_method = method
             self._discrete_symbols()
+            # The equations of motion are discretized when first needed,
+            # which is not at all if the compiled functions are cached.
+            self._discrete_eom = None
+
+    @property
+    def discrete_eom(self):
+        """The discretized equations of motion, see _discretize_eom()."""
+        if self._discrete_eom is None:
             self._discretize_eom()
+        return self._discrete_eom
 
     @staticmethod
     def _parse_inputs(all_syms, known_syms):
@@ -590,7 +1824,9 @@ class ConstraintCollocator(object):
         states = set(self.state_symbols)
         states_derivatives = set(self.state_derivative_symbols)
 
-        time_varying_symbols = me.find_dynamicsymbols(self.eom)
+        from sympy.physics.mechanics import find_dynamicsymbols
+
+        time_varying_symbols = find_dynamicsymbols(self.eom)
         state_related = states.union(states_derivatives)
         non_states = time_varying_symbols.difference(state_related)
 
@@ -636,6 +1872,7 @@ class ConstraintCollocator(object):
             inputs.
 
         """
+        import sympy as sm
 
         # The previus, current, and next states.
         self.previous_discrete_state_symbols = \
@@ -681,6 +1918,8 @@ class ConstraintCollocator(object):
             The column vector of the discretized equations of motion.
 
         """
+        from sympy.physics.mechanics import msubs
+
         x = self.state_symbols
         xd = self.state_derivative_symbols
         u = self.input_trajectories
@@ -699,35 +1938,62 @@ class ConstraintCollocator(object):
 
             func_sub = dict(zip(x + u, xi + ui))
 
-            self.discrete_eom = me.msubs(self.eom, deriv_sub, func_sub)
+            self._discrete_eom = msubs(self.eom, deriv_sub, func_sub)
 
         elif self.integration_method == 'midpoint':
 
             xdot_sub = {d: (n - i) / h for d, i, n in zip(xd, xi, xn)}
             x_sub = {d: (i + n) / 2 for d, i, n in zip(x, xi, xn)}
             u_sub = {d: (i + n) / 2 for d, i, n in zip(u, ui, un)}
-            self.discrete_eom = me.msubs(self.eom, xdot_sub, x_sub, u_sub)
+            self._discrete_eom = msubs(self.eom, xdot_sub, x_sub, u_sub)
 
     def _identify_functions_in_instance_constraints(self):
         """Instantiates a set containing all of the instance functions, i.e.
-        x(1.0) in the instance constraints."""
+        x(1.0) in the instance constraints, and a set of the unknown
+        parameters in the instance constraints."""
+        from sympy.core.function import AppliedUndef
+
+        free_funcs = (self.state_symbols +
+                      self.unknown_input_trajectories)
+        free_func_classes = [f.__class__ for f in free_funcs]
 
         all_funcs = set()
+        all_pars = set()
 
         for con in self.instance_constraints:
-            all_funcs = all_funcs.union(con.atoms(sm.Function))
+            funcs = con.atoms(AppliedUndef)
+            for func in funcs:
+                if (func.__class__ not in free_func_classes or
+                        len(func.args) != 1 or
+                        not func.args[0].is_number):
+                    msg = ('{} in the instance constraints is not a state or '
+                           'unknown input trajectory at an instant of time.')
+                    raise ValueError(msg.format(func))
+            all_funcs = all_funcs.union(funcs)
+            all_pars = all_pars.union(con.free_symbols.intersection(
+                self.unknown_parameters))
 
         self.instance_constraint_function_atoms = all_funcs
+        self.instance_constraint_unknown_parameters = all_pars
 
     def _find_closest_free_index(self):
         """Instantiates a dictionary mapping the instance functions to the
-        nearest index in the free variables vector."""
-
-        def determine_free_index(time_index, state):
-            state_index = self.state_symbols.index(state)
-            return time_index + state_index * self.num_collocation_nodes
+        nearest index in the free variables vector and the unknown
+        parameters to their index in the free variables vector."""
 
         N = self.num_collocation_nodes
+        n = self.num_states
+
+        unknown_classes = [f.__class__ for f in
+                           self.unknown_input_trajectories]
+
+        def determine_free_index(time_index, func):
+            if func in self.state_symbols:
+                trajectory_index = self.state_symbols.index(func)
+            else:
+                trajectory_index = n + unknown_classes.index(func.__class__)
+            return time_index + trajectory_index * N
+
         h = self.node_time_interval
         duration = h * (N - 1)
 
@@ -735,17 +2001,32 @@ class ConstraintCollocator(object):
 
         node_map = {}
         for func in self.instance_constraint_function_atoms:
-            time_value = func.args[0]
+            time_value = float(func.args[0])
             time_index = np.argmin(np.abs(time_vector - time_value))
             free_index = determine_free_index(time_index,
                                               func.__class__(self.time_symbol))
             node_map[func] = free_index
 
+        num_trajectory_values = (n + self.num_unknown_input_trajectories) * N
+        for par in self.instance_constraint_unknown_parameters:
+            node_map[par] = (num_trajectory_values +
+                             self.unknown_parameters.index(par))
+
         self.instance_constraints_free_index_map = node_map
 
+    def _instance_constraint_free_atoms(self, con):
+        """Returns a list of the instance functions and unknown parameters
+        in an instance constraint ordered by their index in the free
+        variables vector."""
+        idx_map = self.instance_constraints_free_index_map
+        atoms = [a for a in idx_map.keys() if con.has(a)]
+        return sorted(atoms, key=lambda a: idx_map[a])
+
     def _instance_constraints_func(self):
         """Returns a function that evaluates the instance constraints given
         the free optimization variables."""
+        import sympy as sm
+
         free = sm.DeferredVector('FREE')
         def_map = {k: free[v] for k, v in
                    self.instance_constraints_free_index_map.items()}
@@ -755,21 +2036,27 @@ class ConstraintCollocator(object):
                         subbed_constraints, modules=[{'ImmutableMatrix':
                                                       np.array}, "numpy"])
 
+        self._instance_constraints_lambdified = f
+
+        return self._wrap_instance_constraints_func(f)
+
+    def _wrap_instance_constraints_func(self, f):
+        """Returns a function of the free optimization variables that
+        evaluates the lambdified instance constraints."""
         return lambda free: f(free, *self.known_parameter_map.values())
 
     def _instance_constraints_jacobian_indices(self):
         """Returns the row and column indices of the non-zero values in the
         Jacobian of the constraints."""
-        idx_map = self.instance_constraints_free_index_map
 
         num_eom_constraints = self.num_states * (self.num_collocation_nodes - 1)
 
         rows = []
         cols = []
 
-        for i, con in enumerate(self.instance_constraints):
-            funcs = con.atoms(sm.Function)
-            indices = [idx_map[f] for f in funcs]
+        columns = self._instance_constraints_jacobian_columns
+
+        for i, indices in enumerate(columns):
             row_idxs = num_eom_constraints + i * np.ones(len(indices),
                                                          dtype=int)
             rows += list(row_idxs)
@@ -780,6 +2067,8 @@ class ConstraintCollocator(object):
     def _instance_constraints_jacobian_values_func(self):
         """Retruns the non-zero values of the constraint Jacobian associated
         with the instance constraints."""
+        import sympy as sm
+
         free = sm.DeferredVector('FREE')
 
         def_map = {k: free[v] for k, v in
@@ -787,27 +2076,320 @@ class ConstraintCollocator(object):
 
         funcs = []
         num_vals_per_func = []
+        columns = []
         for con in self.instance_constraints:
-            partials = list(con.atoms(sm.Function))
+            partials = self._instance_constraint_free_atoms(con)
             num_vals_per_func.append(len(partials))
+            columns.append([int(self.instance_constraints_free_index_map[a])
+                            for a in partials])
             jac = sm.Matrix([con]).jacobian(partials)
             jac = jac.subs(def_map)
             funcs.append(sm.lambdify(([free] +
                                       list(self.known_parameter_map.keys())),
                                      jac, modules=[{'ImmutableMatrix':
                                                     np.array}, "numpy"]))
+
+        self._instance_constraints_jacobian_lambdified = funcs
+        self._instance_constraints_jacobian_sizes = num_vals_per_func
+        self._instance_constraints_jacobian_columns = columns
+
+        return self._wrap_instance_constraints_jacobian_values_func(
+            funcs, num_vals_per_func)
+
+    def _wrap_instance_constraints_jacobian_values_func(self, funcs,
+                                                        num_vals_per_func):
+        """Returns a function of the free optimization variables that
+        evaluates the lambdified Jacobians of each instance constraint and
+        stacks the values."""
+
         l = np.sum(num_vals_per_func)
 
         def wrapped(free):
-            arr = np.zeros(l)
+            arr = np.empty(l)
+            known_values = list(self.known_parameter_map.values())
             j = 0
-            for i, (f, num) in enumerate(zip(funcs, num_vals_per_func)):
-                arr[j:j + num] = f(free, *self.known_parameter_map.values())
+            for f, num in zip(funcs, num_vals_per_func):
+                arr[j:j + num] = f(free, *known_values)
                 j += num
             return arr
 
         return wrapped
 
+    def _instance_constraints_sources(self):
+        """Returns a dictionary of the source of the lambdified instance
+        constraints and their Jacobians, and the free variable indices of
+        the Jacobians, that can be serialized as JSON, see
+        _instance_constraints_from_sources()."""
+        import inspect
+
+        return {'instance_constraints_source': inspect.getsource(
+                    self._instance_constraints_lambdified),
+                'instance_constraints_jacobian_sources': [
+                    inspect.getsource(f) for f in
+                    self._instance_constraints_jacobian_lambdified],
+                'instance_constraints_jacobian_sizes': [
+                    int(v) for v in self._instance_constraints_jacobian_sizes],
+                'instance_constraints_jacobian_columns':
+                    self._instance_constraints_jacobian_columns}
+
+    @staticmethod
+    def _exec_lambdified(source):
+        """Returns the function defined by the source of a lambdified
+        function."""
+        # The instance constraints are printed by lambdify() with NumPy's
+        # functions.
+        namespace = dict(vars(np))
+        namespace['numpy'] = np
+        exec(source, namespace)
+        return namespace['_lambdifygenerated']
+
+    def _instance_constraints_from_sources(self, meta):
+        """Instantiates the instance constraint functions from the output of
+        _instance_constraints_sources() without SymPy."""
+
+        f = self._exec_lambdified(meta['instance_constraints_source'])
+        self._instance_constraints_lambdified = f
+        self.eval_instance_constraints = \
+            self._wrap_instance_constraints_func(f)
+
+        funcs = [self._exec_lambdified(source) for source in
+                 meta['instance_constraints_jacobian_sources']]
+        sizes = meta['instance_constraints_jacobian_sizes']
+        self._instance_constraints_jacobian_lambdified = funcs
+        self._instance_constraints_jacobian_sizes = sizes
+        self._instance_constraints_jacobian_columns = \
+            meta['instance_constraints_jacobian_columns']
+        self.eval_instance_constraints_jacobian_values = \
+            self._wrap_instance_constraints_jacobian_values_func(funcs, sizes)
+
+    def _check_path_constraints(self):
+        """Raises an error if the path constraints contain anything other
+        than the states, input trajectories, and parameters."""
+        self._check_node_expressions(self.path_constraints, 'path constraint')
+
+    def _check_node_expressions(self, exprs, name):
+        """Raises an error if the expressions contain anything other than
+        the states, input trajectories, and parameters."""
+        import sympy as sm
+        from sympy.core.function import AppliedUndef
+
+        functions = set(self.state_symbols + self.input_trajectories)
+        symbols = set(self.parameters)
+
+        for expr in exprs:
+            if expr.atoms(sm.Derivative):
+                msg = 'The {} {} contains a derivative.'
+                raise ValueError(msg.format(name, expr))
+            funcs = expr.atoms(AppliedUndef)
+            # Time may only appear as the argument of the functions.
+            dummies = dict([(f, sm.Dummy()) for f in funcs])
+            syms = expr.xreplace(dummies).free_symbols - set(dummies.values())
+            if not funcs.issubset(functions) or not syms.issubset(symbols):
+                msg = ('The {} {} may only contain the states, input '
+                       'trajectories, and parameters of the equations of '
+                       'motion.')
+                raise ValueError(msg.format(name, expr))
+
+    def _discrete_path_constraints(self):
+        """Returns the path constraints as a column matrix of expressions
+        of the discrete symbols at the ith node."""
+        return self._discrete_node_expressions(self.path_constraints)
+
+    def _discrete_node_expressions(self, exprs):
+        """Returns a column matrix of the expressions of the states, input
+        trajectories, and parameters in terms of the discrete symbols at the
+        ith node."""
+        import sympy as sm
+        from sympy.physics.mechanics import msubs
+
+        func_sub = dict(zip(self.state_symbols + self.input_trajectories,
+                            self.current_discrete_state_symbols +
+                            self.current_discrete_specified_symbols))
+
+        return msubs(sm.Matrix(exprs), func_sub)
+
+    def _path_constraint_args(self):
+        constant_syms = self.known_parameters + self.unknown_parameters
+        args = (self.current_discrete_state_symbols +
+                self.current_discrete_specified_symbols + constant_syms)
+        return args, constant_syms
+
+    def _path_constraint_wrt(self):
+        """Returns the discrete symbols of the free variables at the ith
+        node, i.e. the states, the unknown input trajectories, and the
+        unknown parameters."""
+        return (self.current_discrete_state_symbols +
+                self.current_unknown_discrete_specified_symbols +
+                self.unknown_parameters)
+
+    def _path_constraints_jacobian_pattern(self):
+        """Returns a list of the pairs of the index of a path constraint
+        and the index of a free variable it contains, in the order of
+        _path_constraint_wrt(). Only the partial derivatives of these pairs
+        are evaluated, by constraint and then variable."""
+
+        if self._path_con_jac_pattern is None:
+            wrt = self._path_constraint_wrt()
+            pattern = []
+            for i, con in enumerate(self._discrete_path_constraints()):
+                syms = con.free_symbols
+                pattern += [[i, j] for j, w in enumerate(wrt) if w in syms]
+            self._path_con_jac_pattern = pattern
+
+        return self._path_con_jac_pattern
+
+    def _gen_path_con_func(self):
+        """Instantiates _eval_path_constraints, which evaluates the path
+        constraints at all N nodes."""
+
+        cached = self._read_cached_kernel('path_con')
+        if cached is not None:
+            self._path_con_kernel = cached[0]
+            self._path_con_func_from_kernel(self._path_con_kernel)
+            self._set_parallel_options('path_con', self._path_con_kernel)
+            return
+
+        args, constant_syms = self._path_constraint_args()
+
+        f = ufuncify_matrix(args, self._discrete_path_constraints(),
+                            const=constant_syms, tmp_dir=self.tmp_dir,
+                            parallel=self.parallel,
+                            max_workers=self.max_workers,
+                            split_size=self.split_size)
+
+        self._path_con_kernel = f
+        self._path_con_func_from_kernel(f)
+        self._set_parallel_options('path_con', f)
+        self._write_cached_kernel('path_con', f)
+
+    def _gen_path_con_jac_func(self):
+        """Instantiates _eval_path_constraints_jacobian, which evaluates
+        the partial derivatives of the path constraints with respect to the
+        states, unknown input trajectories, and unknown parameters at all N
+        nodes."""
+
+        cached = self._read_cached_kernel('path_con_jac')
+        if cached is not None:
+            self._path_con_jac_kernel, self._path_con_jac_pattern = cached
+            self._path_con_jac_func_from_kernel(
+                self._path_con_jac_kernel, len(self._path_con_jac_pattern))
+            self._set_parallel_options('path_con_jac',
+                                       self._path_con_jac_kernel)
+            return
+
+        import sympy as sm
+
+        args, constant_syms = self._path_constraint_args()
+
+        # forward_jacobian() only differentiates each constraint with
+        # respect to the variables it contains, and only those partial
+        # derivatives are compiled.
+        sub_exprs, partials = forward_jacobian(
+            self._discrete_path_constraints(), self._path_constraint_wrt(),
+            max_workers=self.max_workers)
+
+        pattern = self._path_constraints_jacobian_pattern()
+        non_zero = sm.Matrix([[partials[i, j] for i, j in pattern]])
+
+        f = ufuncify_matrix(args, non_zero, const=constant_syms,
+                            tmp_dir=self.tmp_dir, parallel=self.parallel,
+                            sub_exprs=sub_exprs, max_workers=self.max_workers,
+                            split_size=self.split_size)
+
+        self._path_con_jac_kernel = f
+        self._path_con_jac_func_from_kernel(f, len(pattern))
+        self._set_parallel_options('path_con_jac', f)
+        self._write_cached_kernel('path_con_jac', f, pattern)
+
+    def _path_con_func_from_kernel(self, f):
+
+        # The output arrays are reused for each number of nodes evaluated.
+        results = {}
+
+        def path_constraints(state_values, specified_values,
+                             constant_values):
+            """Returns the values of the path constraints, shape(s * N,),
+            ordered by constraint and then node, given the states, shape(n,
+            N), a list of the m input trajectories, shape(N,), and the
+            parameters, shape(p,)."""
+
+            num_nodes = state_values.shape[1]
+
+            args = ([x for x in state_values] + list(specified_values) +
+                    [c for c in constant_values])
+
+            try:
+                result = results[num_nodes]
+            except KeyError:
+                result = np.empty((num_nodes, self.num_path_constraints))
+                results[num_nodes] = result
+
+            values = f(result, *args,
+                       **self._kernel_kwargs.get('path_con', {}))
+            values = values.reshape(num_nodes, -1)
+
+            return values.T.ravel()
+
+        self._eval_path_constraints = path_constraints
+
+    def _path_con_jac_func_from_kernel(self, f, num_partials):
+
+        results = {}
+
+        def path_constraints_jacobian(state_values, specified_values,
+                                      constant_values):
+            """Returns the non-zero values of the Jacobian of the path
+            constraints, shape(N * num_partials,), ordered by node and then
+            as in _path_constraints_jacobian_pattern(), see
+            _path_constraints_jacobian_indices()."""
+
+            num_nodes = state_values.shape[1]
+
+            args = ([x for x in state_values] + list(specified_values) +
+                    [c for c in constant_values])
+
+            try:
+                result = results[num_nodes]
+            except KeyError:
+                result = np.empty((num_nodes, num_partials))
+                results[num_nodes] = result
+
+            return f(result, *args, **self._kernel_kwargs.get(
+                'path_con_jac', {})).ravel()
+
+        self._eval_path_constraints_jacobian = path_constraints_jacobian
+
+    def _path_constraints_jacobian_indices(self):
+        """Returns the row and column indices of the non-zero values in the
+        Jacobian of the path constraints, which are the last s * N
+        constraints."""
+
+        N = self.num_collocation_nodes
+        n = self.num_states
+        q = self.num_unknown_input_trajectories
+        r = self.num_unknown_parameters
+        s = self.num_path_constraints
+
+        first_row = self.num_constraints - s * N
+
+        nodes = np.arange(N)
+
+        # shape(n + q + r, N), the columns of the free variables at each node
+        node_cols = np.vstack([j * N + nodes for j in range(n)] +
+                              [n * N + j * N + nodes for j in range(q)] +
+                              [(n + q) * N + j + 0 * nodes
+                               for j in range(r)])
+
+        pattern = np.array(self._path_constraints_jacobian_pattern(),
+                           dtype=int).reshape(-1, 2)
+
+        # shape(N, num_partials)
+        rows = (first_row + N * pattern[np.newaxis, :, 0] +
+                nodes[:, np.newaxis])
+        cols = node_cols[pattern[:, 1]].T
+
+        return rows.ravel(), cols.ravel()
+
     def _gen_multi_arg_con_func(self):
         """Instantiates a function that evaluates the constraints given all
         of the arguments of the functions, i.e. not just the free
@@ -841,6 +2423,13 @@ class ConstraintCollocator(object):
         for n states and N-1 constraints at the time points.
 
         """
+        cached = self._read_cached_kernel('con')
+        if cached is not None:
+            self._con_kernel = cached[0]
+            self._con_func_from_kernel(self._con_kernel)
+            self._set_parallel_options('con', self._con_kernel)
+            return
+
         xi_syms = self.current_discrete_state_symbols
         xp_syms = self.previous_discrete_state_symbols
         xn_syms = self.next_discrete_state_symbols
@@ -854,25 +2443,41 @@ class ConstraintCollocator(object):
             args = [x for x in xi_syms] + [x for x in xp_syms]
             args += [s for s in si_syms] + list(constant_syms) + [h_sym]
 
-            current_start = 1
-            current_stop = None
-            adjacent_start = None
-            adjacent_stop = -1
-
         elif self.integration_method == 'midpoint':
 
             args = [x for x in xi_syms] + [x for x in xn_syms]
             args += [s for s in si_syms] + [s for s in sn_syms]
             args += list(constant_syms) + [h_sym]
 
-            current_start = None
-            current_stop = -1
-            adjacent_start = 1
-            adjacent_stop = None
-
         f = ufuncify_matrix(args, self.discrete_eom,
                             const=constant_syms + (h_sym,),
-                            tmp_dir=self.tmp_dir, parallel=self.parallel)
+                            tmp_dir=self.tmp_dir, parallel=self.parallel,
+                            max_workers=self.max_workers,
+                            split_size=self.split_size)
+
+        self._con_kernel = f
+        self._con_func_from_kernel(f)
+        self._set_parallel_options('con', f)
+        self._write_cached_kernel('con', f)
+
+    def _node_slices(self):
+        """Returns the start and stop indices of the current and adjacent
+        nodes of the N - 1 constraint nodes for the integration method."""
+        if self.integration_method == 'backward euler':
+            return 1, None, None, -1
+        elif self.integration_method == 'midpoint':
+            return None, -1, 1, None
+
+    def _con_func_from_kernel(self, f):
+        """Instantiates _multi_arg_con_func from the compiled function that
+        evaluates the discretized equations of motion, see
+        _gen_multi_arg_con_func()."""
+
+        current_start, current_stop, adjacent_start, adjacent_stop = \
+            self._node_slices()
+
+        # The output arrays are reused for each number of nodes evaluated.
+        results = {}
 
         def constraints(state_values, specified_values, constant_values,
                         interval_value):
@@ -884,8 +2489,9 @@ class ConstraintCollocator(object):
             ----------
             states : ndarray, shape(n, N)
                 The array of n states through N time steps.
-            specified_values : ndarray, shape(m, N) or shape(N,)
-                The array of m specifieds through N time steps.
+            specified_values : ndarray, shape(m, N) or shape(N,), or list
+                The array of m specifieds through N time steps or a list of
+                m arrays of shape(N,).
             constant_values : ndarray, shape(b,)
                 The array of b parameters.
             interval_value : float
@@ -903,8 +2509,10 @@ class ConstraintCollocator(object):
             if state_values.shape[0] < 2:
                 raise ValueError('There should always be at least two states.')
 
-            assert state_values.shape == (self.num_states,
-                                          self.num_collocation_nodes)
+            # The number of nodes is not fixed so that the same compiled
+            # function can evaluate trajectories of any length.
+            assert state_values.shape[0] == self.num_states
+            num_nodes = state_values.shape[1]
 
             x_current = state_values[:, current_start:current_stop]  # n x N - 1
             x_adjacent = state_values[:, adjacent_start:adjacent_stop]  # n x N - 1
@@ -913,18 +2521,22 @@ class ConstraintCollocator(object):
             args = [x for x in x_current] + [x for x in x_adjacent]
 
             # 2n + m x N - 1
-            if len(specified_values.shape) == 2:
+            if isinstance(specified_values, list):
+                args += [s[current_start:current_stop] for s in
+                         specified_values]
+                if self.integration_method == 'midpoint':
+                    args += [s[adjacent_start:adjacent_stop] for s in
+                             specified_values]
+            elif len(specified_values.shape) == 2:
                 assert specified_values.shape == \
-                    (self.num_input_trajectories,
-                     self.num_collocation_nodes)
+                    (self.num_input_trajectories, num_nodes)
                 si = specified_values[:, current_start:current_stop]
                 args += [s for s in si]
                 if self.integration_method == 'midpoint':
                     sn = specified_values[:, adjacent_start:adjacent_stop]
                     args += [s for s in sn]
             elif len(specified_values.shape) == 1 and specified_values.size != 0:
-                assert specified_values.shape == \
-                    (self.num_collocation_nodes,)
+                assert specified_values.shape == (num_nodes,)
                 si = specified_values[current_start:current_stop]
                 args += [si]
                 if self.integration_method == 'midpoint':
@@ -936,12 +2548,14 @@ class ConstraintCollocator(object):
 
             num_constraints = state_values.shape[1] - 1
 
-            # TODO : Move this to an attribute of the class so that it is
-            # only initialized once and just reuse it on each evaluation of
-            # this function.
-            result = np.empty((num_constraints, state_values.shape[0]))
+            try:
+                result = results[num_constraints]
+            except KeyError:
+                result = np.empty((num_constraints, state_values.shape[0]))
+                results[num_constraints] = result
 
-            return f(result, *args).T.flatten()
+            return f(result, *args,
+                     **self._kernel_kwargs.get('con', {})).T.flatten()
 
         self._multi_arg_con_func = constraints
 
@@ -974,12 +2588,11 @@ class ConstraintCollocator(object):
                                 self.num_unknown_input_trajectories +
                                 self.num_unknown_parameters)
 
-        num_non_zero_values = num_constraint_nodes * num_partials
+        if self._explicit_backward_euler:
+            return self._with_constraint_jacobian_indices(
+                *self._explicit_jacobian_indices())
 
-        if self.instance_constraints is not None:
-            ins_row_idxs, ins_col_idxs = \
-                self._instance_constraints_jacobian_indices()
-            num_non_zero_values += len(ins_row_idxs)
+        num_non_zero_values = num_constraint_nodes * num_partials
 
         jac_row_idxs = np.empty(num_non_zero_values, dtype=int)
         jac_col_idxs = np.empty(num_non_zero_values, dtype=int)
@@ -1149,12 +2762,67 @@ class ConstraintCollocator(object):
             jac_row_idxs[start:stop] = row_idx_permutations
             jac_col_idxs[start:stop] = col_idx_permutations
 
+        return self._with_constraint_jacobian_indices(jac_row_idxs,
+                                                      jac_col_idxs)
+
+    def _with_constraint_jacobian_indices(self, jac_row_idxs, jac_col_idxs):
+        """Returns the Jacobian indices of the equations of motion followed
+        by those of the instance and path constraints."""
+
         if self.instance_constraints is not None:
-            jac_row_idxs[-len(ins_row_idxs):] = ins_row_idxs
-            jac_col_idxs[-len(ins_col_idxs):] = ins_col_idxs
+            ins_row_idxs, ins_col_idxs = \
+                self._instance_constraints_jacobian_indices()
+            jac_row_idxs = np.hstack((jac_row_idxs, ins_row_idxs))
+            jac_col_idxs = np.hstack((jac_col_idxs, ins_col_idxs))
+
+        if self.path_constraints is not None:
+            path_row_idxs, path_col_idxs = \
+                self._path_constraints_jacobian_indices()
+            jac_row_idxs = np.hstack((jac_row_idxs, path_row_idxs))
+            jac_col_idxs = np.hstack((jac_col_idxs, path_col_idxs))
 
         return jac_row_idxs, jac_col_idxs
 
+    @property
+    def _explicit_backward_euler(self):
+        return (self.explicit_form and
+                self.integration_method == 'backward euler')
+
+    def _explicit_jacobian_indices(self):
+        """Returns the row and column indices of the non-zero values of the
+        Jacobian of the equations of motion in explicit form with backward
+        Euler integration, see _explicit_jac_func_from_kernel().
+
+        The values are the N - 1 blocks of the partial derivatives of each
+        constraint with respect to the current states, unknown input
+        trajectories, and unknown parameters in the order of
+        jacobian_indices(), followed by the (N - 1) * n partial derivatives of
+        the constraints with respect to their previous state.
+
+        """
+        N = self.num_collocation_nodes
+        n = self.num_states
+        q = self.num_unknown_input_trajectories
+        r = self.num_unknown_parameters
+
+        nodes = np.arange(N - 1)[:, np.newaxis]
+
+        # shape(N - 1, n)
+        rows = np.arange(n) * (N - 1) + nodes
+
+        # shape(N - 1, n + q + r)
+        cols = np.hstack((np.arange(n) * N + nodes + 1,
+                          (n + np.arange(q)) * N + nodes + 1,
+                          np.tile((n + q) * N + np.arange(r), (N - 1, 1))))
+
+        block_rows = np.repeat(rows, n + q + r, axis=1)
+        block_cols = np.tile(cols, (1, n))
+
+        previous_cols = np.arange(n) * N + nodes
+
+        return (np.hstack((block_rows.ravel(), rows.ravel())),
+                np.hstack((block_cols.ravel(), previous_cols.ravel())))
+
     def _gen_multi_arg_con_jac_func(self):
         """Instantiates a function that evaluates the Jacobian of the
         constraints.
@@ -1166,6 +2834,40 @@ class ConstraintCollocator(object):
             at time points 2,...,N.
 
         """
+        cached = self._read_cached_kernel('con_jac')
+        if cached is not None:
+            self._con_jac_kernel, self._con_jac_kernel_size = cached
+            self._jac_func_from_kernel()
+            self._set_parallel_options('con_jac', self._con_jac_kernel)
+            return
+        elif self.explicit_form:
+            self._gen_explicit_jac_func()
+        elif self._mass_forcing_jacobian:
+            self._gen_mass_forcing_jac_func()
+        else:
+            self._gen_general_jac_func()
+
+        self._set_parallel_options('con_jac', self._con_jac_kernel)
+        self._write_cached_kernel('con_jac', self._con_jac_kernel,
+                                  self._con_jac_kernel_size)
+
+    def _jac_func_from_kernel(self):
+        """Instantiates _multi_arg_con_jac_func from the compiled function
+        _con_jac_kernel for the form of the equations of motion."""
+        if self.explicit_form:
+            self._explicit_jac_func_from_kernel(self._con_jac_kernel,
+                                                self._con_jac_kernel_size)
+        elif self._mass_forcing_jacobian:
+            self._mass_forcing_jac_func_from_kernel(
+                self._con_jac_kernel, self._con_jac_kernel_size)
+        else:
+            self._con_jac_func_from_kernel(self._con_jac_kernel,
+                                           self._con_jac_kernel_size)
+
+    def _gen_general_jac_func(self):
+        """Instantiates _multi_arg_con_jac_func by differentiating the
+        discretized equations of motion."""
+
         xi_syms = self.current_discrete_state_symbols
         xp_syms = self.previous_discrete_state_symbols
         xn_syms = self.next_discrete_state_symbols
@@ -1188,11 +2890,6 @@ class ConstraintCollocator(object):
             # Symbols/Functions in the matrix expression.
             args = xi_syms + xp_syms + si_syms + constant_syms + (h_sym,)
 
-            current_start = 1
-            current_stop = None
-            adjacent_start = None
-            adjacent_stop = -1
-
         elif self.integration_method == 'midpoint':
 
             wrt = (xi_syms + xn_syms + ui_syms + un_syms +
@@ -1203,14 +2900,13 @@ class ConstraintCollocator(object):
             args = (xi_syms + xn_syms + si_syms + sn_syms + constant_syms +
                     (h_sym,))
 
-            current_start = None
-            current_stop = -1
-            adjacent_start = 1
-            adjacent_stop = None
-
         # This creates a matrix with all of the symbolic partial derivatives
-        # necessary to compute the full Jacobian.
-        symbolic_partials = self.discrete_eom.jacobian(wrt)
+        # necessary to compute the full Jacobian. The derivatives are taken
+        # of the common subexpressions of the equations of motion, so they
+        # are written in terms of the same intermediates instead of the
+        # expanded expressions.
+        sub_exprs, symbolic_partials = forward_jacobian(
+            self.discrete_eom, wrt, max_workers=self.max_workers)
 
         # This generates a numerical function that evaluates the matrix of
         # partial derivatives. This function returns the non-zero elements
@@ -1218,11 +2914,27 @@ class ConstraintCollocator(object):
         eval_partials = ufuncify_matrix(args, symbolic_partials,
                                         const=constant_syms + (h_sym,),
                                         tmp_dir=self.tmp_dir,
-                                        parallel=self.parallel)
+                                        parallel=self.parallel,
+                                        sub_exprs=sub_exprs,
+                                        max_workers=self.max_workers,
+                                        split_size=self.split_size)
+
+        self._con_jac_kernel = eval_partials
+        self._con_jac_kernel_size = (symbolic_partials.shape[0] *
+                                     symbolic_partials.shape[1])
+        self._con_jac_func_from_kernel(eval_partials,
+                                       self._con_jac_kernel_size)
 
-        result = np.empty((self.num_collocation_nodes - 1,
-                           symbolic_partials.shape[0] *
-                           symbolic_partials.shape[1]))
+    def _con_jac_func_from_kernel(self, eval_partials, num_partials):
+        """Instantiates _multi_arg_con_jac_func from the compiled function
+        that evaluates the num_partials partial derivatives of the
+        discretized equations of motion, see _gen_multi_arg_con_jac_func()."""
+
+        current_start, current_stop, adjacent_start, adjacent_stop = \
+            self._node_slices()
+
+        # The output arrays are reused for each number of nodes evaluated.
+        results = {}
 
         def constraints_jacobian(state_values, specified_values,
                                  parameter_values, interval_value):
@@ -1235,8 +2947,9 @@ class ConstraintCollocator(object):
             states : ndarray, shape(n, N)
                 The array of n states through N time steps. There are always
                 at least two states.
-            specified_values : ndarray, shape(m, N) or shape(N,)
-                The array of m specified inputs through N time steps.
+            specified_values : ndarray, shape(m, N) or shape(N,), or list
+                The array of m specified inputs through N time steps or a
+                list of m arrays of shape(N,).
             parameter_values : ndarray, shape(p,)
                 The array of p parameter.
             interval_value : float
@@ -1275,7 +2988,13 @@ class ConstraintCollocator(object):
             args = [x for x in x_current] + [x for x in x_adjacent]
 
             # 2n + m x N - 1
-            if len(specified_values.shape) == 2:
+            if isinstance(specified_values, list):
+                args += [s[current_start:current_stop] for s in
+                         specified_values]
+                if self.integration_method == 'midpoint':
+                    args += [s[adjacent_start:adjacent_stop] for s in
+                             specified_values]
+            elif len(specified_values.shape) == 2:
                 si = specified_values[:, current_start:current_stop]
                 args += [s for s in si]
                 if self.integration_method == 'midpoint':
@@ -1291,14 +3010,359 @@ class ConstraintCollocator(object):
             args += [c for c in parameter_values]
             args += [interval_value]
 
+            num_nodes = state_values.shape[1]
+            try:
+                result = results[num_nodes]
+            except KeyError:
+                result = np.empty((num_nodes - 1, num_partials))
+                results[num_nodes] = result
+
             # backward euler: shape(N - 1, n, 2*n + q + r)
             # midpoint: shape(N - 1, n, 2*n + 2*q + r)
-            non_zero_derivatives = eval_partials(result, *args)
+            non_zero_derivatives = eval_partials(
+                result, *args, **self._kernel_kwargs.get('con_jac', {}))
 
             return non_zero_derivatives.ravel()
 
         self._multi_arg_con_jac_func = constraints_jacobian
 
+    def _gen_mass_forcing_jac_func(self):
+        """Instantiates _multi_arg_con_jac_func for equations of motion given
+        as a mass matrix and forcing vector, M(x, r, p) x' = F(x, r, p).
+
+        Instead of differentiating the discretized M x' - F, which repeats
+        M in the partial derivatives of the state derivative approximation,
+        the partial derivatives of M v - F are taken for a vector of symbols
+        v that is given the numerical state derivative approximation. The
+        partial derivatives with respect to v are M, so the blocks of the
+        Jacobian are assembled from these, e.g. for backward Euler:
+
+            d/dxi = d(M v - F)/dx + M / h
+            d/dxp = -M / h
+
+        """
+        import sympy as sm
+        from sympy.physics.mechanics import msubs
+
+        xi_syms = self.current_discrete_state_symbols
+        si_syms = self.current_discrete_specified_symbols
+        ui_syms = self.current_unknown_discrete_specified_symbols
+        h_sym = self.time_interval_symbol
+        constant_syms = self.known_parameters + self.unknown_parameters
+
+        n = self.num_states
+        q = self.num_unknown_input_trajectories
+
+        # These stand in for the approximation of the state derivatives.
+        # They are named by their position, unlike Dummy symbols, so that
+        # the generated code is the same in every process.
+        v_syms = tuple([sm.Symbol('_opty_v{}'.format(i), real=True)
+                        for i in range(len(self.state_symbols))])
+
+        # M and F are evaluated at the current node for backward Euler and
+        # at the midpoint for midpoint integration.
+        func_sub = dict(zip(self.state_symbols + self.input_trajectories,
+                            xi_syms + si_syms))
+        mass_matrix = msubs(self.mass_matrix, func_sub)
+        forcing_vector = msubs(self.forcing_vector, func_sub)
+
+        wrt = xi_syms + ui_syms + self.unknown_parameters + v_syms
+        sub_exprs, partials = forward_jacobian(
+            mass_matrix * sm.Matrix(v_syms) - forcing_vector, wrt,
+            max_workers=self.max_workers)
+
+        x_partials = partials[:, :n]
+        u_partials = partials[:, n:n + q]
+        p_partials = partials[:, n + q:-n]
+        mass_h = partials[:, -n:] / h_sym
+
+        if self.integration_method == 'backward euler':
+            blocks = [x_partials + mass_h, -mass_h, u_partials, p_partials]
+        elif self.integration_method == 'midpoint':
+            blocks = [x_partials / 2 - mass_h, x_partials / 2 + mass_h,
+                      u_partials / 2, u_partials / 2, p_partials]
+
+        symbolic_partials = sm.Matrix.hstack(*blocks)
+
+        args = xi_syms + si_syms + v_syms + constant_syms + (h_sym,)
+
+        eval_partials = ufuncify_matrix(args, symbolic_partials,
+                                        const=constant_syms + (h_sym,),
+                                        tmp_dir=self.tmp_dir,
+                                        parallel=self.parallel,
+                                        sub_exprs=sub_exprs,
+                                        max_workers=self.max_workers,
+                                        split_size=self.split_size)
+
+        self._con_jac_kernel = eval_partials
+        self._con_jac_kernel_size = (symbolic_partials.shape[0] *
+                                     symbolic_partials.shape[1])
+        self._mass_forcing_jac_func_from_kernel(eval_partials,
+                                                self._con_jac_kernel_size)
+
+    def _mass_forcing_jac_func_from_kernel(self, eval_partials,
+                                           num_partials):
+        """Instantiates _multi_arg_con_jac_func from the compiled function
+        that evaluates the num_partials partial derivatives of the equations
+        of motion given the mass matrix and forcing vector, see
+        _gen_mass_forcing_jac_func()."""
+
+        current_start, current_stop, adjacent_start, adjacent_stop = \
+            self._node_slices()
+
+        midpoint = self.integration_method == 'midpoint'
+
+        # The output arrays are reused for each number of nodes evaluated.
+        results = {}
+
+        def constraints_jacobian(state_values, specified_values,
+                                 parameter_values, interval_value):
+            """Returns the values of the sparse constraint Jacobian matrix
+            given all of the values for each variable in the equations of
+            motion over the N - 1 nodes.
+
+            Parameters
+            ----------
+            states : ndarray, shape(n, N)
+                The array of n states through N time steps.
+            specified_values : ndarray, shape(m, N) or shape(N,), or list
+                The array of m specified inputs through N time steps or a
+                list of m arrays of shape(N,).
+            parameter_values : ndarray, shape(p,)
+                The array of p parameter.
+            interval_value : float
+                The value of the discretization time interval.
+
+            Returns
+            -------
+            constraint_jacobian_values : ndarray, shape(see below,)
+                backward euler: shape((N - 1) * n * (2*n + q + r),)
+                midpoint: shape((N - 1) * n * (2*n + 2*q + r),)
+                The values of the non-zero entries of the constraints
+                Jacobian. These correspond to the triplet formatted indices
+                returned from jacobian_indices.
+
+            """
+            x_current = state_values[:, current_start:current_stop]
+            x_adjacent = state_values[:, adjacent_start:adjacent_stop]
+
+            specified = self._specified_list(specified_values)
+
+            # The states, inputs, and state derivatives at which M and F are
+            # evaluated.
+            if midpoint:
+                x_eval = (x_current + x_adjacent) / 2.0
+                v_values = (x_adjacent - x_current) / interval_value
+                s_eval = [(s[current_start:current_stop] +
+                           s[adjacent_start:adjacent_stop]) / 2.0
+                          for s in specified]
+            else:
+                x_eval = x_current
+                v_values = (x_current - x_adjacent) / interval_value
+                s_eval = [s[current_start:current_stop] for s in specified]
+
+            args = [x for x in x_eval] + s_eval + [v for v in v_values]
+            args += [c for c in parameter_values]
+            args += [interval_value]
+
+            num_nodes = state_values.shape[1]
+            try:
+                result = results[num_nodes]
+            except KeyError:
+                result = np.empty((num_nodes - 1, num_partials))
+                results[num_nodes] = result
+
+            return eval_partials(result, *args, **self._kernel_kwargs.get(
+                'con_jac', {})).ravel()
+
+        self._multi_arg_con_jac_func = constraints_jacobian
+
+    @staticmethod
+    def _specified_list(specified_values):
+        """Returns the specified values given to the multi argument
+        functions, ndarray shape(m, N) or shape(N,), or a list, as a list of
+        m arrays of shape(N,)."""
+        if isinstance(specified_values, list):
+            return specified_values
+        elif len(specified_values.shape) == 2:
+            return list(specified_values)
+        elif specified_values.size != 0:
+            return [specified_values]
+        else:
+            return []
+
+    def _gen_explicit_jac_func(self):
+        """Instantiates _multi_arg_con_jac_func for equations of motion in
+        the explicit form x' - f(x, r, p).
+
+        Only the partial derivatives of f with respect to the states, the
+        unknown input trajectories, and the unknown parameters are compiled,
+        evaluated at the current node for backward Euler and at the
+        midpoint for midpoint integration. The partial derivatives of the
+        state derivative approximation are the known identity blocks, e.g.
+        for backward Euler:
+
+            d/dxi = I / h - df/dx
+            d/dxp = -I / h
+
+        where only the diagonal of d/dxp is stored, see
+        _explicit_jacobian_indices(). For midpoint integration the compiled
+        function averages the values of the nodes and the halves of df/dx
+        and df/du are shared by the blocks of both nodes.
+
+        """
+        import sympy as sm
+        from sympy.physics.mechanics import msubs
+
+        xi_syms = self.current_discrete_state_symbols
+        xn_syms = self.next_discrete_state_symbols
+        si_syms = self.current_discrete_specified_symbols
+        sn_syms = self.next_discrete_specified_symbols
+        h_sym = self.time_interval_symbol
+        constant_syms = self.known_parameters + self.unknown_parameters
+
+        n = self.num_states
+        q = self.num_unknown_input_trajectories
+
+        if self.integration_method == 'backward euler':
+            # f is evaluated at the current node.
+            x_syms, s_syms = xi_syms, si_syms
+            average_exprs = []
+            args = xi_syms + si_syms + constant_syms + (h_sym,)
+        elif self.integration_method == 'midpoint':
+            # f is evaluated at the midpoint, which the compiled function
+            # computes first. The midpoint symbols are named by their
+            # position so that the generated code is the same in every
+            # process.
+            x_syms = tuple([sm.Symbol('_opty_x{}'.format(i), real=True)
+                            for i in range(len(xi_syms))])
+            s_syms = tuple([sm.Symbol('_opty_s{}'.format(i), real=True)
+                            for i in range(len(si_syms))])
+            average_exprs = [(a, (c + d) / 2) for a, c, d in
+                             zip(x_syms + s_syms, xi_syms + si_syms,
+                                 xn_syms + sn_syms)]
+            args = (xi_syms + xn_syms + si_syms + sn_syms + constant_syms +
+                    (h_sym,))
+
+        func_sub = dict(zip(self.state_symbols + self.input_trajectories,
+                            x_syms + s_syms))
+        rhs = msubs(sm.Matrix(self.state_derivative_symbols) - self.eom,
+                    func_sub)
+
+        wrt = (x_syms + s_syms[self.num_known_input_trajectories:] +
+               self.unknown_parameters)
+        sub_exprs, partials = forward_jacobian(
+            rhs, wrt, max_workers=self.max_workers)
+        sub_exprs = average_exprs + sub_exprs
+
+        identity_h = sm.eye(n) / h_sym
+        p_partials = -partials[:, n + q:]
+
+        if self.integration_method == 'backward euler':
+            blocks = [identity_h - partials[:, :n], -partials[:, n:n + q],
+                      p_partials]
+        elif self.integration_method == 'midpoint':
+
+            # The partial derivatives with respect to the values at either
+            # node are half of those with respect to the midpoint values.
+            half_syms = sm.numbered_symbols('_opty_h', real=True)
+
+            def half(e):
+                e = -e / 2
+                if e.is_Atom or (e.is_Mul and all(a.is_Atom for a in
+                                                  e.args)):
+                    return e
+                sym = next(half_syms)
+                sub_exprs.append((sym, e))
+                return sym
+
+            x_halves = partials[:, :n].applyfunc(half)
+            u_halves = partials[:, n:n + q].applyfunc(half)
+            blocks = [x_halves - identity_h, x_halves + identity_h,
+                      u_halves, u_halves, p_partials]
+
+        symbolic_partials = sm.Matrix.hstack(*blocks)
+
+        eval_partials = ufuncify_matrix(args, symbolic_partials,
+                                        const=constant_syms + (h_sym,),
+                                        tmp_dir=self.tmp_dir,
+                                        parallel=self.parallel,
+                                        sub_exprs=sub_exprs,
+                                        max_workers=self.max_workers,
+                                        split_size=self.split_size)
+
+        self._con_jac_kernel = eval_partials
+        self._con_jac_kernel_size = (symbolic_partials.shape[0] *
+                                     symbolic_partials.shape[1])
+        self._explicit_jac_func_from_kernel(eval_partials,
+                                            self._con_jac_kernel_size)
+
+    def _explicit_jac_func_from_kernel(self, eval_partials, num_partials):
+        """Instantiates _multi_arg_con_jac_func from the compiled function
+        that evaluates the num_partials partial derivatives of the equations
+        of motion in explicit form, see _gen_explicit_jac_func()."""
+
+        if self.integration_method == 'midpoint':
+            # The arguments and values are those of the general function.
+            self._con_jac_func_from_kernel(eval_partials, num_partials)
+            return
+
+        n = self.num_states
+
+        # The output arrays are reused for each number of nodes evaluated.
+        results = {}
+
+        def constraints_jacobian(state_values, specified_values,
+                                 parameter_values, interval_value):
+            """Returns the values of the sparse constraint Jacobian matrix
+            given all of the values for each variable in the equations of
+            motion over the N - 1 nodes.
+
+            Parameters
+            ----------
+            states : ndarray, shape(n, N)
+                The array of n states through N time steps.
+            specified_values : ndarray, shape(m, N) or shape(N,), or list
+                The array of m specified inputs through N time steps or a
+                list of m arrays of shape(N,).
+            parameter_values : ndarray, shape(p,)
+                The array of p parameter.
+            interval_value : float
+                The value of the discretization time interval.
+
+            Returns
+            -------
+            constraint_jacobian_values : ndarray, shape(see below,)
+                shape((N - 1) * n * (n + q + r + 1),)
+                The values of the non-zero entries of the constraints
+                Jacobian. These correspond to the triplet formatted indices
+                returned from jacobian_indices.
+
+            """
+            args = [x for x in state_values[:, 1:]]
+            args += [s[1:] for s in self._specified_list(specified_values)]
+            args += [c for c in parameter_values]
+            args += [interval_value]
+
+            num_nodes = state_values.shape[1]
+            num_block_values = (num_nodes - 1) * num_partials
+            try:
+                result = results[num_nodes]
+            except KeyError:
+                result = np.empty(num_block_values + (num_nodes - 1) * n)
+                results[num_nodes] = result
+
+            eval_partials(result[:num_block_values].reshape(
+                (num_nodes - 1, num_partials)), *args,
+                **self._kernel_kwargs.get('con_jac', {}))
+
+            # The partial derivatives with respect to the previous states.
+            result[num_block_values:] = -1.0 / interval_value
+
+            return result
+
+        self._multi_arg_con_jac_func = constraints_jacobian
+
     @staticmethod
     def _merge_fixed_free(syms, fixed, free, typ):
         """Returns an array with the fixed and free values combined. This
@@ -1334,6 +3398,26 @@ class ConstraintCollocator(object):
                     n += 1
         return np.array(merged)
 
+    def _specified_rows(self, free_specified):
+        """Returns a list of the m input trajectories, each shape(N,), from
+        the known trajectories and the free unknown trajectories. Unlike
+        _merge_fixed_free(), the trajectories are not copied into a new
+        array, so memory mapped known trajectories are read from disk by
+        the compiled functions."""
+
+        rows = []
+        n = 0
+        for s in self.input_trajectories:
+            if s in self.known_trajectory_map:
+                rows.append(np.asarray(self.known_trajectory_map[s],
+                                       dtype=float))
+            elif len(free_specified.shape) == 1:
+                rows.append(free_specified)
+            else:
+                rows.append(free_specified[n])
+                n += 1
+        return rows
+
     def _wrap_constraint_funcs(self, func, typ):
         """Returns a function that evaluates all of the constraints or
         Jacobian of the constraints given the free optimization variables.
@@ -1354,33 +3438,55 @@ class ConstraintCollocator(object):
 
         """
 
+        # This is called several times on every iteration of the solver, so
+        # the sizes are looked up once here instead of on each call.
+        num_states = self.num_states
+        num_nodes = self.num_collocation_nodes
+        num_known_parameters = len(self.known_parameters)
+        num_parameters = len(self.parameters)
+        num_unknown_parameters = num_parameters - num_known_parameters
+
         def constraints(free):
 
             free_states, free_specified, free_constants = \
-                parse_free(free, self.num_states,
-                           self.num_unknown_input_trajectories,
-                           self.num_collocation_nodes)
+                parse_free(free, num_states,
+                           self.num_unknown_input_trajectories, num_nodes)
 
-            all_specified = self._merge_fixed_free(self.input_trajectories,
-                                                   self.known_trajectory_map,
-                                                   free_specified, 'traj')
+            all_specified = self._specified_rows(free_specified)
 
-            all_constants = self._merge_fixed_free(self.parameters,
-                                                   self.known_parameter_map,
-                                                   free_constants, 'par')
+            # The parameters are ordered as the known then the unknown.
+            all_constants = np.empty(num_parameters)
+            all_constants[num_known_parameters:] = \
+                free_constants[:num_unknown_parameters]
+            for i, p in enumerate(self.known_parameters):
+                all_constants[i] = self.known_parameter_map[p]
 
             eom_con_vals = func(free_states, all_specified, all_constants,
                                 self.node_time_interval)
 
+            if (self.instance_constraints is None and
+                    self.path_constraints is None):
+                return eom_con_vals
+
+            con_vals = [eom_con_vals]
+
             if self.instance_constraints is not None:
                 if typ == 'con':
-                    ins_con_vals = self.eval_instance_constraints(free)
+                    instance_vals = self.eval_instance_constraints(free)
                 elif typ == 'jac':
-                    ins_con_vals = \
+                    instance_vals = \
                         self.eval_instance_constraints_jacobian_values(free)
-                return np.hstack((eom_con_vals, ins_con_vals))
-            else:
-                return eom_con_vals
+                con_vals.append(np.ravel(instance_vals))
+
+            if self.path_constraints is not None:
+                if typ == 'con':
+                    path_func = self._eval_path_constraints
+                elif typ == 'jac':
+                    path_func = self._eval_path_constraints_jacobian
+                con_vals.append(path_func(free_states, all_specified,
+                                          all_constants))
+
+            return np.concatenate(con_vals)
 
         intro, second = func.__doc__.split('Parameters')
         params, returns = second.split('Returns')
@@ -1389,14 +3495,1362 @@ class ConstraintCollocator(object):
 
         return constraints
 
+    def _set_parallel_options(self, name, kernel):
+        """Sets the number of threads and the schedule that this collocator
+        calls the compiled function with the name with if it is
+        parallelized, tuning them for the number of nodes if parallel is
+        'auto' and they are not known from the cache. The options are
+        passed to each call, so collocators that share the function can use
+        different options."""
+        if name in self._kernel_options:
+            options = self._kernel_options[name]
+        elif self.parallel == 'auto':
+            try:
+                options = tune_parallel_options(
+                    kernel, self.num_collocation_nodes,
+                    num_threads=self.num_threads, schedule=self.schedule)
+            except ValueError:  # OpenMP is not available
+                return
+        else:
+            options = (self.num_threads, self.schedule)
+
+        kwargs = parallel_options(kernel, *options)
+        if kwargs:
+            self._kernel_options[name] = list(options)
+        self._kernel_kwargs[name] = kwargs
+
+    def _cache_key(self):
+        """Returns a hash of everything that the compiled functions depend
+        on, see the cache_dir argument."""
+        import hashlib
+        import sysconfig
+
+        import sympy as sm
+
+        from .version import __version__
+
+        def canonical(syms):
+            return [sm.srepr(s) for s in syms]
+
+        items = [__version__, sm.__version__,
+                 sysconfig.get_config_var('EXT_SUFFIX'),
+                 self.integration_method, self.explicit_form,
+                 self._mass_forcing_jacobian, self.parallel,
+                 sm.srepr(self.eom), sm.srepr(self.time_symbol),
+                 canonical(self.state_symbols),
+                 canonical(self.known_input_trajectories),
+                 canonical(self.unknown_input_trajectories),
+                 canonical(self.known_parameters),
+                 canonical(self.unknown_parameters),
+                 canonical(self.path_constraints or ())]
+
+        return hashlib.sha256(repr(items).encode('utf-8')).hexdigest()
+
+    def _symbols_cache_key(self):
+        """Returns a hash of everything that the sorted symbols and the
+        lambdified instance constraints depend on, see the cache_dir
+        argument."""
+        import hashlib
+        import sysconfig
+
+        import sympy as sm
+
+        from .version import __version__
+
+        def canonical(syms):
+            return [sm.srepr(s) for s in syms]
+
+        items = [__version__, sm.__version__,
+                 sysconfig.get_config_var('EXT_SUFFIX'),
+                 sm.srepr(self.eom), sm.srepr(self.time_symbol),
+                 canonical(self.state_symbols),
+                 # The known symbols are not sorted, so their order matters.
+                 canonical(self.known_parameter_map.keys()),
+                 canonical(self.known_trajectory_map.keys()),
+                 self.num_collocation_nodes, float(self.node_time_interval),
+                 canonical(self.instance_constraints or ())]
+
+        return hashlib.sha256(repr(items).encode('utf-8')).hexdigest()
+
+    def _cached_kernel_path(self, name):
+        try:
+            key = self._kernel_cache_key
+        except AttributeError:
+            key = self._kernel_cache_key = self._cache_key()
+
+        return self._cache_entry_path(key, name)
+
+    def _cache_entry_path(self, key, name):
+        import os
+
+        return os.path.join(self.cache_dir, '{}_{}.npz'.format(key, name))
+
+    def _check_cache_dir(self):
+        """Creates the cache directory, only writable by the user, if it
+        does not exist and raises a ValueError if someone else can write to
+        it, see cache_dir."""
+        import os
+
+        if self.cache_dir is None:
+            return
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, 0o700)
+
+        if _writable_by_others(self.cache_dir):
+            msg = ('The cache directory {} must be owned by the user and '
+                   'must not be writable by its group or others, as the '
+                   'code in it is executed.')
+            raise ValueError(msg.format(self.cache_dir))
+
+    def _read_cache_entry(self, path):
+        """Returns the metadata and the dictionary of arrays of the cache
+        entry at the path or None if it does not exist or someone else could
+        have written it."""
+        import os
+        import json
+
+        if not os.path.exists(path):
+            return None
+
+        if _writable_by_others(path):
+            msg = ('The cache entry {} is ignored as it is owned by another '
+                   'user or writable by its group or others.')
+            warnings.warn(msg.format(path))
+            return None
+
+        with np.load(path) as data:
+            meta = json.loads(str(data['metadata']))
+            arrays = {k: data[k] for k in data.files if k != 'metadata'}
+
+        return meta, arrays
+
+    def _write_cache_entry(self, path, meta, arrays={}):
+        """Writes the metadata and arrays to the cache entry at the path."""
+        import os
+        import json
+        import tempfile
+
+        if not os.path.isdir(self.cache_dir):
+            os.makedirs(self.cache_dir, 0o700)
+
+        # The entry is written next to its final path and moved there so
+        # that concurrent processes never read a partially written entry.
+        fd, tmp_path = tempfile.mkstemp(suffix='.npz', dir=self.cache_dir)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                np.savez(f, metadata=np.array(json.dumps(meta)), **arrays)
+            getattr(os, 'replace', os.rename)(tmp_path, path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+
+    def _read_cached_kernel(self, name):
+        """Returns the compiled function with the name and its size, see
+        _write_cached_kernel(), from the cache or None if it is not
+        cached."""
+        from .utils import _load_ufuncified_matrix
+
+        if self.cache_dir is None:
+            return None
+
+        entry = self._read_cache_entry(self._cached_kernel_path(name))
+        if entry is None:
+            return None
+        meta, arrays = entry
+
+        if meta.get('parallel_options') is not None:
+            self._kernel_options[name] = meta['parallel_options']
+
+        return (_load_ufuncified_matrix(meta['file_name'],
+                                        arrays['shared_object'].tobytes()),
+                meta['size'])
+
+    def _write_cached_kernel(self, name, kernel, size=None):
+        """Writes the compiled function with the name to the cache with
+        its size, the number of values it evaluates or, for the path
+        constraint Jacobian, the pattern of the values."""
+        from .utils import _shared_objects
+
+        if self.cache_dir is None:
+            return
+
+        file_name, shared_object = _shared_objects[kernel]
+        meta = {'file_name': file_name, 'size': size,
+                'parallel_options': self._kernel_options.get(name)}
+
+        self._write_cache_entry(
+            self._cached_kernel_path(name), meta,
+            {'shared_object': np.frombuffer(shared_object, dtype=np.uint8)})
+
+    def _read_cached_symbols(self):
+        """Returns the cached sorted symbols and instance constraint sources,
+        see _write_cached_symbols(), or None if they are not cached."""
+        if self.cache_dir is None:
+            return None
+
+        entry = self._read_cache_entry(self._cache_entry_path(
+            self._symbols_cache_key(), 'symbols'))
+
+        return None if entry is None else entry[0]
+
+    def _write_cached_symbols(self):
+        """Writes the sorted symbols and the source of the lambdified
+        instance constraints to the cache."""
+        import sympy as sm
+
+        if self.cache_dir is None:
+            return
+
+        def canonical(syms):
+            return [sm.srepr(s) for s in syms]
+
+        meta = {'known_parameters': canonical(self.known_parameters),
+                'unknown_parameters': canonical(self.unknown_parameters),
+                'known_input_trajectories':
+                    canonical(self.known_input_trajectories),
+                'unknown_input_trajectories':
+                    canonical(self.unknown_input_trajectories)}
+
+        if self.instance_constraints is not None:
+            meta.update(self._instance_constraints_sources())
+
+        self._write_cache_entry(self._cache_entry_path(
+            self._symbols_cache_key(), 'symbols'), meta)
+
+    def _sorted_symbols_from_cache(self, meta):
+        """Instantiates the sorted parameters and input trajectories from
+        the output of _read_cached_symbols(), see _sort_parameters() and
+        _sort_trajectories()."""
+        import sympy as sm
+
+        def symbols(sreprs):
+            return tuple(sm.sympify(s) for s in sreprs)
+
+        self.known_parameters = symbols(meta['known_parameters'])
+        self.num_known_parameters = len(self.known_parameters)
+        self.unknown_parameters = symbols(meta['unknown_parameters'])
+        self.num_unknown_parameters = len(self.unknown_parameters)
+        self.parameters = self.known_parameters + self.unknown_parameters
+        self.num_parameters = len(self.parameters)
+
+        self.known_input_trajectories = \
+            symbols(meta['known_input_trajectories'])
+        self.num_known_input_trajectories = \
+            len(self.known_input_trajectories)
+        self.unknown_input_trajectories = \
+            symbols(meta['unknown_input_trajectories'])
+        self.num_unknown_input_trajectories = \
+            len(self.unknown_input_trajectories)
+        self.input_trajectories = (self.known_input_trajectories +
+                                   self.unknown_input_trajectories)
+        self.num_input_trajectories = len(self.input_trajectories)
+
     def generate_constraint_function(self):
         """Returns a function which evaluates the constraints given the
         array of free optimization variables."""
         self._gen_multi_arg_con_func()
+        if self.path_constraints is not None:
+            self._gen_path_con_func()
         return self._wrap_constraint_funcs(self._multi_arg_con_func, 'con')
 
     def generate_jacobian_function(self):
         """Returns a function which evaluates the Jacobian of the
         constraints given the array of free optimization variables."""
         self._gen_multi_arg_con_jac_func()
+        if self.path_constraints is not None:
+            self._gen_path_con_jac_func()
         return self._wrap_constraint_funcs(self._multi_arg_con_jac_func, 'jac')
+
+    def _compiled_nlp_known_values(self):
+        """Returns the array of the known values of the compiled NLP: the
+        node time interval, the known parameters, and the known trajectories
+        one after the other, see _compiled_nlp_blocks()."""
+        values = [[self.node_time_interval]]
+        values.append([self.known_parameter_map[p] for p in
+                       self.known_parameters])
+        values += [self.known_trajectory_map[f] for f in
+                   self.known_input_trajectories]
+        return np.hstack(values).astype(float)
+
+    def _compiled_nlp_blocks(self, objective_expr):
+        """Returns the block of the objective and the blocks of the
+        equations of motion, instance constraints, and path constraints of
+        utils.ufuncify_nlp() in the order of the constraints."""
+        import sympy as sm
+
+        n = self.num_states
+        N = self.num_collocation_nodes
+        h = self.time_interval_symbol
+
+        num_trajectory_values = (n + self.num_unknown_input_trajectories) * N
+        num_known_constants = 1 + self.num_known_parameters
+
+        constants = ([(p, num_trajectory_values + i, 0) for i, p in
+                      enumerate(self.unknown_parameters)])
+        known_constants = ([(h, 0, 0)] +
+                           [(p, 1 + i, 0) for i, p in
+                            enumerate(self.known_parameters)])
+
+        def node(states, unknown, known, offset):
+            """Returns the free and known symbols of a node at the offset
+            from the block's node and their indices."""
+            variables = [(s, i * N + offset, 1) for i, s in enumerate(states)]
+            variables += [(s, (n + i) * N + offset, 1) for i, s in
+                          enumerate(unknown)]
+            known = [(s, num_known_constants + i * N + offset, 1) for i, s
+                     in enumerate(known)]
+            return variables, known
+
+        def block(exprs, nodes, num_nodes, rows=None):
+            syms = set().union(*[e.free_symbols for e in exprs])
+            variables = sum([v for v, _ in nodes], []) + constants
+            known = known_constants + sum([k for _, k in nodes], [])
+            return {'exprs': exprs, 'num_nodes': num_nodes, 'rows': rows,
+                    'variables': [v for v in variables if v[0] in syms],
+                    'known': [k for k in known if k[0] in syms]}
+
+        current = node(self.current_discrete_state_symbols,
+                       self.current_unknown_discrete_specified_symbols,
+                       self.current_known_discrete_specified_symbols, 0)
+
+        self._check_node_expressions([objective_expr], 'objective')
+        objective = block([h * self._discrete_node_expressions(
+            [objective_expr])[0]], [current], N)
+
+        # The N - 1 nodes of the equations of motion start at the second
+        # node with backward Euler and at the first with the midpoint
+        # method.
+        if self.integration_method == 'backward euler':
+            nodes = [node(self.previous_discrete_state_symbols, (), (), 0),
+                     node(self.current_discrete_state_symbols,
+                          self.current_unknown_discrete_specified_symbols,
+                          self.current_known_discrete_specified_symbols, 1)]
+        else:
+            nodes = [current,
+                     node(self.next_discrete_state_symbols,
+                          self.next_unknown_discrete_specified_symbols,
+                          self.next_known_discrete_specified_symbols, 1)]
+
+        constraints = [block(list(self.discrete_eom), nodes, N - 1,
+                             [(i * (N - 1), 1) for i in range(n)])]
+        start = n * (N - 1)
+
+        if self.instance_constraints is not None:
+            if not hasattr(self, 'instance_constraints_free_index_map'):
+                # Not found if the instance constraints were cached.
+                self._identify_functions_in_instance_constraints()
+                self._find_closest_free_index()
+            # Each instance function and unknown parameter is a free
+            # variable of a single node.
+            for i, con in enumerate(self.instance_constraints):
+                atoms = self._instance_constraint_free_atoms(con)
+                syms = [sm.Symbol('_opty_c{}'.format(j), real=True)
+                        for j in range(len(atoms))]
+                con = con.xreplace(dict(zip(atoms, syms)))
+                variables = [(s, self.instance_constraints_free_index_map[a],
+                              0) for s, a in zip(syms, atoms)]
+                constraints.append(
+                    {'exprs': [con], 'num_nodes': 1, 'rows': [(start, 0)],
+                     'variables': variables,
+                     'known': [k for k in known_constants if
+                               k[0] in con.free_symbols]})
+                start += 1
+
+        if self.path_constraints is not None:
+            exprs = list(self._discrete_path_constraints())
+            constraints.append(block(exprs, [current], N,
+                                     [(start + i * N, 1) for i in
+                                      range(len(exprs))]))
+
+        return objective, constraints
+
+    def _generate_compiled_nlp(self, objective_expr):
+        """Returns the compiled extension module that evaluates and solves
+        the NLP with the objective given by objective_expr, see Problem and
+        utils.ufuncify_nlp()."""
+        objective, constraints = self._compiled_nlp_blocks(objective_expr)
+        return ufuncify_nlp(objective, constraints, self.num_free,
+                            self.num_constraints, tmp_dir=self.tmp_dir)
+
+    def _saved_data(self):
+        """Returns a dictionary of metadata that can be serialized as JSON
+        and a dictionary of arrays that hold everything needed to restore
+        the compiled collocator without SymPy, see _from_saved()."""
+
+        import sysconfig
+
+        from .utils import _shared_objects
+        from .version import __version__
+
+        try:
+            con_file, con_so = _shared_objects[self._con_kernel]
+            jac_file, jac_so = _shared_objects[self._con_jac_kernel]
+        except (AttributeError, KeyError):
+            msg = ('The constraint and Jacobian functions must be generated '
+                   'before saving.')
+            raise ValueError(msg)
+
+        def names(syms):
+            return [str(s) for s in syms]
+
+        meta = {'opty_version': __version__,
+                'extension_suffix': sysconfig.get_config_var('EXT_SUFFIX'),
+                'num_collocation_nodes': int(self.num_collocation_nodes),
+                'node_time_interval': float(self.node_time_interval),
+                'integration_method': self.integration_method,
+                'state_symbols': names(self.state_symbols),
+                'known_input_trajectories':
+                    names(self.known_input_trajectories),
+                'unknown_input_trajectories':
+                    names(self.unknown_input_trajectories),
+                'known_parameters': names(self.known_parameters),
+                'unknown_parameters': names(self.unknown_parameters),
+                # The order of the known parameters is the order of the
+                # arguments of the instance constraint functions.
+                'known_parameter_map': [[str(k), float(v)] for k, v in
+                                        self.known_parameter_map.items()],
+                'known_trajectory_map':
+                    names(self.known_trajectory_map.keys()),
+                'con_kernel': con_file,
+                'con_jac_kernel': jac_file,
+                'con_jac_kernel_size': int(self._con_jac_kernel_size),
+                'mass_forcing_jacobian': self._mass_forcing_jacobian,
+                'explicit_form': self.explicit_form,
+                'kernel_options': self._kernel_options,
+                'instance_constraints': None,
+                'path_constraints': None}
+
+        arrays = {'con_kernel': np.frombuffer(con_so, dtype=np.uint8),
+                  'con_jac_kernel': np.frombuffer(jac_so, dtype=np.uint8)}
+
+        for i, v in enumerate(self.known_trajectory_map.values()):
+            arrays['known_trajectory_{}'.format(i)] = np.asarray(v,
+                                                                 dtype=float)
+
+        if self.instance_constraints is not None:
+            meta['instance_constraints'] = names(self.instance_constraints)
+            meta.update(self._instance_constraints_sources())
+
+        if self.path_constraints is not None:
+            path_con_file, path_con_so = \
+                _shared_objects[self._path_con_kernel]
+            path_jac_file, path_jac_so = \
+                _shared_objects[self._path_con_jac_kernel]
+            meta['path_constraints'] = names(self.path_constraints)
+            meta['path_con_kernel'] = path_con_file
+            meta['path_con_jac_kernel'] = path_jac_file
+            meta['path_con_jac_pattern'] = \
+                self._path_constraints_jacobian_pattern()
+            arrays['path_con_kernel'] = np.frombuffer(path_con_so,
+                                                      dtype=np.uint8)
+            arrays['path_con_jac_kernel'] = np.frombuffer(path_jac_so,
+                                                          dtype=np.uint8)
+
+        return meta, arrays
+
+    @classmethod
+    def _from_saved(cls, meta, arrays):
+        """Returns a collocator restored from the output of _saved_data()
+        without importing SymPy or compiling. The symbols are replaced by
+        their names, so only the numerical functions are available."""
+        import sysconfig
+
+        from .utils import _load_ufuncified_matrix
+        from .version import __version__
+
+        # The saved Python source is executed and the saved extension
+        # modules are loaded, so they are only used if they were made by
+        # this version of opty for this platform.
+        if meta.get('opty_version') != __version__:
+            msg = ('The problem was saved with opty {} and can not be loaded '
+                   'with opty {}.')
+            raise ValueError(msg.format(meta.get('opty_version'),
+                                        __version__))
+
+        suffix = sysconfig.get_config_var('EXT_SUFFIX')
+        if meta.get('extension_suffix') != suffix:
+            msg = ('The problem was compiled for {} and can not be loaded '
+                   'on this platform, {}.')
+            raise ValueError(msg.format(meta.get('extension_suffix'),
+                                        suffix))
+
+        self = cls.__new__(cls)
+
+        self.eom = None
+        self.mass_matrix = None
+        self.forcing_vector = None
+        self._mass_forcing_jacobian = meta.get('mass_forcing_jacobian',
+                                               False)
+        self.explicit_form = meta.get('explicit_form', False)
+        self.tmp_dir = None
+        self.parallel = False
+        self.memmap_dir = None
+        self.cache_dir = None
+        self.max_workers = None
+        self.split_size = None
+        self.num_threads = None
+        self.schedule = None
+        self._kernel_options = meta.get('kernel_options', {})
+        self._kernel_kwargs = {}
+
+        self.num_collocation_nodes = meta['num_collocation_nodes']
+        self.node_time_interval = meta['node_time_interval']
+        # The setter would discretize the symbolic equations of motion.
+        self._integration_method = meta['integration_method']
+
+        self.state_symbols = tuple(meta['state_symbols'])
+        self.num_states = len(self.state_symbols)
+
+        self.known_input_trajectories = \
+            tuple(meta['known_input_trajectories'])
+        self.num_known_input_trajectories = \
+            len(self.known_input_trajectories)
+        self.unknown_input_trajectories = \
+            tuple(meta['unknown_input_trajectories'])
+        self.num_unknown_input_trajectories = \
+            len(self.unknown_input_trajectories)
+        self.input_trajectories = (self.known_input_trajectories +
+                                   self.unknown_input_trajectories)
+        self.num_input_trajectories = len(self.input_trajectories)
+
+        self.known_parameters = tuple(meta['known_parameters'])
+        self.num_known_parameters = len(self.known_parameters)
+        self.unknown_parameters = tuple(meta['unknown_parameters'])
+        self.num_unknown_parameters = len(self.unknown_parameters)
+        self.parameters = self.known_parameters + self.unknown_parameters
+        self.num_parameters = len(self.parameters)
+
+        self.known_parameter_map = OrderedDict(
+            [(k, v) for k, v in meta['known_parameter_map']])
+        self.known_trajectory_map = OrderedDict(
+            [(k, arrays['known_trajectory_{}'.format(i)]) for i, k in
+             enumerate(meta['known_trajectory_map'])])
+
+        self.num_free = ((self.num_states +
+                          self.num_unknown_input_trajectories) *
+                         self.num_collocation_nodes +
+                         self.num_unknown_parameters)
+        self.num_constraints = (self.num_states *
+                                (self.num_collocation_nodes - 1))
+
+        if meta['instance_constraints'] is None:
+            self.instance_constraints = None
+        else:
+            self.instance_constraints = tuple(meta['instance_constraints'])
+            self.num_instance_constraints = len(self.instance_constraints)
+            self.num_constraints += self.num_instance_constraints
+            self._instance_constraints_from_sources(meta)
+
+        self._con_kernel = _load_ufuncified_matrix(
+            meta['con_kernel'], arrays['con_kernel'].tobytes())
+        self._con_func_from_kernel(self._con_kernel)
+
+        self._con_jac_kernel = _load_ufuncified_matrix(
+            meta['con_jac_kernel'], arrays['con_jac_kernel'].tobytes())
+        self._con_jac_kernel_size = meta['con_jac_kernel_size']
+        self._jac_func_from_kernel()
+
+        if meta['path_constraints'] is None:
+            self.path_constraints = None
+            self.num_path_constraints = 0
+        else:
+            self.path_constraints = tuple(meta['path_constraints'])
+            self.num_path_constraints = len(self.path_constraints)
+            self.num_constraints += (self.num_path_constraints *
+                                     self.num_collocation_nodes)
+            self._path_con_kernel = _load_ufuncified_matrix(
+                meta['path_con_kernel'], arrays['path_con_kernel'].tobytes())
+            self._path_con_func_from_kernel(self._path_con_kernel)
+            self._path_con_jac_kernel = _load_ufuncified_matrix(
+                meta['path_con_jac_kernel'],
+                arrays['path_con_jac_kernel'].tobytes())
+            self._path_con_jac_pattern = meta['path_con_jac_pattern']
+            self._path_con_jac_func_from_kernel(
+                self._path_con_jac_kernel, len(self._path_con_jac_pattern))
+
+        for name in self._kernel_options:
+            self._set_parallel_options(
+                name, getattr(self, '_{}_kernel'.format(name)))
+
+        return self
+
+    def _saved_functions(self):
+        """Returns the constraint and Jacobian functions of a collocator
+        restored by _from_saved()."""
+        return (self._wrap_constraint_funcs(self._multi_arg_con_func, 'con'),
+                self._wrap_constraint_funcs(self._multi_arg_con_jac_func,
+                                            'jac'))
+
+    def generate_ode_functions(self):
+        """Returns compiled functions that evaluate the first order form of
+        the equations of motion, xdot = f(x, r, p), and its Jacobian with
+        respect to the states, e.g. to simulate the model with
+        scipy.integrate.solve_ivp. The equations of motion must be linear in
+        the state derivatives, M(x, r, p) * xdot = F(x, r, p). If M is
+        diagonal f is found symbolically, otherwise the linear system is
+        solved numerically on each evaluation.
+
+        Returns
+        -------
+        rhs : function
+            ``rhs(x, r, p)`` returns xdot given the states ``x``, shape(n,)
+            ordered as ``state_symbols``, the input trajectories ``r``,
+            shape(m,) ordered as ``input_trajectories``, and the parameters
+            ``p``, shape(p,) ordered as ``parameters``. The states and input
+            trajectories may also be shape(n, K) and shape(m, K) to evaluate
+            K points at once, in which case xdot is shape(n, K).
+        rhs_jacobian : function
+            ``rhs_jacobian(x, r, p)`` returns df/dx, shape(n, n), or
+            shape(K, n, n) for K points, with the same arguments as rhs.
+
+        """
+        import sympy as sm
+        from sympy.physics.mechanics import msubs
+
+        x = self.state_symbols
+        xd = self.state_derivative_symbols
+        u = self.input_trajectories
+
+        xi = self.current_discrete_state_symbols
+        ui = self.current_discrete_specified_symbols
+        xdi = tuple([sm.Symbol(f.__class__.__name__ + 'd', real=True)
+                     for f in self.state_symbols])
+        p = self.parameters
+
+        eom = msubs(self.eom, dict(zip(xd, xdi)), dict(zip(x + u, xi + ui)))
+
+        mass_matrix = eom.jacobian(xdi)
+        if any(mass_matrix.has(s) for s in xdi):
+            raise ValueError('The equations of motion must be linear in the '
+                             'state derivatives.')
+        forcing = -msubs(eom, dict([(s, 0) for s in xdi]))
+
+        n = self.num_states
+
+        args = xi + ui + p
+
+        def eval_args(x_values, r_values):
+            x_values = np.asarray(x_values, dtype=float).reshape((n, -1))
+            num_points = x_values.shape[1]
+            if len(u) > 0:
+                r_values = np.asarray(r_values, dtype=float)
+                r_values = r_values.reshape((len(u), -1)) * np.ones(num_points)
+            else:
+                r_values = []
+            return num_points, [r for r in x_values] + [r for r in r_values]
+
+        is_diagonal = all([mass_matrix[i, j] == 0 for i in range(n)
+                           for j in range(n) if i != j])
+
+        if is_diagonal:
+
+            explicit = sm.Matrix([forcing[i] / mass_matrix[i, i]
+                                  for i in range(n)])
+
+            eval_f = ufuncify_matrix(args, explicit, const=p,
+                                     tmp_dir=self.tmp_dir,
+                                     parallel=self.parallel)
+            eval_dfdx = ufuncify_matrix(args, explicit.jacobian(xi), const=p,
+                                        tmp_dir=self.tmp_dir,
+                                        parallel=self.parallel)
+
+            def rhs(x_values, r_values, p_values):
+                num_points, vals = eval_args(x_values, r_values)
+                result = np.empty((num_points, n))
+                xdot = eval_f(result, *(vals + list(p_values)))[:, :, 0].T
+                return xdot if np.ndim(x_values) == 2 else xdot[:, 0]
+
+            def rhs_jacobian(x_values, r_values, p_values):
+                num_points, vals = eval_args(x_values, r_values)
+                result = np.empty((num_points, n * n))
+                jac = eval_dfdx(result, *(vals + list(p_values)))
+                return jac if np.ndim(x_values) == 2 else jac[0]
+
+        else:
+
+            eval_mass = ufuncify_matrix(args, mass_matrix, const=p,
+                                        tmp_dir=self.tmp_dir,
+                                        parallel=self.parallel)
+            eval_forcing = ufuncify_matrix(args, forcing, const=p,
+                                           tmp_dir=self.tmp_dir,
+                                           parallel=self.parallel)
+            # The derivatives of the implicit equations of motion with
+            # respect to the states depend on the state derivatives.
+            eval_dgdx = ufuncify_matrix(args + xdi, eom.jacobian(xi),
+                                        const=p, tmp_dir=self.tmp_dir,
+                                        parallel=self.parallel)
+
+            def solve_xdot(num_points, vals, p_values):
+                mass = eval_mass(np.empty((num_points, n * n)),
+                                 *(vals + list(p_values)))
+                force = eval_forcing(np.empty((num_points, n)),
+                                     *(vals + list(p_values)))
+                return mass, np.linalg.solve(mass, force)[:, :, 0]
+
+            def rhs(x_values, r_values, p_values):
+                num_points, vals = eval_args(x_values, r_values)
+                mass, xdot = solve_xdot(num_points, vals, p_values)
+                return xdot.T if np.ndim(x_values) == 2 else xdot[0]
+
+            def rhs_jacobian(x_values, r_values, p_values):
+                num_points, vals = eval_args(x_values, r_values)
+                mass, xdot = solve_xdot(num_points, vals, p_values)
+                dgdx = eval_dgdx(np.empty((num_points, n * n)),
+                                 *(vals + list(p_values) + list(xdot.T)))
+                jac = -np.linalg.solve(mass, dgdx)
+                return jac if np.ndim(x_values) == 2 else jac[0]
+
+        return rhs, rhs_jacobian
+
+
+class MultiExperimentCollocator(object):
+    """This class generates the constraint function and the sparse Jacobian
+    of the constraint function for a set of experiments (trials) of the same
+    system which share the unknown parameters. Each trial has its own state
+    and unknown input trajectories, known trajectories, number of
+    collocation nodes, and instance constraints. The constraint and
+    Jacobian functions are compiled once and evaluated for every trial.
+
+    Notes
+    -----
+    The free optimization vector is ordered as::
+
+        [trial 1 states, trial 1 unknown input trajectories, ...,
+         trial T states, trial T unknown input trajectories,
+         unknown parameters]
+
+    and the constraints are the constraints of each trial in order. The
+    constraint Jacobian is block diagonal with additional columns for the
+    shared unknown parameters.
+
+    """
+
+    def __init__(self, equations_of_motion, state_symbols, trials,
+                 known_parameter_map={}, time_symbol=None, tmp_dir=None,
+                 integration_method='backward euler', parallel=False,
+                 memmap_dir=None, cache_dir=None, max_workers=None,
+                 split_size=None, num_threads=None, schedule=None):
+        """Instantiates a MultiExperimentCollocator object.
+
+        Parameters
+        ==========
+        equations_of_motion : sympy.Matrix, shape(n, 1), or tuple
+            A column matrix of SymPy expressions defining the right hand
+            side of the equations of motion when the left hand side is zero
+            or a tuple of their mass matrix and forcing vector, see
+            ConstraintCollocator.
+        state_symbols : iterable
+            An iterable containing all of the SymPy functions of time which
+            represent the states in the equations of motion.
+        trials : sequence of dictionaries
+            One dictionary per trial with the ``num_collocation_nodes`` and
+            ``node_time_interval`` and optionally the
+            ``known_trajectory_map`` and ``instance_constraints`` of that
+            trial, as described in ``ConstraintCollocator``. All trials must
+            supply the same known trajectories.
+        known_parameter_map : dictionary, optional
+            A dictionary that maps the SymPy symbols representing the known
+            constant parameters to floats. Any parameters in the equations
+            of motion not provided in this dictionary will become free
+            optimization variables shared by all trials.
+        time_symbol : SymPy Symbol, optional
+            The symbol representating time in the equations of motion.
+        tmp_dir : string, optional
+            A path to a directory to store the generated code in.
+        integration_method : string, optional
+            The integration method to use, either `backward euler` or
+            `midpoint`.
+        parallel : boolean or string, optional
+            If true and openmp is installed, the compiled functions will be
+            executed across multiple threads. If ``'auto'``, the number of
+            threads and the schedule are tuned, see
+            ``ConstraintCollocator``.
+        memmap_dir : string, optional
+            A path to a directory in which the known trajectories, the
+            Jacobian indices, and the last solution and multipliers are
+            stored as memory mapped files, see ``ConstraintCollocator``.
+            Each trial's known trajectories are stored in a sub-directory.
+        cache_dir : string, optional
+            A path to a directory in which the compiled functions are
+            cached, see ``ConstraintCollocator``.
+        max_workers : integer, optional
+            The number of processes used to differentiate the equations of
+            motion and print them to C code, see ``ConstraintCollocator``.
+        split_size : integer, optional
+            The maximum number of assignments in each generated C function,
+            see ``ConstraintCollocator``.
+        num_threads : integer, optional
+            The number of threads of the parallel compiled functions.
+        schedule : string, optional
+            The OpenMP schedule of the parallel compiled functions, see
+            ``ConstraintCollocator``.
+
+        """
+        import os
+
+        if len(trials) == 0:
+            raise ValueError('At least one trial must be given.')
+
+        self.trial_collocators = []
+
+        self.memmap_dir = memmap_dir
+
+        for i, trial in enumerate(trials):
+            trial = dict(trial)
+            traj_map = trial.pop('known_trajectory_map', {})
+            if self.trial_collocators:
+                # Order the known trajectories as in the first trial so that
+                # the compiled functions' arguments match.
+                first = self.trial_collocators[0]
+                if set(traj_map.keys()) != set(first.known_input_trajectories):
+                    msg = 'All trials must have the same known trajectories.'
+                    raise ValueError(msg)
+                traj_map = OrderedDict([(k, traj_map[k]) for k in
+                                        first.known_input_trajectories])
+            if memmap_dir is None:
+                trial_dir = None
+            else:
+                trial_dir = os.path.join(memmap_dir, 'trial_{}'.format(i))
+            collocator = ConstraintCollocator(
+                equations_of_motion, state_symbols,
+                known_parameter_map=known_parameter_map,
+                known_trajectory_map=traj_map, time_symbol=time_symbol,
+                tmp_dir=tmp_dir, integration_method=integration_method,
+                parallel=parallel, memmap_dir=trial_dir,
+                cache_dir=cache_dir, max_workers=max_workers,
+                split_size=split_size, num_threads=num_threads,
+                schedule=schedule, **trial)
+            self.trial_collocators.append(collocator)
+
+        self._set_trial_offsets()
+
+    def _set_trial_offsets(self):
+        """Instantiates the attributes shared by the trial collocators and
+        the offsets of each trial in the free and constraint vectors."""
+
+        first = self.trial_collocators[0]
+
+        self.num_trials = len(self.trial_collocators)
+        self.state_symbols = first.state_symbols
+        self.num_states = first.num_states
+        self.known_parameter_map = first.known_parameter_map
+        self.parameters = first.parameters
+        self.unknown_parameters = first.unknown_parameters
+        self.num_unknown_parameters = first.num_unknown_parameters
+        self.input_trajectories = first.input_trajectories
+        self.unknown_input_trajectories = first.unknown_input_trajectories
+        self.num_unknown_input_trajectories = \
+            first.num_unknown_input_trajectories
+        self.integration_method = first.integration_method
+
+        # The start index of each trial's trajectories in the free vector and
+        # of each trial's constraints in the constraint vector.
+        self.trial_free_offsets = []
+        self.trial_constraint_offsets = []
+
+        num_trajectory_values = 0
+        num_constraints = 0
+        for collocator in self.trial_collocators:
+            self.trial_free_offsets.append(num_trajectory_values)
+            self.trial_constraint_offsets.append(num_constraints)
+            num_trajectory_values += (collocator.num_free -
+                                      self.num_unknown_parameters)
+            num_constraints += collocator.num_constraints
+
+        self.num_free = num_trajectory_values + self.num_unknown_parameters
+        self.num_constraints = num_constraints
+
+        # Path constraints are not supported for multiple trials.
+        self.path_constraints = None
+        self.num_path_constraints = 0
+
+    def _trial_free_slice(self, i):
+        start = self.trial_free_offsets[i]
+        collocator = self.trial_collocators[i]
+        return slice(start, start + collocator.num_free -
+                     self.num_unknown_parameters)
+
+    def trial_free(self, free, i):
+        """Returns the free vector of the ith trial, i.e. the trial's state
+        and unknown input trajectories followed by the unknown parameters,
+        as used by that trial's ConstraintCollocator.
+
+        Parameters
+        ----------
+        free : ndarray, shape(num_free,)
+            The free optimization vector of all trials.
+        i : integer
+            The index of the trial.
+
+        Returns
+        -------
+        trial_free : ndarray
+            The free vector of the trial.
+
+        """
+        parameters = free[self.num_free - self.num_unknown_parameters:]
+        return np.hstack((free[self._trial_free_slice(i)], parameters))
+
+    def jacobian_indices(self):
+        """Returns the row and column indices for the non-zero values in the
+        constraint Jacobian.
+
+        Returns
+        -------
+        jac_row_idxs : ndarray
+            The row indices for the non-zero values in the Jacobian.
+        jac_col_idxs : ndarray
+            The column indices for the non-zero values in the Jacobian.
+
+        """
+
+        num_trajectory_values = self.num_free - self.num_unknown_parameters
+
+        rows = []
+        cols = []
+
+        for i, collocator in enumerate(self.trial_collocators):
+            trial_rows, trial_cols = collocator.jacobian_indices()
+            num_trial_values = (collocator.num_free -
+                                self.num_unknown_parameters)
+            is_parameter = trial_cols >= num_trial_values
+            # Shift the trajectory columns to the trial's block and the
+            # parameter columns to the shared parameters.
+            trial_cols = np.where(is_parameter,
+                                  trial_cols - num_trial_values +
+                                  num_trajectory_values,
+                                  trial_cols + self.trial_free_offsets[i])
+            rows.append(trial_rows + self.trial_constraint_offsets[i])
+            cols.append(trial_cols)
+
+        return np.hstack(rows), np.hstack(cols)
+
+    def _wrap_trial_funcs(self, funcs, num_values):
+        """Returns a function that evaluates the trial functions given the
+        free vector of all trials and stacks the results."""
+
+        def stacked(free):
+            result = np.empty(sum(num_values))
+            start = 0
+            for i, (func, num) in enumerate(zip(funcs, num_values)):
+                result[start:start + num] = func(self.trial_free(free, i))
+                start += num
+            return result
+
+        return stacked
+
+    def generate_constraint_function(self):
+        """Returns a function which evaluates the constraints of all trials
+        given the array of free optimization variables."""
+
+        first = self.trial_collocators[0]
+        first._gen_multi_arg_con_func()
+
+        # The other trials evaluate the first trial's compiled function.
+        for c in self.trial_collocators[1:]:
+            c._kernel_options = first._kernel_options
+            c._kernel_kwargs = first._kernel_kwargs
+            c._con_kernel = first._con_kernel
+            c._con_func_from_kernel(c._con_kernel)
+
+        return self._trial_constraint_function()
+
+    def _trial_constraint_function(self):
+        funcs = [c._wrap_constraint_funcs(c._multi_arg_con_func, 'con')
+                 for c in self.trial_collocators]
+        num_values = [c.num_constraints for c in self.trial_collocators]
+
+        return self._wrap_trial_funcs(funcs, num_values)
+
+    def generate_jacobian_function(self):
+        """Returns a function which evaluates the non-zero values of the
+        Jacobian of the constraints of all trials given the array of free
+        optimization variables."""
+
+        first = self.trial_collocators[0]
+        first._gen_multi_arg_con_jac_func()
+
+        for c in self.trial_collocators[1:]:
+            c._kernel_options = first._kernel_options
+            c._kernel_kwargs = first._kernel_kwargs
+            c._con_jac_kernel = first._con_jac_kernel
+            c._con_jac_kernel_size = first._con_jac_kernel_size
+            c._jac_func_from_kernel()
+
+        return self._trial_jacobian_function()
+
+    def _trial_jacobian_function(self):
+        funcs = [c._wrap_constraint_funcs(c._multi_arg_con_jac_func, 'jac')
+                 for c in self.trial_collocators]
+        num_values = [len(c.jacobian_indices()[0])
+                      for c in self.trial_collocators]
+
+        return self._wrap_trial_funcs(funcs, num_values)
+
+    def _saved_data(self):
+        """Returns a dictionary of metadata and a dictionary of arrays that
+        hold each trial's collocator, see ConstraintCollocator._saved_data().
+        The arrays of the ith trial are prefixed with ``trial_<i>_``."""
+
+        metas = []
+        arrays = {}
+
+        for i, collocator in enumerate(self.trial_collocators):
+            meta, trial_arrays = collocator._saved_data()
+            metas.append(meta)
+            for k, v in trial_arrays.items():
+                arrays['trial_{}_{}'.format(i, k)] = v
+
+        return {'trials': metas}, arrays
+
+    @classmethod
+    def _from_saved(cls, meta, arrays):
+        """Returns a collocator restored from the output of _saved_data()
+        without importing SymPy or compiling, see
+        ConstraintCollocator._from_saved()."""
+
+        self = cls.__new__(cls)
+
+        self.memmap_dir = None
+        self.trial_collocators = []
+
+        for i, trial_meta in enumerate(meta['trials']):
+            prefix = 'trial_{}_'.format(i)
+            trial_arrays = dict([(k[len(prefix):], v) for k, v in
+                                 arrays.items() if k.startswith(prefix)])
+            self.trial_collocators.append(
+                ConstraintCollocator._from_saved(trial_meta, trial_arrays))
+
+        self._set_trial_offsets()
+
+        return self
+
+    def _saved_functions(self):
+        """Returns the constraint and Jacobian functions of a collocator
+        restored by _from_saved()."""
+        return (self._trial_constraint_function(),
+                self._trial_jacobian_function())
+
+    def generate_ode_functions(self):
+        """Returns compiled functions that evaluate the first order form of
+        the equations of motion and its Jacobian with respect to the
+        states, see ConstraintCollocator.generate_ode_functions()."""
+        return self.trial_collocators[0].generate_ode_functions()
+
+
+class MultiExperimentProblem(Problem):
+    """This class allows the user to instantiate a parameter identification
+    problem from several experiments (trials) of the same system which share
+    the unknown parameters, see MultiExperimentCollocator for the layout of
+    the free vector.
+
+    The methods of Problem apply to all of the trials, with these
+    differences: ``warm_start_from()`` requires another multiple experiment
+    problem with the same number of trials and interpolates each trial from
+    the same trial of the other problem, ``generate_initial_guess()`` takes
+    the initial state and the unknown input trajectories of each trial, and
+    the plotting methods plot one trial at a time. Path constraints are not
+    supported.
+
+    """
+
+    def __init__(self, obj, obj_grad, equations_of_motion, state_symbols,
+                 trials, bounds=None, scaling=None, constraint_scaling=None,
+                 objective_scaling=None, recorder=None, checkpoint_path=None,
+                 checkpoint_interval=10, obj_hess=None, obj_hess_indices=None,
+                 **kwargs):
+        """
+
+        Parameters
+        ==========
+        obj : function
+            Returns the value of the objective function given the free vector.
+        obj_grad : function
+            Returns the gradient of the objective function given the free
+            vector.
+        equations_of_motion : sympy.Matrix, shape(n, 1), or tuple
+            A column matrix of SymPy expressions defining the right hand
+            side of the equations of motion when the left hand side is zero
+            or a tuple of their mass matrix and forcing vector, see
+            ConstraintCollocator.
+        state_symbols : iterable
+            An iterable containing all of the SymPy functions of time which
+            represent the states in the equations of motion.
+        trials : sequence of dictionaries
+            One dictionary per trial, see MultiExperimentCollocator.
+        bounds : dictionary, optional
+            This dictionary should contain a mapping from any of the
+            symbolic states, unknown trajectories, or unknown parameters to
+            a 2-tuple of floats, the first being the lower bound and the
+            second the upper bound for that free variable in all trials.
+        scaling : dictionary or string, optional
+            The nominal magnitudes of the free variables in all trials, see
+            Problem.
+        constraint_scaling : sequence of floats, shape(n,), optional
+            The nominal magnitudes of the residuals of each of the equations
+            of motion in all trials, see Problem.
+        objective_scaling : float, optional
+            The nominal magnitude of the objective function.
+        recorder : IterateRecorder, optional
+            Streams the iterations and results of each solve to a file.
+        checkpoint_path : string, optional
+            The file that the current iterate of a solve is written to, see
+            Problem.
+        checkpoint_interval : integer, optional
+            The number of iterations between checkpoints, 10 by default.
+        obj_hess : function, optional
+            Returns the non-zero values of the Hessian of the objective
+            function given the free vector, see Problem.
+        obj_hess_indices : 2-tuple of integer ndarrays, optional
+            The row and column indices of the values returned by
+            ``obj_hess``, see Problem.
+        **kwargs
+            Any other keyword arguments to MultiExperimentCollocator.
+
+        """
+
+        self.recorder = recorder
+        self.checkpoint_path = checkpoint_path
+        self.checkpoint_interval = checkpoint_interval
+        self.bounds = bounds
+        self.path_constraint_bounds = None
+        self.scaling = scaling
+        self.constraint_scaling = constraint_scaling
+        self.objective_scaling = objective_scaling
+
+        self.collocator = MultiExperimentCollocator(equations_of_motion,
+                                                    state_symbols, trials,
+                                                    **kwargs)
+
+        self._init_nlp(obj, obj_grad, obj_hess=obj_hess,
+                       obj_hess_indices=obj_hess_indices)
+
+    def _free_variable_array(self, values, default):
+        array = default * np.ones(self.num_free)
+
+        n = self.collocator.num_states
+        state_syms = self.collocator.state_symbols
+        unk_traj = self.collocator.unknown_input_trajectories
+        unk_par = self.collocator.unknown_parameters
+        par_start = self.num_free - self.collocator.num_unknown_parameters
+
+        for var, value in values.items():
+            if var in unk_par:
+                array[par_start + unk_par.index(var)] = value
+                continue
+            elif var in state_syms:
+                i = state_syms.index(var)
+            elif var in unk_traj:
+                i = n + unk_traj.index(var)
+            else:
+                continue
+            for offset, collocator in \
+                    zip(self.collocator.trial_free_offsets,
+                        self.collocator.trial_collocators):
+                N = collocator.num_collocation_nodes
+                start = offset + i * N
+                array[start:start + N] = value
+
+        return array
+
+    def _constraint_array(self, eom_values, default):
+        array = default * np.ones(self.num_constraints)
+
+        for offset, collocator in \
+                zip(self.collocator.trial_constraint_offsets,
+                    self.collocator.trial_collocators):
+            N = collocator.num_collocation_nodes
+            num_eom_constraints = collocator.num_states * (N - 1)
+            array[offset:offset + num_eom_constraints] = \
+                np.repeat(eom_values, N - 1)
+
+        return array
+
+    def warm_start_from(self, other):
+        """Stores the last solution and multipliers of another problem as
+        this problem's warm start values so that ``solve(warm_start=True)``
+        starts from them. The trajectories and the equations of motion
+        constraint multipliers of each trial are linearly interpolated onto
+        the nodes of this problem's trial, see Problem.warm_start_from().
+
+        Parameters
+        ==========
+        other : MultiExperimentProblem
+            A problem with the same number of trials, states, unknown input
+            trajectories, unknown parameters, and number of instance
+            constraints per trial which has been solved.
+
+        """
+
+        if other.last_solution is None:
+            raise ValueError('The other problem has not been solved.')
+
+        this, that = self.collocator, other.collocator
+
+        if getattr(that, 'num_trials', None) != this.num_trials:
+            msg = 'The other problem must have {} trials.'
+            raise ValueError(msg.format(this.num_trials))
+
+        r = this.num_unknown_parameters
+
+        # The trial blocks of the solution and of the lower and upper bound
+        # multipliers.
+        trajectories = ([], [], [])
+        multipliers = []
+
+        for i, (c, other_c) in enumerate(zip(this.trial_collocators,
+                                             that.trial_collocators)):
+            start = that.trial_constraint_offsets[i]
+            other_values = (that.trial_free(other.last_solution, i),
+                            other.last_constraint_multipliers[
+                                start:start + other_c.num_constraints],
+                            that.trial_free(other.last_lower_bound_multipliers,
+                                            i),
+                            that.trial_free(other.last_upper_bound_multipliers,
+                                            i))
+            solution, trial_multipliers, lower, upper = \
+                self._interpolate_warm_start(c, other_c, other_values)
+            multipliers.append(trial_multipliers)
+            for blocks, values in zip(trajectories, (solution, lower, upper)):
+                blocks.append(values[:len(values) - r])
+
+        # The shared parameters follow the trajectories of all trials.
+        for blocks, values in zip(trajectories, (solution, lower, upper)):
+            blocks.append(values[len(values) - r:])
+
+        (self.last_solution, self.last_lower_bound_multipliers,
+         self.last_upper_bound_multipliers) = [np.hstack(blocks) for blocks
+                                               in trajectories]
+        self.last_constraint_multipliers = np.hstack(multipliers)
+
+    def generate_initial_guess(self, initial_state,
+                               unknown_trajectory_map=None,
+                               unknown_parameter_map=None, tolerance=1e-10,
+                               max_iterations=20):
+        """Returns a dynamically consistent initial guess of the free vector
+        by solving the discretized equations of motion of each trial forward
+        in time from its initial state, see
+        Problem.generate_initial_guess().
+
+        Parameters
+        ==========
+        initial_state : array_like, shape(n,) or shape(T, n)
+            The states at the first node ordered as the state symbols,
+            either for all T trials or for each trial.
+        unknown_trajectory_map : dictionary, optional
+            A mapping from any of the unknown input trajectories to a
+            sequence of T ndarrays, the ith of shape(N_i,) for the N_i nodes
+            of the ith trial. The unknown input trajectories not given are
+            zero.
+        unknown_parameter_map : dictionary, optional
+            A mapping from each of the unknown parameters to a float. This
+            is required if there are unknown parameters.
+        tolerance : float, optional
+            The Newton iterations at a node stop when the absolute values of
+            the constraints at that node are less than this.
+        max_iterations : integer, optional
+            The maximum number of Newton iterations per node. A warning is
+            issued if the iterations do not converge at any node.
+
+        Returns
+        =======
+        initial_guess : ndarray, shape(num_free,)
+            The trajectories of each trial and the unknown parameters in
+            the layout of MultiExperimentCollocator.
+
+        """
+
+        c = self.collocator
+        n = c.num_states
+        r = c.num_unknown_parameters
+
+        initial_states = np.asarray(initial_state, dtype=float)
+        if initial_states.shape == (n,):
+            initial_states = np.tile(initial_states, (c.num_trials, 1))
+        elif initial_states.shape != (c.num_trials, n):
+            msg = 'The initial state must be shape({0},) or shape({1}, {0}).'
+            raise ValueError(msg.format(n, c.num_trials))
+
+        if unknown_trajectory_map is None:
+            unknown_trajectory_map = {}
+
+        blocks = []
+        unconverged = []
+
+        for i, trial_collocator in enumerate(c.trial_collocators):
+            trajectory_map = dict([(k, v[i]) for k, v in
+                                   unknown_trajectory_map.items()])
+            free, trial_unconverged = self._initial_guess(
+                trial_collocator, initial_states[i], trajectory_map,
+                unknown_parameter_map, tolerance, max_iterations)
+            blocks.append(free[:len(free) - r])
+            if trial_unconverged:
+                unconverged.append((i, trial_unconverged))
+
+        blocks.append(free[len(free) - r:])
+
+        if unconverged:
+            msg = ('The Newton iterations did not converge at the nodes {} '
+                   'of the trials.'.format(dict(unconverged)))
+            warnings.warn(msg)
+
+        return np.hstack(blocks)
+
+    @_optional_plt_dep
+    def plot_trajectories(self, vector, axes=None, trial=0):
+        """Returns the axes for two plots of a trial. The first plot
+        displays the state trajectories versus time and the second plot
+        displays the input trajectories versus time.
+
+        Parameters
+        ==========
+        vector : ndarray, shape(num_free,)
+            The initial guess, solution, or any other vector that is in the
+            layout of MultiExperimentCollocator.
+        axes : ndarray of AxesSubplot, shape(n + m, )
+            An array of matplotlib axes to plot to.
+        trial : integer, optional
+            The index of the trial to plot.
+
+        Returns
+        =======
+        axes : ndarray of AxesSubplot
+            A matplotlib axes with the state and input trajectories plotted.
+
+        """
+        c = self.collocator
+        return self._plot_trajectories(c.trial_collocators[trial],
+                                       c.trial_free(vector, trial), axes)
+
+    @_optional_plt_dep
+    def plot_constraint_violations(self, vector, trial=0):
+        """Returns an axis with the state constraint violations of a trial
+        plotted versus node number and its instance constraints as a bar
+        graph.
+
+        Parameters
+        ==========
+        vector : ndarray, shape(num_free,)
+            The initial guess, solution, or any other vector that is in the
+            layout of MultiExperimentCollocator.
+        trial : integer, optional
+            The index of the trial to plot.
+
+        Returns
+        =======
+        axes : ndarray of AxesSubplot
+            A matplotlib axes with the constraint violations plotted.
+
+        """
+        c = self.collocator
+        trial_collocator = c.trial_collocators[trial]
+        start = c.trial_constraint_offsets[trial]
+        con_violations = self.con(vector)[start:start +
+                                          trial_collocator.num_constraints]
+        return self._plot_constraint_violations(trial_collocator,
+                                                con_violations)
+
+    @staticmethod
+    def _collocator_from_saved(meta, arrays):
+        return MultiExperimentCollocator._from_saved(meta, arrays)
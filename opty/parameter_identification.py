@@ -3,7 +3,7 @@
 import numpy as np
 from scipy.interpolate import interp1d
 
-from .utils import parse_free
+from .utils import parse_free, _memmap_array
 
 
 def output_equations(x):
@@ -150,6 +150,330 @@ def objective_function_gradient(free, num_dis_points, num_states,
     return dobj_dfree
 
 
+class ParameterIdentificationObjective(object):
+    """This class evaluates the same cost and gradient as
+    objective_function() and objective_function_gradient() but the
+    measurements are interpolated at the discretization time points and the
+    indices of the outputs in the free vector are computed only once, when
+    the object is instantiated. The gradient is written into a reusable
+    array, so the evaluations do not allocate new arrays. Pass the
+    objective() and gradient() methods to Problem."""
+
+    def __init__(self, num_dis_points, num_states, dis_period, time_measured,
+                 y_measured, output_indices=None, free_offset=0,
+                 memmap_dir=None):
+        """Instantiates a ParameterIdentificationObjective object.
+
+        Parameters
+        ----------
+        num_dis_points : integer
+            The number of model discretization points.
+        num_states : integer
+            The number of system states.
+        dis_period : float
+            The discretization time interval.
+        time_measured : ndarray, shape(M,)
+            The times at which the measurements were sampled.
+        y_measured : ndarray, shape(M, o)
+            The measured trajectories of the o output variables at each
+            sampled time instance.
+        output_indices : sequence of integers, shape(o,), optional
+            The indices of the trajectories in the free vector, i.e. the
+            states followed by any unknown input trajectories, that are
+            measured and ordered as the columns of y_measured. If None, the
+            outputs are the first n / 2 states, as in output_equations().
+        free_offset : integer, optional
+            The index of the first state value in the free vector, e.g. the
+            start of a trial's block in a MultiExperimentProblem's free
+            vector.
+        memmap_dir : string, optional
+            A path to a directory in which the interpolated measurements and
+            their indices in the free vector are stored as memory mapped
+            ``.npy`` files instead of in memory.
+
+        """
+        N, n = num_dis_points, num_states
+
+        self.num_dis_points = N
+        self.num_states = n
+        self.dis_period = dis_period
+
+        y_measured = np.asarray(y_measured)
+        if len(y_measured.shape) == 1:
+            y_measured = y_measured.reshape((len(y_measured), 1))
+
+        if output_indices is None:
+            output_indices = range(n // 2)
+        self.output_indices = tuple(output_indices)
+
+        if len(self.output_indices) != y_measured.shape[1]:
+            msg = 'There are {} output indices and {} measured outputs.'
+            raise ValueError(msg.format(len(self.output_indices),
+                                        y_measured.shape[1]))
+
+        duration = (N - 1) * dis_period
+        model_time = np.linspace(0.0, duration, num=N)
+
+        func = interp1d(time_measured, y_measured, axis=0)
+
+        # shape(o * N,) ordered as the outputs are in the free vector
+        self._y_interpolated = np.ascontiguousarray(func(model_time).T).ravel()
+
+        # The indices of the outputs in the free vector.
+        self._free_indices = np.hstack([free_offset + i * N + np.arange(N)
+                                        for i in self.output_indices])
+
+        self._residual = np.empty_like(self._y_interpolated)
+
+        # The residuals are the outputs less the measurements, so the
+        # Hessian is constant and only has values on its diagonal.
+        self._hessian = 2.0 * dis_period * np.ones_like(self._y_interpolated)
+
+        if memmap_dir is not None:
+            self._y_interpolated = _memmap_array(self._y_interpolated,
+                                                 memmap_dir, 'y_interpolated')
+            self._free_indices = _memmap_array(self._free_indices,
+                                               memmap_dir, 'free_indices')
+
+        self._gradient = None
+
+    def _eval_residual(self, free):
+        np.take(free, self._free_indices, out=self._residual)
+        np.subtract(self._residual, self._y_interpolated, out=self._residual)
+        return self._residual
+
+    def objective(self, free):
+        """Returns the norm of the difference in the measured and simulated
+        output.
+
+        Parameters
+        ----------
+        free : ndarray, shape(n * N + q,)
+            The flattened state array with n states at N time points and
+            the q free model constants.
+
+        Returns
+        -------
+        cost : float
+            The cost value.
+
+        """
+        residual = self._eval_residual(free)
+        return self.dis_period * np.dot(residual, residual)
+
+    def gradient(self, free):
+        """Returns the gradient of the objective function with respect to
+        the free parameters.
+
+        Parameters
+        ----------
+        free : ndarray, shape(n * N + q,)
+            The flattened state array with n states at N time points and
+            the q free model constants.
+
+        Returns
+        -------
+        gradient : ndarray, shape(n * N + q,)
+            The gradient of the cost function with respect to the free
+            parameters. This array is reused and overwritten on the next
+            call.
+
+        """
+        if self._gradient is None or self._gradient.shape != free.shape:
+            # All entries but the outputs are always zero.
+            self._gradient = np.zeros_like(free)
+
+        residual = self._eval_residual(free)
+        np.multiply(residual, 2.0 * self.dis_period, out=residual)
+        self._gradient.put(self._free_indices, residual)
+
+        return self._gradient
+
+    def hessian_indices(self):
+        """Returns the row and column indices of the non-zero values of the
+        Hessian of the objective function, which are on its diagonal.
+
+        Returns
+        -------
+        rows : ndarray, shape(o * N,)
+            The row indices.
+        cols : ndarray, shape(o * N,)
+            The column indices.
+
+        """
+        return (np.asarray(self._free_indices),
+                np.asarray(self._free_indices))
+
+    def hessian(self, free):
+        """Returns the non-zero values of the Hessian of the objective
+        function with respect to the free parameters. The Hessian does not
+        depend on the free parameters. Pass this method and
+        hessian_indices() to Problem as ``obj_hess`` and
+        ``obj_hess_indices``.
+
+        Parameters
+        ----------
+        free : ndarray, shape(n * N + q,)
+            The flattened state array with n states at N time points and
+            the q free model constants.
+
+        Returns
+        -------
+        hessian : ndarray, shape(o * N,)
+            The values of the Hessian at the indices returned by
+            hessian_indices().
+
+        """
+        return self._hessian
+
+
+class LeastSquaresObjective(object):
+    """This class evaluates an objective function that is a weighted sum of
+    squared residuals, ``weight * r(free)^T r(free)``, and its gradient
+    given a function that evaluates the residuals, e.g. the differences in
+    the simulated outputs and the measurements, and one that evaluates the
+    non-zero values of their sparse Jacobian with respect to the free
+    vector. It also evaluates the Gauss-Newton approximation of the
+    Hessian of the objective, ``2 * weight * J^T J``, which only needs the
+    first derivatives of the residuals. Pass the objective(), gradient(),
+    and hessian() methods and hessian_indices() to Problem as ``obj``,
+    ``obj_grad``, ``obj_hess``, and ``obj_hess_indices``."""
+
+    def __init__(self, residual, residual_jacobian, jacobian_indices,
+                 weight=1.0):
+        """Instantiates a LeastSquaresObjective object.
+
+        Parameters
+        ----------
+        residual : function
+            Returns the residuals, shape(m,), given the free vector.
+        residual_jacobian : function
+            Returns the non-zero values of the Jacobian of the residuals
+            with respect to the free vector, ordered as
+            ``jacobian_indices``, given the free vector.
+        jacobian_indices : 2-tuple of integer ndarrays
+            The row (residual) and column (free vector) indices of the
+            values returned by ``residual_jacobian``. Repeated indices are
+            summed.
+        weight : float, optional
+            The weight of the sum of squared residuals, e.g. the
+            discretization time interval.
+
+        """
+        self.residual = residual
+        self.residual_jacobian = residual_jacobian
+        self.weight = weight
+
+        rows, cols = [np.asarray(i, dtype=int) for i in jacobian_indices]
+
+        if rows.shape != cols.shape:
+            msg = 'There are {} row indices and {} column indices.'
+            raise ValueError(msg.format(len(rows), len(cols)))
+
+        self._jac_rows = rows
+        self._jac_cols = cols
+
+        # Each value in the lower triangle of J^T J is the sum of the
+        # products of the pairs of Jacobian values in the same row whose
+        # columns are the row and column of the Hessian value. The pairs and
+        # the Hessian value they are summed into are found once here.
+        order = np.argsort(rows, kind='mergesort')
+        first, second = [], []
+        for idxs in np.split(order, np.nonzero(np.diff(rows[order]))[0] + 1):
+            a, b = np.meshgrid(idxs, idxs, indexing='ij')
+            lower = cols[a] >= cols[b]
+            first.append(a[lower])
+            second.append(b[lower])
+
+        self._first = np.hstack(first)
+        self._second = np.hstack(second)
+
+        # The (row, column) pairs of the Hessian values are found as unique
+        # linear indices, as np.unique() only supports an axis since NumPy
+        # 1.13.
+        num_cols = cols.max() + 1 if len(cols) > 0 else 1
+        linear, self._hessian_positions = np.unique(
+            cols[self._first].astype(np.int64) * num_cols +
+            cols[self._second], return_inverse=True)
+        self._hessian_rows = linear // num_cols
+        self._hessian_cols = linear % num_cols
+
+    def objective(self, free):
+        """Returns the weighted sum of the squared residuals.
+
+        Parameters
+        ----------
+        free : ndarray, shape(n * N + q,)
+            The free optimization variables.
+
+        Returns
+        -------
+        cost : float
+            The cost value.
+
+        """
+        residual = self.residual(free)
+        return self.weight * np.dot(residual, residual)
+
+    def gradient(self, free):
+        """Returns the gradient of the objective function with respect to
+        the free optimization variables, ``2 * weight * J^T r``.
+
+        Parameters
+        ----------
+        free : ndarray, shape(n * N + q,)
+            The free optimization variables.
+
+        Returns
+        -------
+        gradient : ndarray, shape(n * N + q,)
+            The gradient of the cost function.
+
+        """
+        residual = self.residual(free)
+        jac_vals = self.residual_jacobian(free)
+        return 2.0 * self.weight * np.bincount(
+            self._jac_cols, weights=jac_vals * residual[self._jac_rows],
+            minlength=len(free))
+
+    def hessian_indices(self):
+        """Returns the row and column indices of the non-zero values in
+        the lower triangle of the Gauss-Newton approximation of the Hessian.
+
+        Returns
+        -------
+        rows : ndarray, shape(k,)
+            The row indices.
+        cols : ndarray, shape(k,)
+            The column indices.
+
+        """
+        return self._hessian_rows, self._hessian_cols
+
+    def hessian(self, free):
+        """Returns the non-zero values in the lower triangle of the
+        Gauss-Newton approximation of the Hessian of the objective function,
+        ``2 * weight * J^T J``.
+
+        Parameters
+        ----------
+        free : ndarray, shape(n * N + q,)
+            The free optimization variables.
+
+        Returns
+        -------
+        hessian : ndarray, shape(k,)
+            The values of the Hessian at the indices returned by
+            hessian_indices().
+
+        """
+        jac_vals = self.residual_jacobian(free)
+        return 2.0 * self.weight * np.bincount(
+            self._hessian_positions,
+            weights=jac_vals[self._first] * jac_vals[self._second],
+            minlength=len(self._hessian_rows))
+
+
 def wrap_objective(obj_func, *args):
     def wrapped_func(free):
         return obj_func(free, *args)
@@ -0,0 +1,225 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+from timeit import default_timer
+
+import numpy as np
+
+from .direct_collocation import Problem
+from .utils import shift_free
+
+__all__ = ['RecedingHorizonController']
+
+
+class RecedingHorizonController(object):
+    """This class repeatedly solves a direct collocation optimal control
+    problem over a fixed length horizon that recedes in time, i.e. model
+    predictive control. The problem is built and compiled once. Each step
+    only updates the measured initial state and the known trajectories and
+    re-solves the problem warm started from the previous solution shifted
+    by one node."""
+
+    def __init__(self, obj, obj_grad, equations_of_motion, state_symbols,
+                 num_collocation_nodes, node_time_interval,
+                 max_iterations=None, max_cpu_time=None, **kwargs):
+        """Instantiates a RecedingHorizonController object.
+
+        Parameters
+        ==========
+        obj : function
+            Returns the value of the objective function given the free vector.
+        obj_grad : function
+            Returns the gradient of the objective function given the free
+            vector.
+        equations_of_motion : sympy.Matrix, shape(n, 1), or tuple
+            A column matrix of SymPy expressions defining the right hand
+            side of the equations of motion when the left hand side is zero
+            or a tuple of their mass matrix and forcing vector, see
+            ConstraintCollocator.
+        state_symbols : iterable
+            An iterable containing all of the SymPy functions of time which
+            represent the states in the equations of motion.
+        num_collocation_nodes : integer
+            The number of collocation nodes, N, in the horizon.
+        node_time_interval : float
+            The time interval between collocation nodes. The horizon
+            recedes by this interval on each step.
+        max_iterations : integer, optional
+            The maximum number of IPOPT iterations per step.
+        max_cpu_time : float, optional
+            The maximum CPU time in seconds IPOPT may use per step.
+        **kwargs
+            Any other keyword arguments to ``Problem``, e.g.
+            ``known_parameter_map``, ``known_trajectory_map``,
+            ``instance_constraints``, or ``bounds``. Instance constraints
+            are added to the constraints that set the states at the first
+            node equal to the measured state.
+
+        """
+
+        import sympy as sm
+
+        self.state_symbols = tuple(state_symbols)
+        self.num_collocation_nodes = num_collocation_nodes
+
+        # The measured initial state enters the problem as known parameters
+        # of the initial state instance constraints so that it can be
+        # changed without rebuilding the problem.
+        self.initial_state_symbols = \
+            tuple([sm.Symbol(s.__class__.__name__ + '_initial', real=True)
+                   for s in self.state_symbols])
+
+        par_map = OrderedDict(kwargs.pop('known_parameter_map', {}))
+        for sym in self.initial_state_symbols:
+            par_map[sym] = 0.0
+
+        initial_constraints = tuple([s.__class__(0.0) - sym for s, sym in
+                                     zip(self.state_symbols,
+                                         self.initial_state_symbols)])
+        other_constraints = kwargs.pop('instance_constraints', None)
+        if other_constraints is not None:
+            instance_constraints = (initial_constraints +
+                                    tuple(other_constraints))
+        else:
+            instance_constraints = initial_constraints
+
+        traj_map = OrderedDict(kwargs.pop('known_trajectory_map', {}))
+
+        self.problem = Problem(obj, obj_grad, equations_of_motion,
+                               state_symbols, num_collocation_nodes,
+                               node_time_interval,
+                               known_parameter_map=par_map,
+                               known_trajectory_map=traj_map,
+                               instance_constraints=instance_constraints,
+                               **kwargs)
+
+        if max_iterations is not None:
+            self.problem.addOption('max_iter', int(max_iterations))
+        if max_cpu_time is not None:
+            self.problem.addOption('max_cpu_time', float(max_cpu_time))
+
+        self.solution = None
+        self.step_durations = []
+        self.step_iterations = []
+        self.step_statuses = []
+
+    def _shift_warm_start(self):
+        """Shifts the stored solution and multipliers of the problem by one
+        node."""
+
+        prob = self.problem
+        n = prob.collocator.num_states
+        q = prob.collocator.num_unknown_input_trajectories
+        N = self.num_collocation_nodes
+
+        prob.last_solution = shift_free(prob.last_solution, n, q, N)
+        prob.last_lower_bound_multipliers = \
+            shift_free(prob.last_lower_bound_multipliers, n, q, N)
+        prob.last_upper_bound_multipliers = \
+            shift_free(prob.last_upper_bound_multipliers, n, q, N)
+        # The path constraint multipliers, s trajectories at the N nodes,
+        # follow the equations of motion and instance constraint
+        # multipliers.
+        s = prob.collocator.num_path_constraints
+        multipliers = prob.last_constraint_multipliers
+        shifted = shift_free(multipliers[:len(multipliers) - s * N], n, 0,
+                             N - 1)
+        if s > 0:
+            shifted = np.hstack((shifted, shift_free(multipliers[-s * N:], s,
+                                                     0, N)))
+        prob.last_constraint_multipliers = shifted
+
+    def step(self, initial_state, known_trajectory_map=None,
+             initial_guess=None):
+        """Returns the solution over the horizon starting at the measured
+        state. The problem is warm started from the previous step's solution
+        shifted by one node unless an initial guess is given.
+
+        Parameters
+        ==========
+        initial_state : array_like, shape(n,)
+            The measured state at the start of the horizon ordered as
+            ``state_symbols``.
+        known_trajectory_map : dictionary, optional
+            A mapping from any of the known trajectories to new ndarrays of
+            shape(N,) over the horizon. After the first step, known
+            trajectories not given are shifted by one node, repeating the
+            last value.
+        initial_guess : ndarray, (n * N + m * M + q, ), optional
+            An initial guess for the free vector. This is required on the
+            first step.
+
+        Returns
+        =======
+        solution : ndarray, (n * N + m * M + q, )
+            The solution over the horizon in the canonical form.
+        info : dictionary
+            The IPOPT solution information.
+
+        """
+
+        start = default_timer()
+
+        collocator = self.problem.collocator
+        N = self.num_collocation_nodes
+
+        initial_state = np.asarray(initial_state, dtype=float)
+        if initial_state.shape != (len(self.state_symbols),):
+            msg = 'The initial state must be shape({},).'
+            raise ValueError(msg.format(len(self.state_symbols)))
+
+        par_map = collocator.known_parameter_map
+        for sym, val in zip(self.initial_state_symbols, initial_state):
+            par_map[sym] = val
+
+        if known_trajectory_map is None:
+            known_trajectory_map = {}
+        traj_map = collocator.known_trajectory_map
+        for k in traj_map.keys():
+            if k in known_trajectory_map:
+                v = np.asarray(known_trajectory_map[k], dtype=float)
+                if v.shape != (N,):
+                    msg = 'The known trajectory {} is not length {}'
+                    raise ValueError(msg.format(k, N))
+                traj_map[k] = v
+            elif self.step_durations:
+                traj_map[k] = np.hstack((traj_map[k][1:], traj_map[k][-1:]))
+
+        # Only keep the objective values of this step.
+        del self.problem.obj_value[:]
+
+        if initial_guess is not None:
+            solution, info = self.problem.solve(initial_guess)
+        elif self.problem.last_solution is None:
+            raise ValueError('An initial guess is required on the first step.')
+        else:
+            self._shift_warm_start()
+            solution, info = self.problem.solve(warm_start=True)
+
+        self.solution = solution
+
+        self.step_durations.append(default_timer() - start)
+        # The intermediate callback is also called for iteration 0.
+        self.step_iterations.append(len(self.problem.obj_value) - 1)
+        self.step_statuses.append(info['status'])
+
+        return solution, info
+
+    def timing_statistics(self):
+        """Returns a dictionary with the number of steps taken and the
+        mean, minimum, and maximum step duration in seconds and IPOPT
+        iterations per step."""
+
+        durations = np.array(self.step_durations)
+        iterations = np.array(self.step_iterations)
+
+        if len(durations) == 0:
+            raise ValueError('step() must be run first.')
+
+        return {'num_steps': len(durations),
+                'mean_duration': durations.mean(),
+                'min_duration': durations.min(),
+                'max_duration': durations.max(),
+                'mean_iterations': iterations.mean(),
+                'min_iterations': iterations.min(),
+                'max_iterations': iterations.max()}
@@ -0,0 +1,260 @@
+#!/usr/bin/env python
+
+import os
+from collections import OrderedDict
+from timeit import default_timer
+
+import numpy as np
+
+__all__ = ['IterateRecorder', 'load_recording']
+
+# The statistics that IPOPT passes to the intermediate callback, in order.
+ITERATION_STATISTICS = ('alg_mod', 'iteration', 'objective', 'inf_pr',
+                        'inf_du', 'mu', 'd_norm', 'regularization_size',
+                        'alpha_du', 'alpha_pr', 'ls_trials')
+
+
+def _is_hdf5(path):
+    return os.path.splitext(path)[1].lower() in ('.h5', '.hdf5')
+
+
+def _import_h5py():
+    try:
+        import h5py
+    except ImportError:
+        raise ImportError('h5py must be installed to record to HDF5 files.')
+    return h5py
+
+
+class _NPZStore(object):
+    """Stores tables of columns in a directory with one compressed NPZ file
+    per appended chunk of rows."""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _chunk_files(self, table):
+        if not os.path.isdir(self.path):
+            return []
+        prefix = table + '_'
+        return sorted([os.path.join(self.path, f) for f in
+                       os.listdir(self.path) if f.startswith(prefix) and
+                       f.endswith('.npz')])
+
+    def append(self, table, columns):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path)
+        file_name = '{}_{:08d}.npz'.format(table,
+                                          len(self._chunk_files(table)))
+        # The chunk is written under a temporary name so that a reader never
+        # sees a partially written file.
+        tmp_path = os.path.join(self.path, '.' + file_name)
+        with open(tmp_path, 'wb') as f:
+            np.savez_compressed(f, **columns)
+        getattr(os, 'replace', os.rename)(tmp_path,
+                                          os.path.join(self.path, file_name))
+
+    def num_rows(self, table):
+        num = 0
+        for path in self._chunk_files(table):
+            with np.load(path) as data:
+                num += len(data['solve'])
+        return num
+
+    def read(self, table):
+        chunks = OrderedDict()
+        for path in self._chunk_files(table):
+            with np.load(path) as data:
+                for k in data.files:
+                    chunks.setdefault(k, []).append(data[k])
+        return OrderedDict([(k, np.concatenate(v)) for k, v in
+                            chunks.items()])
+
+
+class _HDF5Store(object):
+    """Stores tables of columns as groups of chunked, compressed, resizable
+    datasets in an HDF5 file. The file is only open while appending so that
+    it can be read during a solve."""
+
+    def __init__(self, path):
+        self.path = path
+        self.h5py = _import_h5py()
+
+    def append(self, table, columns):
+        with self.h5py.File(self.path, 'a') as f:
+            group = f.require_group(table)
+            for name, values in columns.items():
+                if name not in group:
+                    group.create_dataset(name, data=values,
+                                         maxshape=(None,) + values.shape[1:],
+                                         chunks=True, compression='gzip')
+                else:
+                    dataset = group[name]
+                    num = dataset.shape[0]
+                    dataset.resize(num + values.shape[0], axis=0)
+                    dataset[num:] = values
+
+    def num_rows(self, table):
+        if not os.path.exists(self.path):
+            return 0
+        with self.h5py.File(self.path, 'r') as f:
+            if table not in f:
+                return 0
+            return f[table]['solve'].shape[0]
+
+    def read(self, table):
+        with self.h5py.File(self.path, 'r') as f:
+            if table not in f:
+                return OrderedDict()
+            group = f[table]
+            return OrderedDict([(k, group[k][...]) for k in group.keys()])
+
+
+def _store(path):
+    if _is_hdf5(path):
+        return _HDF5Store(path)
+    else:
+        return _NPZStore(path)
+
+
+class IterateRecorder(object):
+    """This class streams the progress of a ``Problem``'s solves to an HDF5
+    file or a directory of compressed NPZ files while IPOPT runs. Each
+    iteration's statistics from the intermediate callback, every k-th
+    primal iterate, and the result of each solve are buffered and appended
+    in chunks. Pass it to ``Problem`` with the ``recorder`` keyword argument
+    or set ``Problem.recorder`` and use ``load_recording()`` to read the
+    store, also during a solve.
+
+    The recorded primal iterate is the last point at which IPOPT evaluated
+    the objective before the intermediate callback, i.e. the accepted trial
+    point of the line search."""
+
+    def __init__(self, path, primal_interval=1, chunk_size=100):
+        """Instantiates an IterateRecorder object.
+
+        Parameters
+        ==========
+        path : string
+            The path of the store. Paths ending in ``.h5`` or ``.hdf5`` are
+            written as HDF5 files with h5py, any other path is a directory
+            of NPZ files. An existing store is appended to.
+        primal_interval : integer, optional
+            The primal iterate is recorded every ``primal_interval``
+            iterations. If 0, no primal iterates are recorded.
+        chunk_size : integer, optional
+            The number of buffered iterations that are appended to the store
+            at once. The buffers are also written at the end of each solve.
+
+        """
+        self.path = path
+        self.primal_interval = primal_interval
+        self.chunk_size = chunk_size
+
+        self._store = _store(path)
+
+        # The index of the current solve, which continues from any solves
+        # already in the store.
+        self._solve = self._store.num_rows('results') - 1
+        self._start_time = None
+
+        self._iterates = []
+        self._primals = []
+
+    def start(self):
+        """Starts recording a new solve. Called by ``Problem.solve()``."""
+        self._solve += 1
+        self._start_time = default_timer()
+
+    def record_iteration(self, problem, statistics):
+        """Records the statistics of an iteration and, every
+        ``primal_interval`` iterations, the primal iterate. Called by
+        ``Problem.intermediate()``."""
+
+        elapsed = default_timer() - self._start_time
+        self._iterates.append((self._solve, elapsed) + tuple(statistics))
+
+        iteration = statistics[1]
+        free = problem._last_evaluated_free
+        if (self.primal_interval > 0 and free is not None and
+                iteration % self.primal_interval == 0):
+            self._primals.append((self._solve, iteration,
+                                  np.array(free, dtype=float)))
+
+        if len(self._iterates) >= self.chunk_size:
+            self.flush()
+
+    def record_result(self, problem, info):
+        """Records the result of a solve and writes the buffers. Called by
+        ``Problem.solve()``."""
+        self.flush()
+        g = np.asarray(info['g'])
+        if g.size:
+            # The constraints are only violated outside of their bounds,
+            # e.g. an inactive inequality path constraint is not.
+            violation = max(np.max(problem.con_lower_bound - g),
+                            np.max(g - problem.con_upper_bound), 0.0)
+        else:
+            violation = 0.0
+        columns = OrderedDict([
+            ('solve', np.array([self._solve])),
+            ('status', np.array([info['status']])),
+            ('objective', np.array([info['obj_val']], dtype=float)),
+            ('max_constraint_violation', np.array([violation])),
+            ('solve_time', np.array([default_timer() - self._start_time])),
+            ('solution', np.array([info['x']], dtype=float))])
+        self._store.append('results', columns)
+
+    def flush(self):
+        """Appends the buffered iterations to the store."""
+
+        if self._iterates:
+            rows = list(zip(*self._iterates))
+            columns = OrderedDict([('solve', np.array(rows[0], dtype=int)),
+                                   ('time', np.array(rows[1]))])
+            for name, values in zip(ITERATION_STATISTICS, rows[2:]):
+                columns[name] = np.array(values)
+            self._store.append('iterates', columns)
+            self._iterates = []
+
+        if self._primals:
+            solves, iterations, primals = zip(*self._primals)
+            columns = OrderedDict([('solve', np.array(solves, dtype=int)),
+                                   ('iteration', np.array(iterations,
+                                                          dtype=int)),
+                                   ('x', np.array(primals))])
+            self._store.append('primal', columns)
+            self._primals = []
+
+
+def load_recording(path):
+    """Returns the contents of a store written by an ``IterateRecorder``.
+
+    Parameters
+    ==========
+    path : string
+        The path of the HDF5 file or NPZ directory.
+
+    Returns
+    =======
+    recording : dictionary
+        A dictionary with the tables ``'iterates'``, ``'primal'``, and
+        ``'results'``, each a dictionary mapping column names to arrays of
+        equal length:
+
+        - ``iterates``: ``solve``, ``time`` (seconds since the start of the
+          solve) and the IPOPT statistics ``alg_mod``, ``iteration``,
+          ``objective``, ``inf_pr`` (constraint violation), ``inf_du``,
+          ``mu``, ``d_norm``, ``regularization_size``, ``alpha_du``,
+          ``alpha_pr`` (step sizes), and ``ls_trials`` for each iteration.
+        - ``primal``: ``solve``, ``iteration``, and ``x``, the recorded
+          primal iterates.
+        - ``results``: ``solve``, ``status``, ``objective``,
+          ``max_constraint_violation`` (the largest distance of a
+          constraint outside of its bounds), ``solve_time``, and
+          ``solution`` for each finished solve.
+
+    """
+    store = _store(path)
+    return OrderedDict([(table, store.read(table)) for table in
+                        ('iterates', 'primal', 'results')])
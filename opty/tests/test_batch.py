@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+
+import numpy as np
+import sympy as sym
+
+from ..batch import BatchSolver
+from ..direct_collocation import Problem
+
+
+# The objective must be picklable to send it to the worker processes. The
+# free vector holds x, v, and f at N nodes.
+def obj(free):
+    N = len(free) // 3
+    return np.sum(free[2 * N:]**2)
+
+
+def obj_grad(free):
+    N = len(free) // 3
+    grad = np.zeros_like(free)
+    grad[2 * N:] = 2.0 * free[2 * N:]
+    return grad
+
+
+def test_BatchSolver():
+
+    m, c, k, t = sym.symbols('m, c, k, t')
+    x, v, f = [s(t) for s in sym.symbols('x, v, f', cls=sym.Function)]
+
+    state_symbols = (x, v)
+
+    eom = sym.Matrix([x.diff() - v,
+                      m * v.diff() + c * v + k * x - f])
+
+    num_nodes = 21
+    interval_value = 0.1
+    duration = (num_nodes - 1) * interval_value
+
+    par_map = OrderedDict([(m, 1.0), (c, 0.5), (k, 1.0)])
+    instance_constraints = (x.func(0.0), v.func(0.0),
+                            x.func(duration) - 1.0, v.func(duration))
+    options = {'print_level': 0}
+
+    solver = BatchSolver(obj, obj_grad, eom, state_symbols, num_nodes,
+                         interval_value, max_workers=2,
+                         ipopt_options=options,
+                         known_parameter_map=par_map,
+                         instance_constraints=instance_constraints)
+
+    guess = np.zeros(3 * num_nodes)
+
+    jobs = [{'initial_guess': guess},
+            {'initial_guess': guess, 'known_parameter_map': {k: 2.0}},
+            {'initial_guess': guess, 'bounds': {f: (-1.5, 1.25)}},
+            {'initial_guess': np.zeros(3 * 41),
+             'num_collocation_nodes': 41,
+             'node_time_interval': duration / 40},
+            {'initial_guess': guess,
+             'known_parameter_map': {sym.Symbol('d'): 1.0}}]
+
+    with solver:
+        results = list(solver.solve(jobs))
+
+        # The workers and their compiled problems are kept for later calls.
+        more_results = list(solver.solve(jobs[:2]))
+
+    assert solver._executor is None
+
+    assert sorted([r['index'] for r in results]) == list(range(len(jobs)))
+    results = sorted(results, key=lambda r: r['index'])
+
+    workers = set(r['worker'] for r in results)
+    assert set(r['worker'] for r in more_results) <= workers
+    for r in more_results:
+        assert r['error'] is None, r['error']
+        np.testing.assert_allclose(r['solution'],
+                                   results[r['index']]['solution'])
+
+    # The failed job is reported and does not stop the others.
+    assert results[4]['solution'] is None
+    assert 'is not a known parameter' in results[4]['error']
+
+    for r in results[:4]:
+        assert r['error'] is None, r['error']
+        assert r['info']['status'] == 0
+        assert r['num_iterations'] > 0
+        assert r['wall_time'] >= r['solve_time'] > 0.0
+
+    # Each worker compiles a problem once per number of nodes, so at least
+    # one of the jobs with the default nodes reuses a compiled problem.
+    setup_times = [r['setup_time'] for r in results[:3]]
+    assert min(setup_times) < max(setup_times) / 10.0
+
+    prob = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                   interval_value, known_parameter_map=par_map,
+                   instance_constraints=instance_constraints)
+    prob.addOption('print_level', 0)
+    expected, info = prob.solve(guess)
+    np.testing.assert_allclose(results[0]['solution'], expected, atol=1e-8)
+    # The initial iterate, iteration 0, is not counted.
+    assert results[0]['num_iterations'] == len(prob.obj_value) - 1
+
+    # The known parameter is changed for only the one job.
+    prob.collocator.known_parameter_map[k] = 2.0
+    expected, info = prob.solve(guess)
+    np.testing.assert_allclose(results[1]['solution'], expected, atol=1e-8)
+    assert not np.allclose(results[0]['solution'], results[1]['solution'])
+
+    # The force is limited by the bounds of the job.
+    force = results[2]['solution'][2 * num_nodes:]
+    assert force.max() <= 1.25 + 1e-6
+    assert results[0]['solution'][2 * num_nodes:].max() > 1.25
+
+    assert len(results[3]['solution']) == 3 * 41
@@ -6,8 +6,13 @@ import numpy as np
 import sympy as sym
 from scipy import sparse
 from nose.tools import raises
+import pytest
 
-from ..direct_collocation import Problem, ConstraintCollocator
+from .. import direct_collocation, utils
+from ..direct_collocation import (Problem, ConstraintCollocator,
+                                  MultiExperimentCollocator,
+                                  MultiExperimentProblem)
+from ..parameter_identification import ParameterIdentificationObjective
 
 
 def test_Problem():
@@ -46,9 +51,88 @@ def test_Problem():
     np.testing.assert_allclose(prob.upper_bound, expected_upper)
 
 
+def test_Problem_warm_start():
+
+    m, c, k, t = sym.symbols('m, c, k, t')
+    x, v, f = [s(t) for s in sym.symbols('x, v, f', cls=sym.Function)]
+
+    state_symbols = (x, v)
+
+    eom = sym.Matrix([x.diff() - v,
+                      m * v.diff() + c * v + k * x - f])
+
+    par_map = OrderedDict([(m, 1.0), (c, 0.5), (k, 2.0)])
+
+    def make_problem(num_nodes):
+
+        duration = 2.0
+        interval_value = duration / (num_nodes - 1)
+
+        def obj(free):
+            return interval_value * np.sum(free[2 * num_nodes:]**2)
+
+        def obj_grad(free):
+            grad = np.zeros_like(free)
+            grad[2 * num_nodes:] = 2.0 * interval_value * free[2 * num_nodes:]
+            return grad
+
+        x, v = sym.symbols('x, v', cls=sym.Function)
+        instance_constraints = (x(0.0) - 1.0, v(0.0), x(duration), v(duration))
+
+        prob = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                       interval_value, known_parameter_map=par_map,
+                       instance_constraints=instance_constraints,
+                       bounds={f: (-10.0, 10.0)})
+        prob.addOption('print_level', 0)
+
+        return prob
+
+    prob = make_problem(21)
+
+    try:
+        prob.solve(warm_start=True)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('A warm start without a solution should fail.')
+
+    cold_solution, info = prob.solve(np.zeros(prob.num_free))
+    assert info['status'] == 0
+    num_cold_iterations = len(prob.obj_value)
+
+    np.testing.assert_allclose(prob.last_solution, cold_solution)
+    assert prob.last_constraint_multipliers.shape == (prob.num_constraints,)
+    assert prob.last_lower_bound_multipliers.shape == (prob.num_free,)
+    assert prob.last_upper_bound_multipliers.shape == (prob.num_free,)
+
+    warm_solution, info = prob.solve(warm_start=True)
+    assert info['status'] == 0
+    num_warm_iterations = len(prob.obj_value) - num_cold_iterations
+
+    assert num_warm_iterations < num_cold_iterations
+    np.testing.assert_allclose(warm_solution, cold_solution, atol=1e-6)
+
+    # A cold start after a warm start reverts the warm start options.
+    solution, info = prob.solve(np.zeros(prob.num_free))
+    assert info['status'] == 0
+    assert not prob._warm_start_options_set
+
+    finer_prob = make_problem(41)
+    finer_prob.warm_start_from(prob)
+
+    assert finer_prob.last_solution.shape == (finer_prob.num_free,)
+    assert finer_prob.last_constraint_multipliers.shape == \
+        (finer_prob.num_constraints,)
+    np.testing.assert_allclose(finer_prob.last_solution[:41:2],
+                               prob.last_solution[:21])
+
+    solution, info = finer_prob.solve(warm_start=True)
+    assert info['status'] == 0
+
+
 class TestConstraintCollocator():
 
-    def setup(self):
+    def setup_method(self):
 
         m, c, k, t = sym.symbols('m, c, k, t')
         x, v, f = [s(t) for s in sym.symbols('x, v, f', cls=sym.Function)]
@@ -389,7 +473,7 @@ class TestConstraintCollocator():
 
 class TestConstraintCollocatorUnknownTrajectories():
 
-    def setup(self):
+    def setup_method(self):
 
         # constant parameters
         m, c, t = sym.symbols('m, c, t')
@@ -769,7 +853,7 @@ def test_merge_fixed_free_trajectories():
 
 class TestConstraintCollocatorInstanceConstraints():
 
-    def setup(self):
+    def setup_method(self):
 
         I, m, g, d, t = sym.symbols('I, m, g, d, t')
         theta, omega, T = [f(t) for f in sym.symbols('theta, omega, T',
@@ -1045,6 +1129,10 @@ class TestConstraintCollocatorInstanceConstraints():
 
         np.testing.assert_allclose(result, expected)
 
+        # The arrays reused for the evaluations are not returned.
+        constrain(np.random.random(self.free.shape))
+        np.testing.assert_allclose(result, expected)
+
     def test_generate_jacobian_function(self):
 
         jacobian = self.collocator.generate_jacobian_function()
@@ -1074,3 +1162,1636 @@ class TestConstraintCollocatorInstanceConstraints():
             dtype=float)
 
         np.testing.assert_allclose(jacobian_matrix.todense(), expected_jacobian)
+
+
+def _mass_spring_damper(nonlinear=False, disturbance=False):
+    """Returns the symbols (m, c, k, t), the functions of time (x, v, f, d),
+    and the equations of motion of a mass-spring-damper with the states x
+    and v driven by the force f. The spring force is k * sin(x) if
+    nonlinear and the force is f + d if disturbance."""
+
+    m, c, k, t = sym.symbols('m, c, k, t')
+    x, v, f, d = [s(t) for s in sym.symbols('x, v, f, d', cls=sym.Function)]
+
+    spring = sym.sin(x) if nonlinear else x
+    force = f + d if disturbance else f
+
+    eom = sym.Matrix([x.diff() - v,
+                      m * v.diff() + c * v + k * spring - force])
+
+    return (m, c, k, t), (x, v, f, d), eom
+
+
+def _effort_objective(num_nodes, interval_value=1.0):
+    """Returns the objective, the sum of the squares of the force f over
+    the nodes times the interval, and its gradient for a free vector that
+    starts with the states x and v and the force f."""
+
+    force = slice(2 * num_nodes, 3 * num_nodes)
+
+    def obj(free):
+        return interval_value * np.sum(free[force]**2)
+
+    def obj_grad(free):
+        grad = np.zeros_like(free)
+        grad[force] = 2.0 * interval_value * free[force]
+        return grad
+
+    return obj, obj_grad
+
+
+def _simulate_backward_euler(m, c, k, x0, v0, force, h):
+    """Returns the states of the mass-spring-damper discretized with the
+    backward Euler method."""
+    N = len(force)
+    states = np.zeros((2, N))
+    states[:, 0] = x0, v0
+    A = np.array([[1.0 / h, -1.0],
+                  [k, m / h + c]])
+    for i in range(1, N):
+        b = np.array([states[0, i - 1] / h,
+                      m * states[1, i - 1] / h + force[i]])
+        states[:, i] = np.linalg.solve(A, b)
+    return states
+
+
+class TestMultiExperiment():
+
+    def setup_method(self):
+
+        m, c, k, t = sym.symbols('m, c, k, t')
+        x, v, f = [s(t) for s in sym.symbols('x, v, f', cls=sym.Function)]
+
+        self.constant_values = {m: 1.0, c: 0.5, k: 2.0}
+        self.state_symbols = (x, v)
+        self.eom = sym.Matrix([x.diff() - v,
+                               m * v.diff() + c * v + k * x - f])
+
+        self.h = 0.01
+        self.nodes = (6, 9)
+        self.forces = [np.sin(np.arange(6)), np.cos(np.arange(9))]
+        self.states = [_simulate_backward_euler(1.0, 0.5, 2.0, 1.0, 0.0,
+                                                force, self.h)
+                       for force in self.forces]
+
+        x, v = sym.symbols('x, v', cls=sym.Function)
+        self.trials = [{'num_collocation_nodes': N,
+                        'node_time_interval': self.h,
+                        'known_trajectory_map': {f: force},
+                        'instance_constraints': (x(0.0) - 1.0, v(0.0))}
+                       for N, force in zip(self.nodes, self.forces)]
+
+        self.symbols = m, c, k, f
+
+    def test_collocator(self):
+
+        m, c, k, f = self.symbols
+
+        num_compiled = utils.module_counter
+
+        collocator = MultiExperimentCollocator(self.eom, self.state_symbols,
+                                               self.trials,
+                                               known_parameter_map={m: 1.0})
+
+        assert collocator.num_trials == 2
+        assert collocator.unknown_parameters == (c, k)
+        assert collocator.trial_free_offsets == [0, 12]
+        assert collocator.num_free == 2 * 6 + 2 * 9 + 2
+        assert collocator.num_constraints == 2 * 5 + 2 + 2 * 8 + 2
+
+        con = collocator.generate_constraint_function()
+        jac = collocator.generate_jacobian_function()
+        rows, cols = collocator.jacobian_indices()
+
+        # One constraint and one Jacobian function are compiled for all of
+        # the trials.
+        assert utils.module_counter == num_compiled + 2
+
+        free = np.random.random(collocator.num_free)
+        parameters = free[-2:]
+
+        dense = sparse.coo_matrix((jac(free), (rows, cols)),
+                                  shape=(collocator.num_constraints,
+                                         collocator.num_free)).todense()
+
+        con_vals = con(free)
+
+        for i, (trial, collocator_i) in \
+                enumerate(zip(self.trials, collocator.trial_collocators)):
+
+            N = trial['num_collocation_nodes']
+            block = slice(collocator.trial_free_offsets[i],
+                          collocator.trial_free_offsets[i] + 2 * N)
+            trial_free = np.hstack((free[block], parameters))
+            np.testing.assert_allclose(collocator.trial_free(free, i),
+                                       trial_free)
+
+            single = ConstraintCollocator(
+                self.eom, self.state_symbols, N, self.h,
+                known_parameter_map={m: 1.0},
+                known_trajectory_map=trial['known_trajectory_map'],
+                instance_constraints=trial['instance_constraints'])
+
+            con_rows = slice(collocator.trial_constraint_offsets[i],
+                             collocator.trial_constraint_offsets[i] +
+                             single.num_constraints)
+
+            np.testing.assert_allclose(
+                con_vals[con_rows],
+                collocator_i._wrap_constraint_funcs(
+                    collocator.trial_collocators[0]._multi_arg_con_func,
+                    'con')(trial_free))
+
+            single_rows, single_cols = single.jacobian_indices()
+            single_jac = collocator_i._wrap_constraint_funcs(
+                collocator.trial_collocators[0]._multi_arg_con_jac_func,
+                'jac')(trial_free)
+            expected = sparse.coo_matrix(
+                (single_jac, (single_rows, single_cols)),
+                shape=(single.num_constraints, single.num_free)).todense()
+
+            # The trial's block and the shared parameter columns.
+            np.testing.assert_allclose(dense[con_rows, block],
+                                       expected[:, :2 * N])
+            np.testing.assert_allclose(dense[con_rows, -2:],
+                                       expected[:, -2:])
+            # Everything else is zero.
+            mask = np.ones(collocator.num_free, dtype=bool)
+            mask[block] = False
+            mask[-2:] = False
+            assert not np.any(dense[con_rows][:, mask])
+
+    @raises(ValueError)
+    def test_mismatched_trajectories(self):
+
+        trials = [dict(trial) for trial in self.trials]
+        trials[1]['known_trajectory_map'] = {}
+
+        MultiExperimentCollocator(self.eom, self.state_symbols, trials,
+                                  known_parameter_map={self.symbols[0]: 1.0})
+
+    def _problem(self, **kwargs):
+        """Returns the problem of identifying c and k from the measured x of
+        each trial."""
+
+        m, c, k, f = self.symbols
+        x = self.state_symbols[0]
+
+        prob = MultiExperimentProblem(None, None, self.eom,
+                                      self.state_symbols, self.trials,
+                                      known_parameter_map={m: 1.0},
+                                      bounds={x: (-5.0, 5.0),
+                                              k: (0.0, 10.0)}, **kwargs)
+
+        objectives = [ParameterIdentificationObjective(
+            N, 2, self.h, self.h * np.arange(N), states[0],
+            output_indices=(0,), free_offset=offset)
+            for N, states, offset in zip(self.nodes, self.states,
+                                         prob.collocator.trial_free_offsets)]
+
+        prob.obj = lambda free: sum(o.objective(free) for o in objectives)
+        prob.obj_grad = lambda free: sum(o.gradient(free) for o in
+                                         objectives)
+
+        prob.addOption('print_level', 0)
+        prob.addOption('tol', 1e-12)
+
+        return prob
+
+    def test_problem(self):
+
+        prob = self._problem()
+
+        assert prob.lower_bound[0] == -5.0
+        assert prob.lower_bound[12] == -5.0
+        assert prob.lower_bound[6] == -prob.INF
+        assert prob.upper_bound[-1] == 10.0
+        assert prob.upper_bound[-2] == prob.INF
+
+        solution, info = prob.solve(np.zeros(prob.num_free))
+
+        np.testing.assert_allclose(solution[-2:], [0.5, 2.0], rtol=1e-3)
+        np.testing.assert_allclose(solution[:12],
+                                   self.states[0].flatten(), atol=1e-6)
+        np.testing.assert_allclose(solution[12:30],
+                                   self.states[1].flatten(), atol=1e-6)
+
+    def test_generate_initial_guess(self):
+
+        m, c, k, f = self.symbols
+
+        prob = self._problem()
+
+        guess = prob.generate_initial_guess(
+            [1.0, 0.0], unknown_parameter_map={c: 0.5, k: 2.0})
+
+        expected = np.hstack([states.flatten() for states in self.states] +
+                             [[0.5, 2.0]])
+        np.testing.assert_allclose(guess, expected)
+
+        # Or one initial state per trial.
+        guess = prob.generate_initial_guess(
+            [[1.0, 0.0], [1.0, 0.0]], unknown_parameter_map={c: 0.5, k: 2.0})
+        np.testing.assert_allclose(guess, expected)
+
+    def test_warm_start_save_load(self):
+
+        import os
+        import shutil
+        import tempfile
+
+        prob = self._problem()
+        solution, info = prob.solve(np.zeros(prob.num_free))
+
+        other = self._problem()
+        other.warm_start_from(prob)
+        np.testing.assert_allclose(other.last_solution, prob.last_solution)
+        np.testing.assert_allclose(other.last_constraint_multipliers,
+                                   prob.last_constraint_multipliers)
+        np.testing.assert_allclose(other.last_lower_bound_multipliers,
+                                   prob.last_lower_bound_multipliers)
+        np.testing.assert_allclose(other.last_upper_bound_multipliers,
+                                   prob.last_upper_bound_multipliers)
+
+        # The trials must match.
+        single = Problem(prob.obj, prob.obj_grad, self.eom,
+                         self.state_symbols, self.nodes[0], self.h,
+                         known_parameter_map={self.symbols[0]: 1.0})
+        single.last_solution = np.zeros(single.num_free)
+        try:
+            other.warm_start_from(single)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('A single trial problem was accepted.')
+
+        tmp_dir = tempfile.mkdtemp()
+
+        try:
+            path = os.path.join(tmp_dir, 'problem.npz')
+            prob.save(path)
+            loaded = MultiExperimentProblem.load(path, prob.obj,
+                                                 prob.obj_grad)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        assert loaded.collocator.num_trials == 2
+        assert loaded.num_free == prob.num_free
+        np.testing.assert_allclose(loaded.last_solution, solution)
+
+        free = np.random.random(prob.num_free)
+        np.testing.assert_allclose(loaded.con(free), prob.con(free))
+        np.testing.assert_allclose(loaded.con_jac(free), prob.con_jac(free))
+        np.testing.assert_array_equal(loaded.jacobianstructure()[0],
+                                      prob.jacobianstructure()[0])
+        np.testing.assert_array_equal(loaded.jacobianstructure()[1],
+                                      prob.jacobianstructure()[1])
+
+        loaded.addOption('print_level', 0)
+        loaded_solution, info = loaded.solve(warm_start=True)
+        np.testing.assert_allclose(loaded_solution, solution, atol=1e-6)
+
+    def test_checkpoint_recorder(self):
+
+        import os
+        import shutil
+        import tempfile
+
+        from ..recorder import IterateRecorder, load_recording
+
+        tmp_dir = tempfile.mkdtemp()
+
+        try:
+            path = os.path.join(tmp_dir, 'checkpoint.npz')
+            prob = self._problem(recorder=IterateRecorder(
+                os.path.join(tmp_dir, 'iterates')), checkpoint_path=path,
+                checkpoint_interval=2)
+            expected, info = prob.solve(np.zeros(prob.num_free))
+
+            recording = load_recording(os.path.join(tmp_dir, 'iterates'))
+            np.testing.assert_allclose(recording['results']['solution'][0],
+                                       expected)
+
+            # The solve is continued from the last checkpoint in a new
+            # problem.
+            solution, info = self._problem().resume(path)
+        finally:
+            shutil.rmtree(tmp_dir)
+
+        assert info['status'] == 0
+        np.testing.assert_allclose(solution[:-2], expected[:-2], atol=1e-6)
+        np.testing.assert_allclose(solution[-2:], expected[-2:], rtol=1e-3)
+
+
+def test_Problem_scaling():
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper()
+
+    state_symbols = (x, v)
+
+    # A stiff system with small displacements, large forces, and large
+    # parameters.
+    num_nodes = 201
+    interval_value = 0.005
+    time = np.linspace(0.0, (num_nodes - 1) * interval_value, num=num_nodes)
+    force = 500.0 * np.sin(2.0 * np.pi * 3.0 * time)
+    states = _simulate_backward_euler(1.0, 40.0, 4000.0, 0.0, 0.0, force,
+                                      interval_value)
+
+    objective = ParameterIdentificationObjective(num_nodes, 2, interval_value,
+                                                 time, states[0])
+
+    initial_guess = np.hstack((np.zeros(2 * num_nodes), [1.0, 1.0]))
+
+    prob = Problem(objective.objective, objective.gradient, eom,
+                   state_symbols, num_nodes, interval_value,
+                   known_parameter_map={m: 1.0},
+                   known_trajectory_map={f: force},
+                   scaling={x: 0.1, v: 2.0, c: 40.0, k: 4000.0},
+                   constraint_scaling=[2.0, 500.0])
+    prob.addOption('print_level', 0)
+
+    free_nominal, con_nominal = prob._generate_scaling_arrays()
+    expected = np.hstack((0.1 * np.ones(num_nodes), 2.0 * np.ones(num_nodes),
+                          [40.0, 4000.0]))
+    np.testing.assert_allclose(free_nominal, expected)
+    expected = np.hstack((2.0 * np.ones(num_nodes - 1),
+                          500.0 * np.ones(num_nodes - 1)))
+    np.testing.assert_allclose(con_nominal, expected)
+
+    solution, info = prob.solve(initial_guess)
+
+    assert info['status'] == 0
+    np.testing.assert_allclose(solution[-2:], [40.0, 4000.0], rtol=1e-3)
+    # The unscaled problem takes about 100 iterations.
+    assert len(prob.obj_value) < 50
+
+    # The nominal magnitudes can be derived from the bounds.
+    prob = Problem(objective.objective, objective.gradient, eom,
+                   state_symbols, num_nodes, interval_value,
+                   known_parameter_map={m: 1.0},
+                   known_trajectory_map={f: force},
+                   bounds={x: (-0.1, 0.1), c: (0.0, 100.0),
+                           k: (0.0, 10000.0)},
+                   scaling='bounds')
+
+    free_nominal, con_nominal = prob._generate_scaling_arrays()
+    expected = np.hstack((0.1 * np.ones(num_nodes), np.ones(num_nodes),
+                          [100.0, 10000.0]))
+    np.testing.assert_allclose(free_nominal, expected)
+    np.testing.assert_allclose(con_nominal, np.ones(2 * (num_nodes - 1)))
+
+
+def test_Problem_generate_initial_guess():
+
+    # The linear system can be compared to the simulation.
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper()
+
+    state_symbols = (x, v)
+
+    num_nodes = 51
+    interval_value = 0.02
+    force = np.sin(np.arange(num_nodes) * interval_value)
+
+    prob = Problem(lambda free: 1.0, lambda free: free, eom, state_symbols,
+                   num_nodes, interval_value,
+                   known_parameter_map={m: 1.0, k: 2.0})
+
+    try:
+        prob.generate_initial_guess([1.0, 0.0])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('The unknown parameter must be given.')
+
+    guess = prob.generate_initial_guess([1.0, 0.0],
+                                        unknown_trajectory_map={f: force},
+                                        unknown_parameter_map={c: 0.5})
+
+    states = _simulate_backward_euler(1.0, 0.5, 2.0, 1.0, 0.0, force,
+                                      interval_value)
+    expected = np.hstack((states.flatten(), force, [0.5]))
+    np.testing.assert_allclose(guess, expected)
+
+
+@pytest.mark.parametrize('method', ['backward euler', 'midpoint'])
+def test_Problem_generate_initial_guess_nonlinear(method):
+
+    # The nonlinear system satisfies the equations of motion constraints
+    # with either integration method.
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper(nonlinear=True)
+
+    num_nodes = 51
+    interval_value = 0.02
+    force = np.sin(np.arange(num_nodes) * interval_value)
+
+    prob = Problem(lambda free: 1.0, lambda free: free, eom, (x, v),
+                   num_nodes, interval_value,
+                   known_parameter_map={m: 1.0, c: 0.5, k: 2.0},
+                   known_trajectory_map={f: force},
+                   integration_method=method)
+    guess = prob.generate_initial_guess([1.0, 0.0])
+    np.testing.assert_allclose(guess[[0, num_nodes]], [1.0, 0.0])
+    np.testing.assert_allclose(prob.con(guess),
+                               np.zeros(2 * (num_nodes - 1)), atol=1e-10)
+
+
+def test_Problem_obj_hess():
+
+    from scipy.integrate import odeint
+
+    m, c, k, t = sym.symbols('m, c, k, t')
+    x, v, f = [s(t) for s in sym.symbols('x, v, f', cls=sym.Function)]
+
+    state_symbols = (x, v)
+
+    eom = sym.Matrix([x.diff() - v,
+                      m * v.diff() + c * v + k * x - f])
+
+    num_nodes = 51
+    interval_value = 0.1
+    time = np.linspace(0.0, (num_nodes - 1) * interval_value, num=num_nodes)
+
+    def rhs(y, t):
+        return [y[1], np.sin(3.0 * t) - 0.5 * y[1] - 2.0 * y[0]]
+
+    x_measured = odeint(rhs, [1.0, 0.0], time)[:, 0]
+
+    objective = ParameterIdentificationObjective(num_nodes, 2, interval_value,
+                                                 time, x_measured)
+
+    initial_guess = np.hstack((x_measured, np.zeros(num_nodes), 0.1, 0.1))
+
+    solutions = []
+    num_iterations = []
+    for kwargs in ({}, {'obj_hess': objective.hessian,
+                        'obj_hess_indices': objective.hessian_indices()}):
+        prob = Problem(objective.objective, objective.gradient, eom,
+                       state_symbols, num_nodes, interval_value,
+                       known_parameter_map={m: 1.0},
+                       known_trajectory_map={f: np.sin(3.0 * time)},
+                       **kwargs)
+        prob.addOption('print_level', 0)
+        solution, info = prob.solve(initial_guess)
+        assert info['status'] == 0
+        solutions.append(solution)
+        num_iterations.append(len(prob.obj_value))
+
+    # IPOPT only uses the Hessian if it is given.
+    assert not hasattr(Problem, 'hessian')
+    assert prob.hessianstructure()[0] is prob.obj_hess_rows
+
+    # The Gauss-Newton Hessian converges in fewer iterations than IPOPT's
+    # limited-memory approximation.
+    np.testing.assert_allclose(solutions[1], solutions[0], atol=1e-4)
+    assert num_iterations[1] < num_iterations[0]
+
+    try:
+        Problem(objective.objective, objective.gradient, eom, state_symbols,
+                num_nodes, interval_value, known_parameter_map={m: 1.0},
+                known_trajectory_map={f: np.sin(3.0 * time)},
+                obj_hess=objective.hessian)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('The indices of the Hessian are required.')
+
+
+def test_Problem_save_load():
+
+    import os
+    import shutil
+    import subprocess
+    import sys
+    import tempfile
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper(nonlinear=True,
+                                                         disturbance=True)
+
+    state_symbols = (x, v)
+
+    num_nodes = 21
+    interval_value = 0.1
+    duration = (num_nodes - 1) * interval_value
+
+    obj, obj_grad = _effort_objective(num_nodes)
+
+    par_map = OrderedDict([(m, 1.0), (k, 2.0)])
+    traj_map = {d: 0.1 * np.sin(np.arange(num_nodes) * interval_value)}
+    instance_constraints = (x.func(0.0), v.func(0.0),
+                            x.func(duration) - m, v.func(duration))
+
+    prob = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                   interval_value, known_parameter_map=par_map,
+                   known_trajectory_map=traj_map,
+                   instance_constraints=instance_constraints,
+                   integration_method='midpoint',
+                   bounds={f: (-5.0, 5.0), c: (0.5, 0.5)},
+                   scaling={f: 2.0})
+    prob.addOption('print_level', 0)
+
+    solution, info = prob.solve(np.zeros(prob.num_free))
+    assert info['status'] == 0
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'problem.npz')
+
+    try:
+        prob.save(path)
+
+        loaded = Problem.load(path, obj, obj_grad)
+
+        assert loaded.num_free == prob.num_free
+        assert loaded.collocator.state_symbols == ('x(t)', 'v(t)')
+        assert loaded.collocator.unknown_parameters == ('c',)
+        np.testing.assert_allclose(loaded.lower_bound, prob.lower_bound)
+        np.testing.assert_allclose(loaded.upper_bound, prob.upper_bound)
+        np.testing.assert_allclose(loaded.con_jac_rows, prob.con_jac_rows)
+        np.testing.assert_allclose(loaded.con_jac_cols, prob.con_jac_cols)
+        np.testing.assert_allclose(loaded.last_solution, solution)
+
+        free = np.random.random(prob.num_free)
+        np.testing.assert_allclose(loaded.con(free), prob.con(free))
+        np.testing.assert_allclose(loaded.con_jac(free), prob.con_jac(free))
+
+        # The known values can be changed by name.
+        loaded.collocator.known_parameter_map['m'] = 2.0
+        prob.collocator.known_parameter_map[m] = 2.0
+        np.testing.assert_allclose(loaded.con(free), prob.con(free))
+
+        # Files from other versions of opty or other platforms are rejected
+        # before any of their code is executed.
+        import json
+        with np.load(path) as data:
+            arrays = {k: data[k] for k in data.files}
+        meta = json.loads(str(arrays['metadata']))
+        meta['instance_constraints_source'] = "raise RuntimeError('run')"
+        for key, value in (('opty_version', '0.0.0'),
+                           ('extension_suffix', '.other.so')):
+            changed = dict(meta)
+            changed[key] = value
+            arrays['metadata'] = np.array(json.dumps(changed))
+            changed_path = os.path.join(tmp_dir, 'changed.npz')
+            np.savez(changed_path, **arrays)
+            try:
+                Problem.load(changed_path, obj, obj_grad)
+            except ValueError as e:
+                assert value in str(e)
+            else:
+                raise AssertionError('The file should not be loaded.')
+
+        # The problem is solved in a new process without SymPy.
+        code = """
+import sys
+import numpy as np
+from opty.direct_collocation import Problem
+N = {N}
+def obj(free):
+    return np.sum(free[2 * N:3 * N]**2)
+def obj_grad(free):
+    grad = np.zeros_like(free)
+    grad[2 * N:3 * N] = 2.0 * free[2 * N:3 * N]
+    return grad
+prob = Problem.load({path!r}, obj, obj_grad)
+prob.addOption('print_level', 0)
+solution, info = prob.solve(warm_start=True)
+assert info['status'] == 0
+assert 'sympy' not in sys.modules
+np.save({out!r}, solution)
+""".format(N=num_nodes, path=path, out=os.path.join(tmp_dir, 'out.npy'))
+        root = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+        subprocess.check_call([sys.executable, '-c', code], cwd=root)
+
+        np.testing.assert_allclose(np.load(os.path.join(tmp_dir, 'out.npy')),
+                                   solution, atol=1e-6)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@pytest.mark.parametrize('method', ['backward euler', 'midpoint'])
+def test_Problem_memmap(method):
+
+    import shutil
+    import tempfile
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper(disturbance=True)
+
+    state_symbols = (x, v)
+
+    num_nodes = 21
+    interval_value = 0.1
+    duration = (num_nodes - 1) * interval_value
+
+    obj, obj_grad = _effort_objective(num_nodes)
+
+    traj_map = {d: np.sin(np.arange(num_nodes) * interval_value)}
+    instance_constraints = (x.func(0.0), v.func(0.0),
+                            x.func(duration) - 1.0, v.func(duration))
+
+    kwargs = dict(known_parameter_map={m: 1.0, c: 0.5, k: 2.0},
+                  known_trajectory_map=traj_map,
+                  instance_constraints=instance_constraints,
+                  integration_method=method)
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        prob = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                       interval_value, **kwargs)
+        mapped = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                         interval_value, memmap_dir=tmp_dir, **kwargs)
+        for p in (prob, mapped):
+            p.addOption('print_level', 0)
+
+        known = mapped.collocator.known_trajectory_map[d]
+        assert isinstance(known, np.memmap)
+        assert isinstance(mapped.con_jac_rows, np.memmap)
+        np.testing.assert_allclose(known, traj_map[d])
+        np.testing.assert_allclose(mapped.con_jac_rows, prob.con_jac_rows)
+        np.testing.assert_allclose(mapped.con_jac_cols, prob.con_jac_cols)
+
+        free = np.random.random(prob.num_free)
+        np.testing.assert_allclose(mapped.con(free), prob.con(free))
+        np.testing.assert_allclose(mapped.con_jac(free), prob.con_jac(free))
+
+        expected, info = prob.solve(np.zeros(prob.num_free))
+        solution, info = mapped.solve(np.zeros(prob.num_free))
+        assert info['status'] == 0
+        np.testing.assert_allclose(solution, expected)
+
+        assert isinstance(mapped.last_solution, np.memmap)
+        np.testing.assert_allclose(mapped.last_solution, solution)
+        np.testing.assert_allclose(mapped.last_constraint_multipliers,
+                                   prob.last_constraint_multipliers)
+
+        solution, info = mapped.solve(warm_start=True)
+        assert info['status'] == 0
+
+        del known, mapped
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_Problem_checkpoint_resume():
+
+    import json
+    import os
+    import shutil
+    import tempfile
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper(nonlinear=True)
+
+    state_symbols = (x, v)
+
+    num_nodes = 41
+    interval_value = 0.05
+    duration = (num_nodes - 1) * interval_value
+
+    obj, obj_grad = _effort_objective(num_nodes, interval_value)
+
+    tmp_dir = tempfile.mkdtemp()
+    path = os.path.join(tmp_dir, 'checkpoint.npz')
+
+    def make_problem():
+        prob = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                       interval_value,
+                       known_parameter_map={m: 1.0, c: 0.1, k: 10.0},
+                       instance_constraints=(x.func(0.0), v.func(0.0),
+                                             x.func(duration) - 3.0,
+                                             v.func(duration)),
+                       bounds={f: (-30.0, 30.0)},
+                       checkpoint_path=path, checkpoint_interval=4)
+        prob.addOption('print_level', 0)
+        prob.addOption('tol', 1e-10)
+        return prob
+
+    try:
+        prob = make_problem()
+
+        try:
+            prob.resume()
+        except IOError:
+            pass
+        else:
+            raise AssertionError('There is no checkpoint to resume from.')
+
+        expected, info = prob.solve(np.zeros(prob.num_free))
+        assert info['status'] == 0
+        num_iterations = len(prob.obj_value) - 1
+        assert num_iterations > 8
+
+        # The last checkpoint is as if the solve was interrupted then.
+        with np.load(path) as data:
+            meta = json.loads(str(data['metadata']))
+            assert data['free'].shape == (prob.num_free,)
+        last_checkpoint = 4 * (num_iterations // 4)
+        if last_checkpoint == num_iterations:
+            last_checkpoint -= 4
+        assert meta['iteration'] == last_checkpoint
+        assert ['tol', 1e-10] in meta['options']
+
+        # The solve is continued in a new problem.
+        prob = make_problem()
+        prob.checkpoint_path = None
+        solution, info = prob.resume(path)
+        assert info['status'] == 0
+        np.testing.assert_allclose(solution, expected, atol=1e-5)
+        assert len(prob.obj_value) - 1 < num_iterations
+
+        # The options are restored after resuming, so a cold start takes as
+        # many iterations as the first solve.
+        del prob.obj_value[:]
+        solution, info = prob.solve(np.zeros(prob.num_free))
+        assert len(prob.obj_value) - 1 == num_iterations
+        np.testing.assert_allclose(solution, expected)
+
+        wrong_size = Problem(obj, obj_grad, eom, state_symbols, 21,
+                             interval_value,
+                             known_parameter_map={m: 1.0, c: 0.1, k: 10.0})
+        try:
+            wrong_size.resume(path)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('The checkpoint is for another problem.')
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@pytest.mark.parametrize('method', ['backward euler', 'midpoint'])
+def test_ConstraintCollocator_path_constraints(method):
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper(disturbance=True)
+
+    num_nodes = 6
+    interval_value = 0.1
+
+    path_constraints = (f * v, c * x**2 + d * f)
+
+    known = np.random.random(num_nodes)
+
+    col = ConstraintCollocator(eom, (x, v), num_nodes, interval_value,
+                               known_parameter_map={m: 1.0, k: 2.0},
+                               known_trajectory_map={d: known},
+                               instance_constraints=(x.func(0.0),),
+                               integration_method=method,
+                               path_constraints=path_constraints)
+
+    assert col.num_path_constraints == 2
+    assert col.num_constraints == 2 * (num_nodes - 1) + 1 + 2 * num_nodes
+
+    con = col.generate_constraint_function()
+    jac = col.generate_jacobian_function()
+    rows, cols = col.jacobian_indices()
+
+    free = np.random.random(col.num_free)
+    xs, vs, fs = free[:3 * num_nodes].reshape(3, num_nodes)
+    cs = free[-1]
+
+    con_vals = con(free)
+    np.testing.assert_allclose(con_vals[-2 * num_nodes:],
+                               np.hstack((fs * vs, cs * xs**2 + known * fs)))
+
+    jac_vals = jac(free)
+    assert jac_vals.shape == rows.shape == cols.shape
+
+    # Only the partial derivatives with respect to f and v and to c, x and
+    # f are stored at each node.
+    assert np.sum(rows >= col.num_constraints - 2 * num_nodes) == \
+        5 * num_nodes
+
+    jacobian = sparse.coo_matrix((jac_vals, (rows, cols)),
+                                 shape=(col.num_constraints,
+                                        col.num_free)).toarray()
+
+    delta = 1e-7
+    expected = np.zeros_like(jacobian)
+    for i in range(col.num_free):
+        perturbed = free.copy()
+        perturbed[i] += delta
+        expected[:, i] = (con(perturbed) - con_vals) / delta
+
+    np.testing.assert_allclose(jacobian, expected, atol=1e-5)
+
+    # The pattern of the path constraint Jacobian is saved with it.
+    loaded = ConstraintCollocator._from_saved(*col._saved_data())
+    loaded_rows, loaded_cols = loaded.jacobian_indices()
+    np.testing.assert_allclose(loaded_rows, rows)
+    np.testing.assert_allclose(loaded_cols, cols)
+    loaded_jac = loaded._wrap_constraint_funcs(
+        loaded._multi_arg_con_jac_func, 'jac')
+    np.testing.assert_allclose(loaded_jac(free), jac_vals)
+
+
+def test_ConstraintCollocator_invalid_path_constraints():
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper(disturbance=True)
+
+    # Derivatives and symbols not in the equations of motion are not
+    # allowed.
+    for path_constraint in (v.diff(), f * sym.Symbol('a'), f * t):
+        try:
+            ConstraintCollocator(eom, (x, v), 6, 0.1,
+                                 path_constraints=(path_constraint,))
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('{} is invalid.'.format(path_constraint))
+
+
+def test_Problem_path_constraints():
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper()
+
+    state_symbols = (x, v)
+
+    num_nodes = 41
+    interval_value = 0.05
+    duration = (num_nodes - 1) * interval_value
+
+    obj, obj_grad = _effort_objective(num_nodes, interval_value)
+
+    kwargs = dict(known_parameter_map={m: 1.0, c: 0.5, k: 1.0},
+                  instance_constraints=(x.func(0.0), v.func(0.0),
+                                        x.func(duration) - 1.0,
+                                        v.func(duration)))
+
+    prob = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                   interval_value, **kwargs)
+    prob.addOption('print_level', 0)
+    unconstrained, info = prob.solve(np.zeros(prob.num_free))
+    assert info['status'] == 0
+
+    max_power = np.max(np.abs(unconstrained[2 * num_nodes:] *
+                              unconstrained[num_nodes:2 * num_nodes]))
+
+    # The power of the actuator is limited to less than the unconstrained
+    # maximum.
+    limit = 0.8 * max_power
+    prob = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                   interval_value, path_constraints=(f * v,),
+                   path_constraint_bounds=[(-limit, limit)], **kwargs)
+    prob.addOption('print_level', 0)
+
+    np.testing.assert_allclose(prob.con_lower_bound[-num_nodes:], -limit)
+    np.testing.assert_allclose(prob.con_upper_bound[-num_nodes:], limit)
+    np.testing.assert_allclose(prob.con_lower_bound[:-num_nodes], 0.0)
+
+    solution, info = prob.solve(np.zeros(prob.num_free))
+    assert info['status'] == 0
+
+    power = solution[2 * num_nodes:] * solution[num_nodes:2 * num_nodes]
+    assert np.max(np.abs(power)) <= limit + 1e-6
+    np.testing.assert_allclose(np.max(np.abs(power)), limit)
+    assert info['obj_val'] > obj(unconstrained)
+
+    # The multipliers of the path constraints are interpolated for a warm
+    # start of a finer problem.
+    finer = Problem(obj, obj_grad, eom, state_symbols, 2 * num_nodes - 1,
+                    interval_value / 2, path_constraints=(f * v,),
+                    path_constraint_bounds=[(-limit, limit)], **kwargs)
+    finer.warm_start_from(prob)
+    assert finer.last_constraint_multipliers.shape == (finer.num_constraints,)
+
+    try:
+        Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                interval_value, path_constraints=(f * v,),
+                path_constraint_bounds=[(1.0, -1.0)], **kwargs)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('The lower bound is larger than the upper.')
+
+
+def test_ConstraintCollocator_instance_constraints_unknowns():
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper(disturbance=True)
+
+    state_symbols = (x, v)
+
+    num_nodes = 5
+    interval_value = 0.1
+    duration = (num_nodes - 1) * interval_value
+
+    # The unknown input at the start and end, periodicity of the unknown
+    # input, and an unknown parameter.
+    instance_constraints = (f.func(0.0),
+                            f.func(duration) - f.func(0.0) + x.func(0.1),
+                            c * v.func(duration) - 2.0 * k,
+                            c**2 - 1.0)
+
+    col = ConstraintCollocator(eom, state_symbols, num_nodes,
+                               interval_value,
+                               known_parameter_map={m: 1.0, k: 2.0},
+                               known_trajectory_map={d: np.zeros(num_nodes)},
+                               instance_constraints=instance_constraints)
+
+    assert col.instance_constraints_free_index_map == {x.func(0.1): 1,
+                                                       v.func(duration): 9,
+                                                       f.func(0.0): 10,
+                                                       f.func(duration): 14,
+                                                       c: 15}
+
+    rows, cols = col._instance_constraints_jacobian_indices()
+    num_eom = 2 * (num_nodes - 1)
+    np.testing.assert_allclose(rows, num_eom + np.array([0, 1, 1, 1, 2, 2,
+                                                         3]))
+    np.testing.assert_allclose(cols, [10, 1, 10, 14, 9, 15, 15])
+
+    free = np.random.random(col.num_free)
+
+    np.testing.assert_allclose(col.eval_instance_constraints(free),
+                               [free[10], free[14] - free[10] + free[1],
+                                free[15] * free[9] - 4.0,
+                                free[15]**2 - 1.0])
+    np.testing.assert_allclose(
+        col.eval_instance_constraints_jacobian_values(free),
+        [1.0, 1.0, -1.0, 1.0, free[15], free[9], 2.0 * free[15]])
+
+    # Instances of known trajectories are not supported.
+    try:
+        ConstraintCollocator(eom, state_symbols, num_nodes, interval_value,
+                             known_trajectory_map={d: np.zeros(num_nodes)},
+                             instance_constraints=(d.func(0.0),))
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('d(0.0) is a known trajectory.')
+
+    # A periodic unknown input is solved for without additional states.
+    num_nodes = 41
+    interval_value = 0.05
+    duration = (num_nodes - 1) * interval_value
+
+    obj, obj_grad = _effort_objective(num_nodes, interval_value)
+
+    prob = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                   interval_value,
+                   known_parameter_map={m: 1.0, k: 2.0},
+                   known_trajectory_map={d: np.zeros(num_nodes)},
+                   instance_constraints=(x.func(0.0), v.func(0.0),
+                                         x.func(duration) - 1.0,
+                                         v.func(duration),
+                                         f.func(0.0) - f.func(duration),
+                                         c - 0.5))
+    prob.addOption('print_level', 0)
+
+    solution, info = prob.solve(np.zeros(prob.num_free))
+    assert info['status'] == 0
+
+    force = solution[2 * num_nodes:3 * num_nodes]
+    np.testing.assert_allclose(force[0], force[-1], atol=1e-8)
+    np.testing.assert_allclose(solution[-1], 0.5)
+    assert prob.num_free == 3 * num_nodes + 1
+
+
+def _mass_forcing():
+    """Returns the symbols, the states, and the mass matrix and forcing
+    vector of a mass-spring-damper with a nonlinear mass and damper."""
+
+    (m, c, k, t), (x, v, f, d), _ = _mass_spring_damper()
+
+    mass_matrix = sym.Matrix([[1, 0],
+                              [0, m + c * sym.cos(x)**2]])
+    forcing_vector = sym.Matrix([v,
+                                 -k * x - c * sym.sin(x) * v**2 + f * d])
+
+    return (m, c, k, t), (x, v, f, d), mass_matrix, forcing_vector
+
+
+@pytest.mark.parametrize('method', ['backward euler', 'midpoint'])
+def test_ConstraintCollocator_mass_forcing(method):
+
+    (m, c, k, t), (x, v, f, d), mass_matrix, forcing_vector = \
+        _mass_forcing()
+
+    state_symbols = (x, v)
+
+    num_nodes = 6
+    interval_value = 0.1
+
+    kwargs = dict(known_parameter_map={m: 1.0, k: 2.0},
+                  known_trajectory_map={d: np.random.random(num_nodes)},
+                  integration_method=method)
+
+    col = ConstraintCollocator((mass_matrix, forcing_vector),
+                               state_symbols, num_nodes, interval_value,
+                               **kwargs)
+    expected_col = ConstraintCollocator(
+        utils.f_minus_ma(mass_matrix, forcing_vector, state_symbols),
+        state_symbols, num_nodes, interval_value, **kwargs)
+
+    assert col.eom == expected_col.eom
+    np.testing.assert_allclose(col.jacobian_indices(),
+                               expected_col.jacobian_indices())
+
+    free = np.random.random(col.num_free)
+
+    jac = col.generate_jacobian_function()
+    expected_jac = expected_col.generate_jacobian_function()
+
+    np.testing.assert_allclose(jac(free), expected_jac(free))
+
+    # The mass matrix and forcing kernels are saved and loaded.
+    col.generate_constraint_function()
+    loaded = ConstraintCollocator._from_saved(*col._saved_data())
+    loaded_jac = loaded._wrap_constraint_funcs(
+        loaded._multi_arg_con_jac_func, 'jac')
+    np.testing.assert_allclose(loaded_jac(free), expected_jac(free))
+
+
+@raises(ValueError)
+def test_ConstraintCollocator_mass_forcing_derivatives():
+
+    (m, c, k, t), (x, v, f, d), mass_matrix, forcing_vector = \
+        _mass_forcing()
+
+    # The forcing vector contains derivatives.
+    ConstraintCollocator((mass_matrix, forcing_vector.diff(t)), (x, v), 6,
+                         0.1)
+
+
+def _explicit_form():
+    """Returns the symbols, the states, and the explicit equations of motion
+    of a mass-spring-damper with a nonlinear damper."""
+
+    (m, c, k, t), (x, v, f, d), _ = _mass_spring_damper()
+
+    eom = sym.Matrix([x.diff() - v,
+                      v.diff() - (-c * v * sym.cos(x) - k * x + f * d) / m])
+
+    return (m, c, k, t), (x, v, f, d), eom
+
+
+@pytest.mark.parametrize('method', ['backward euler', 'midpoint'])
+def test_ConstraintCollocator_explicit_form(method):
+
+    (m, c, k, t), (x, v, f, d), eom = _explicit_form()
+
+    state_symbols = (x, v)
+
+    num_nodes = 6
+    interval_value = 0.1
+
+    kwargs = dict(known_parameter_map={m: 1.0, k: 2.0},
+                  known_trajectory_map={d: np.random.random(num_nodes)},
+                  instance_constraints=(x.func(0.0) - 1.0,),
+                  integration_method=method)
+
+    col = ConstraintCollocator(eom, state_symbols, num_nodes, interval_value,
+                               explicit_form=True, **kwargs)
+    expected_col = ConstraintCollocator(eom, state_symbols, num_nodes,
+                                        interval_value, **kwargs)
+
+    rows, cols = col.jacobian_indices()
+    expected_rows, expected_cols = expected_col.jacobian_indices()
+
+    if method == 'backward euler':
+        # Only the diagonal of the partials with respect to the previous
+        # states are stored.
+        assert len(rows) == len(expected_rows) - 5 * 2 * (2 - 1)
+    else:
+        np.testing.assert_allclose(rows, expected_rows)
+        np.testing.assert_allclose(cols, expected_cols)
+
+    free = np.random.random(col.num_free)
+
+    jac = col.generate_jacobian_function()
+    expected_jac = expected_col.generate_jacobian_function()
+
+    shape = (col.num_constraints, col.num_free)
+    np.testing.assert_allclose(
+        sparse.coo_matrix((jac(free), (rows, cols)), shape).toarray(),
+        sparse.coo_matrix((expected_jac(free),
+                           (expected_rows, expected_cols)),
+                          shape).toarray())
+
+    col.generate_constraint_function()
+    loaded = ConstraintCollocator._from_saved(*col._saved_data())
+    loaded_jac = loaded._wrap_constraint_funcs(
+        loaded._multi_arg_con_jac_func, 'jac')
+    np.testing.assert_allclose(loaded_jac(free), jac(free))
+
+
+def test_Problem_explicit_form():
+
+    (m, c, k, t), (x, v, f, d), eom = _explicit_form()
+
+    state_symbols = (x, v)
+
+    num_nodes = 6
+    interval_value = 0.1
+
+    kwargs = dict(known_parameter_map={m: 1.0, k: 2.0, c: 0.5},
+                  known_trajectory_map={d: np.random.random(num_nodes)})
+
+    # The initial guess is simulated with the explicit Jacobian.
+    prob = Problem(lambda free: 0.0, lambda free: np.zeros_like(free), eom,
+                   state_symbols, num_nodes, interval_value,
+                   explicit_form=True, **kwargs)
+    expected_prob = Problem(lambda free: 0.0,
+                            lambda free: np.zeros_like(free), eom,
+                            state_symbols, num_nodes, interval_value,
+                            **kwargs)
+    force = np.random.random(num_nodes)
+    np.testing.assert_allclose(
+        prob.generate_initial_guess([1.0, 0.0], {f: force}),
+        expected_prob.generate_initial_guess([1.0, 0.0], {f: force}))
+
+
+@raises(ValueError)
+def test_ConstraintCollocator_explicit_form_implicit_eom():
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper()
+
+    # The equations of motion are not explicit.
+    ConstraintCollocator(eom, (x, v), 6, 0.1, explicit_form=True)
+
+
+def test_ConstraintCollocator_cache_dir():
+
+    import os
+    import shutil
+    import tempfile
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper()
+
+    state_symbols = (x, v)
+
+    num_nodes = 5
+    interval_value = 0.1
+
+    kwargs = dict(known_parameter_map={m: 1.0, k: 2.0},
+                  known_trajectory_map={f: np.random.random(num_nodes)},
+                  instance_constraints=(x.func(0.0) - 1.0,),
+                  path_constraints=(x**2 + c,))
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        col = ConstraintCollocator(eom, state_symbols, num_nodes,
+                                   interval_value, cache_dir=tmp_dir,
+                                   **kwargs)
+        con = col.generate_constraint_function()
+        jac = col.generate_jacobian_function()
+
+        # The four compiled functions and the sorted symbols.
+        assert len(os.listdir(tmp_dir)) == 5
+
+        cached_col = ConstraintCollocator(eom, state_symbols, num_nodes,
+                                          interval_value, cache_dir=tmp_dir,
+                                          **kwargs)
+        cached_con = cached_col.generate_constraint_function()
+        cached_jac = cached_col.generate_jacobian_function()
+
+        # The compiled functions are loaded without discretizing the
+        # equations of motion.
+        assert cached_col._discrete_eom is None
+        assert len(os.listdir(tmp_dir)) == 5
+
+        free = np.random.random(col.num_free)
+        np.testing.assert_allclose(cached_con(free), con(free))
+        np.testing.assert_allclose(cached_jac(free), jac(free))
+
+        # A different integration method is not a cache hit.
+        other_col = ConstraintCollocator(eom, state_symbols, num_nodes,
+                                         interval_value, cache_dir=tmp_dir,
+                                         integration_method='midpoint',
+                                         **kwargs)
+        other_col.generate_constraint_function()
+        assert other_col._discrete_eom is not None
+        assert len(os.listdir(tmp_dir)) == 7
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_ConstraintCollocator_cache_dir_hit():
+
+    import shutil
+    import tempfile
+
+    import sympy.physics.mechanics
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper()
+
+    state_symbols = (x, v)
+
+    num_nodes = 5
+    interval_value = 0.1
+
+    kwargs = dict(known_parameter_map={m: 1.0, k: 2.0},
+                  known_trajectory_map={f: np.random.random(num_nodes)},
+                  instance_constraints=(x.func(0.0) - 1.0,
+                                        v.func(0.4) - c),
+                  path_constraints=(x**2 + c,))
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        col = ConstraintCollocator(eom, state_symbols, num_nodes,
+                                   interval_value, cache_dir=tmp_dir,
+                                   **kwargs)
+        con = col.generate_constraint_function()
+        jac = col.generate_jacobian_function()
+
+        # A cache hit neither discretizes the equations of motion, nor
+        # searches them for the input trajectories, nor lambdifies the
+        # instance constraints.
+        def fail(*args, **kwargs):
+            raise AssertionError('The cache was not used.')
+
+        patched = [(ConstraintCollocator, '_discretize_eom'),
+                   (sympy.physics.mechanics, 'find_dynamicsymbols'),
+                   (sym, 'lambdify')]
+        originals = [getattr(obj, name) for obj, name in patched]
+        for obj, name in patched:
+            setattr(obj, name, fail)
+        try:
+            cached_col = ConstraintCollocator(eom, state_symbols, num_nodes,
+                                              interval_value,
+                                              cache_dir=tmp_dir, **kwargs)
+            cached_con = cached_col.generate_constraint_function()
+            cached_jac = cached_col.generate_jacobian_function()
+            cached_rows, cached_cols = cached_col.jacobian_indices()
+        finally:
+            for (obj, name), original in zip(patched, originals):
+                setattr(obj, name, original)
+
+        assert cached_col.known_parameters == col.known_parameters
+        assert cached_col.unknown_parameters == col.unknown_parameters
+        assert (cached_col.known_input_trajectories ==
+                col.known_input_trajectories)
+        assert (cached_col.unknown_input_trajectories ==
+                col.unknown_input_trajectories)
+
+        free = np.random.random(col.num_free)
+        np.testing.assert_allclose(cached_con(free), con(free))
+        np.testing.assert_allclose(cached_jac(free), jac(free))
+        rows, cols = col.jacobian_indices()
+        np.testing.assert_array_equal(cached_rows, rows)
+        np.testing.assert_array_equal(cached_cols, cols)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_ConstraintCollocator_cache_dir_permissions():
+
+    import os
+    import shutil
+    import tempfile
+    import warnings
+    from unittest import SkipTest
+
+    if not hasattr(os, 'getuid'):
+        raise SkipTest('Files have no POSIX owners on this platform.')
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper()
+
+    kwargs = dict(known_parameter_map={m: 1.0, c: 0.5, k: 2.0})
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        # The cache is not used if others could write to it.
+        os.chmod(tmp_dir, 0o770)
+        try:
+            ConstraintCollocator(eom, (x, v), 5, 0.1, cache_dir=tmp_dir,
+                                 **kwargs)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('The cache directory is group writable.')
+
+        # A new directory is created only writable by the user.
+        cache_dir = os.path.join(tmp_dir, 'cache')
+        os.chmod(tmp_dir, 0o700)
+        col = ConstraintCollocator(eom, (x, v), 5, 0.1, cache_dir=cache_dir,
+                                   **kwargs)
+        assert os.stat(cache_dir).st_mode & 0o077 == 0
+        free = np.random.random(col.num_free)
+        expected = col.generate_constraint_function()(free)
+
+        # Entries that others could have written are ignored.
+        for name in os.listdir(cache_dir):
+            os.chmod(os.path.join(cache_dir, name), 0o666)
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            col = ConstraintCollocator(eom, (x, v), 5, 0.1,
+                                       cache_dir=cache_dir, **kwargs)
+            con = col.generate_constraint_function()
+        assert any('is ignored' in str(w.message) for w in caught)
+        np.testing.assert_allclose(con(free), expected)
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_ConstraintCollocator_reproducible_code():
+
+    import os
+    import re
+    import shutil
+    import tempfile
+
+    (m, c, k, t), (x, v, f, d), mass_matrix, forcing_vector = \
+        _mass_forcing()
+    explicit_eom = _explicit_form()[2]
+
+    def generated_code(eom):
+        """Returns the C code of the Jacobian of the equations of motion
+        with the module names removed."""
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            col = ConstraintCollocator(eom, (x, v), 6, 0.1,
+                                       known_parameter_map={m: 1.0, k: 2.0},
+                                       integration_method='midpoint',
+                                       explicit_form=not isinstance(eom,
+                                                                    tuple),
+                                       tmp_dir=tmp_dir)
+            col.generate_jacobian_function()
+            code = []
+            for name in sorted(os.listdir(tmp_dir)):
+                if name.endswith('.c') and '_c' in name:
+                    with open(os.path.join(tmp_dir, name)) as f:
+                        code.append(re.sub(r'ufuncify_matrix_\d+', '',
+                                           f.read()))
+            return code
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    # The symbols that stand in for the state derivatives of the mass matrix
+    # form and the midpoint values of the explicit form are not Dummy
+    # symbols, whose names depend on how many were created before.
+    for eom in ((mass_matrix, forcing_vector), explicit_eom):
+        code = generated_code(eom)
+        assert code == generated_code(eom)
+        assert '_opty_' in ''.join(code)
+
+
+def test_ConstraintCollocator_parallel_options():
+
+    import shutil
+    import tempfile
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper()
+
+    state_symbols = (x, v)
+
+    num_nodes = 50
+    interval_value = 0.1
+
+    kwargs = dict(known_parameter_map={m: 1.0, k: 2.0},
+                  known_trajectory_map={f: np.random.random(num_nodes)})
+
+    col = ConstraintCollocator(eom, state_symbols, num_nodes, interval_value,
+                               **kwargs)
+    free = np.random.random(col.num_free)
+    expected_con = col.generate_constraint_function()(free)
+    expected_jac = col.generate_jacobian_function()(free)
+
+    if not utils.openmp_installed():
+        return
+
+    col = ConstraintCollocator(eom, state_symbols, num_nodes, interval_value,
+                               parallel=True, num_threads=2,
+                               schedule='dynamic,4', **kwargs)
+    np.testing.assert_allclose(col.generate_constraint_function()(free),
+                               expected_con)
+    np.testing.assert_allclose(col.generate_jacobian_function()(free),
+                               expected_jac)
+    assert col._kernel_options == {'con': [2, 'dynamic,4'],
+                                   'con_jac': [2, 'dynamic,4']}
+    # The options are passed to each call of the compiled functions.
+    assert col._kernel_kwargs['con'] == {'num_threads': 2,
+                                         'schedule_kind': 2,
+                                         'chunk_size': 4}
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        col = ConstraintCollocator(eom, state_symbols, num_nodes,
+                                   interval_value, parallel='auto',
+                                   cache_dir=tmp_dir, **kwargs)
+        np.testing.assert_allclose(col.generate_constraint_function()(free),
+                                   expected_con)
+        np.testing.assert_allclose(col.generate_jacobian_function()(free),
+                                   expected_jac)
+        assert sorted(col._kernel_options.keys()) == ['con', 'con_jac']
+
+        # The tuned options are read from the cache instead of tuned again.
+        def tune(*args, **kwargs):
+            raise AssertionError('The options are tuned again.')
+
+        tune_parallel_options = direct_collocation.tune_parallel_options
+        direct_collocation.tune_parallel_options = tune
+        try:
+            cached_col = ConstraintCollocator(eom, state_symbols, num_nodes,
+                                              interval_value,
+                                              parallel='auto',
+                                              cache_dir=tmp_dir, **kwargs)
+            np.testing.assert_allclose(
+                cached_col.generate_constraint_function()(free),
+                expected_con)
+            cached_col.generate_jacobian_function()
+        finally:
+            direct_collocation.tune_parallel_options = tune_parallel_options
+        assert cached_col._kernel_options == col._kernel_options
+
+        # And saved with the compiled functions.
+        loaded = ConstraintCollocator._from_saved(*col._saved_data())
+        assert loaded._kernel_options == col._kernel_options
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_ConstraintCollocator_generate_ode_functions():
+
+    from scipy.integrate import solve_ivp
+
+    m, c, k, t = sym.symbols('m, c, k, t')
+    x, v, f = [s(t) for s in sym.symbols('x, v, f', cls=sym.Function)]
+
+    state_symbols = (x, v)
+    par_map = OrderedDict([(m, 2.0), (c, 0.5), (k, 3.0)])
+
+    eom = sym.Matrix([x.diff() - v,
+                      m * v.diff() + c * v + k * sym.sin(x) - f])
+
+    col = ConstraintCollocator(eom, state_symbols, 10, 0.01,
+                               known_parameter_map=par_map)
+
+    assert col.parameters == (m, c, k)
+
+    rhs, rhs_jac = col.generate_ode_functions()
+
+    p = np.array([2.0, 0.5, 3.0])
+
+    np.testing.assert_allclose(rhs([0.1, 0.2], [1.0], p),
+                               [0.2, (1.0 - 0.5 * 0.2 -
+                                      3.0 * np.sin(0.1)) / 2.0])
+    np.testing.assert_allclose(rhs_jac([0.1, 0.2], [1.0], p),
+                               [[0.0, 1.0],
+                                [-3.0 * np.cos(0.1) / 2.0, -0.5 / 2.0]])
+
+    # Many points at once.
+    xs = np.random.random((2, 5))
+    rs = np.random.random((1, 5))
+    xdots = rhs(xs, rs, p)
+    jacs = rhs_jac(xs, rs, p)
+    assert xdots.shape == (2, 5)
+    assert jacs.shape == (5, 2, 2)
+    for i in range(5):
+        np.testing.assert_allclose(xdots[:, i], rhs(xs[:, i], rs[:, i], p))
+        np.testing.assert_allclose(jacs[i], rhs_jac(xs[:, i], rs[:, i], p))
+
+    # The same dynamics with a non-diagonal mass matrix.
+    implicit_eom = sym.Matrix([eom[0] + eom[1], eom[1]])
+
+    col = ConstraintCollocator(implicit_eom, state_symbols, 10, 0.01,
+                               known_parameter_map=par_map)
+
+    implicit_rhs, implicit_rhs_jac = col.generate_ode_functions()
+
+    np.testing.assert_allclose(implicit_rhs(xs, rs, p), xdots)
+    np.testing.assert_allclose(implicit_rhs_jac(xs, rs, p), jacs)
+
+    def fun(t, x):
+        return rhs(x, np.sin(t), p)
+
+    def jac(t, x):
+        return rhs_jac(x, np.sin(t), p)
+
+    sol = solve_ivp(fun, (0.0, 2.0), [0.1, 0.0], method='Radau', jac=jac,
+                    rtol=1e-8, atol=1e-10)
+    expected = solve_ivp(lambda t, x: [x[1], (np.sin(t) - 0.5 * x[1] -
+                                              3.0 * np.sin(x[0])) / 2.0],
+                         (0.0, 2.0), [0.1, 0.0], rtol=1e-8, atol=1e-10)
+    np.testing.assert_allclose(sol.y[:, -1], expected.y[:, -1], rtol=1e-5)
+
+
+@pytest.mark.parametrize('method', ['backward euler', 'midpoint'])
+def test_Problem_objective_expr(method):
+
+    from unittest import SkipTest
+
+    try:
+        utils._ipopt_build_args()
+    except ImportError:
+        raise SkipTest('IPOPT is not found with pkg-config.')
+
+    (m, c, k, t), (x, v, f, d), eom = _mass_spring_damper(nonlinear=True,
+                                                          disturbance=True)
+
+    state_symbols = (x, v)
+
+    num_nodes = 11
+    interval_value = 0.1
+    duration = (num_nodes - 1) * interval_value
+
+    # The unknown stiffness is in the objective and an instance constraint.
+    kwargs = dict(known_parameter_map={m: 1.0, c: 0.5},
+                  known_trajectory_map={d: 0.1 * np.sin(np.arange(num_nodes))},
+                  instance_constraints=(x.func(0.0), v.func(0.0),
+                                        x.func(duration) - 1.0,
+                                        k * v.func(duration)),
+                  path_constraints=(f * v,),
+                  path_constraint_bounds=[(-5.0, 5.0)],
+                  bounds={k: (1.0, 2.0)},
+                  integration_method=method)
+
+    prob = Problem(None, None, eom, state_symbols, num_nodes,
+                   interval_value, objective_expr=f**2 + k * x**2, **kwargs)
+    module = prob._nlp_module
+    known = prob._nlp_known
+
+    free = np.random.random(prob.num_free)
+    force = free[2 * num_nodes:3 * num_nodes]
+    np.testing.assert_allclose(
+        prob.obj(free),
+        interval_value * np.sum(force**2 + free[-1] * free[:num_nodes]**2))
+
+    # The compiled constraints and Jacobian are the same as the
+    # collocator's.
+    np.testing.assert_allclose(module.constraints(known, free),
+                               prob.con(free))
+    shape = (prob.num_constraints, prob.num_free)
+
+    def jacobian(free):
+        rows, cols = module.jacobian_structure()
+        return sparse.coo_matrix((module.jacobian(known, free),
+                                  (rows, cols)), shape=shape).toarray()
+
+    expected = sparse.coo_matrix((prob.con_jac(free), (prob.con_jac_rows,
+                                                       prob.con_jac_cols)),
+                                 shape=shape).toarray()
+    np.testing.assert_allclose(jacobian(free), expected)
+
+    # The gradient and the Hessian of the Lagrangian match central
+    # differences.
+    eps = 1e-6
+    lagrange = np.random.random(prob.num_constraints)
+
+    def gradient_of_lagrangian(free):
+        return (0.5 * prob.obj_grad(free) +
+                jacobian(free).T.dot(lagrange))
+
+    expected_grad = np.zeros(prob.num_free)
+    expected_hess = np.zeros((prob.num_free, prob.num_free))
+    for i in range(prob.num_free):
+        step = np.zeros(prob.num_free)
+        step[i] = eps
+        expected_grad[i] = (prob.obj(free + step) -
+                            prob.obj(free - step)) / (2 * eps)
+        expected_hess[:, i] = (gradient_of_lagrangian(free + step) -
+                               gradient_of_lagrangian(free - step)) / (2 * eps)
+    np.testing.assert_allclose(prob.obj_grad(free), expected_grad, atol=1e-6)
+
+    rows, cols = module.hessian_structure()
+    assert np.all(rows >= cols)
+    hess = sparse.coo_matrix((module.hessian(known, free, lagrange, 0.5),
+                              (rows, cols)), shape=expected_hess.shape)
+    hess = hess.toarray()
+    np.testing.assert_allclose(hess + np.tril(hess, -1).T, expected_hess,
+                               atol=1e-6)
+
+    # IPOPT finds the same solution with the compiled callbacks as with the
+    # Python callbacks.
+    expected_prob = Problem(prob.obj, prob.obj_grad, eom, state_symbols,
+                            num_nodes, interval_value, **kwargs)
+    for p in (prob, expected_prob):
+        p.addOption('print_level', 0)
+        p.addOption('tol', 1e-10)
+
+    initial_guess = np.zeros(prob.num_free)
+    initial_guess[-1] = 1.5
+    solution, info = prob.solve(initial_guess)
+    expected_solution, expected_info = expected_prob.solve(initial_guess)
+
+    assert info['status'] == 0
+    assert expected_info['status'] == 0
+    np.testing.assert_allclose(solution, expected_solution, atol=1e-6)
+    np.testing.assert_allclose(info['g'], prob.con(solution), atol=1e-12)
+    np.testing.assert_allclose(info['obj_val'], prob.obj(solution))
+    assert len(prob.obj_value) > 1
+    assert prob.obj_value[-1] == info['obj_val']
+
+    # A warm start continues from the stored solution and multipliers.
+    warm_solution, warm_info = prob.solve(warm_start=True)
+    assert warm_info['status'] == 0
+    np.testing.assert_allclose(warm_solution, solution, atol=1e-6)
+
+    prob.addOption('max_iter', 'five')
+    try:
+        prob.solve(initial_guess)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('The invalid option is not reported.')
+
+    try:
+        Problem(prob.obj, prob.obj_grad, eom, state_symbols, num_nodes,
+                interval_value, objective_expr=f**2, **kwargs)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('The objective is given twice.')
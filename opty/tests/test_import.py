@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+
+"""Checks that importing opty does not import its slow dependencies. Run
+this file to benchmark the import time of the opty modules in fresh
+interpreters:
+
+    python -m opty.tests.test_import
+
+"""
+
+import subprocess
+import sys
+
+MODULES = ('opty.direct_collocation', 'opty.utils',
+           'opty.parameter_identification', 'opty.receding_horizon',
+           'opty.batch')
+
+# These are only imported when a Problem is instantiated, a plot is made, or
+# the equations of motion are parsed.
+DEFERRED = ('ipopt', 'cyipopt', 'matplotlib', 'sympy.physics.mechanics')
+
+
+def _run(code):
+    return subprocess.check_output([sys.executable, '-c', code])
+
+
+def test_deferred_imports():
+
+    code = ('import sys\n'
+            'import {}\n'
+            'print(",".join([m for m in {} if m in sys.modules]))')
+    output = _run(code.format(', '.join(MODULES), repr(DEFERRED)))
+
+    assert output.decode().strip() == ''
+
+
+def test_deferred_sympy_import():
+
+    # Only the batch solver needs SymPy to send problems to its workers.
+    code = ('import sys\n'
+            'import {}\n'
+            'print("sympy" in sys.modules)')
+    output = _run(code.format(', '.join([m for m in MODULES if m !=
+                                         'opty.batch'])))
+
+    assert output.decode().strip() == 'False'
+
+
+def benchmark_import_time(num_runs=5):
+    """Returns the minimum time in seconds of importing each of the opty
+    modules and sympy in fresh interpreters."""
+
+    code = ('from timeit import default_timer\n'
+            'start = default_timer()\n'
+            'import {}\n'
+            'print(default_timer() - start)')
+
+    times = {}
+    for module in ('sympy',) + MODULES:
+        times[module] = min([float(_run(code.format(module)))
+                             for i in range(num_runs)])
+
+    return times
+
+
+if __name__ == '__main__':
+    for module, duration in sorted(benchmark_import_time().items()):
+        print('{:<32}{:8.3f} s'.format(module, duration))
@@ -1,9 +1,14 @@
 #!/usr/bin/env python
 
+import shutil
+import tempfile
+
 import numpy as np
 
 from ..parameter_identification import (objective_function,
-                                        objective_function_gradient)
+                                        objective_function_gradient,
+                                        ParameterIdentificationObjective,
+                                        LeastSquaresObjective)
 
 
 def test_objective_function():
@@ -52,3 +57,149 @@ def test_objective_function_gradient():
         expected_grad[i] = (perturbed - cost) / delta
 
     np.testing.assert_allclose(grad, expected_grad, atol=1e-8)
+
+
+def test_ParameterIdentificationObjective():
+
+    M = 5
+    o = 2
+    n = 2 * o
+    q = 3
+    h = 0.01
+
+    time = np.linspace(0.0, (M - 1) * h, num=M)
+    y_measured = np.random.random((M, o))  # measured coordinates
+    x_model = np.random.random((M, n))
+    free = np.hstack((x_model.T.flatten(), np.random.random(q)))
+
+    objective = ParameterIdentificationObjective(M, n, h, time, y_measured)
+
+    np.testing.assert_allclose(objective.objective(free),
+                               objective_function(free, M, n, h, time,
+                                                  y_measured))
+
+    grad = objective.gradient(free)
+
+    np.testing.assert_allclose(grad,
+                               objective_function_gradient(free, M, n, h,
+                                                           time, y_measured))
+
+    # The gradient array is reused.
+    assert objective.gradient(free + 1.0) is grad
+
+    # Measurements sampled at a different rate than the model and outputs
+    # other than the coordinates.
+    time_measured = np.linspace(0.0, (M - 1) * h, num=2 * M)
+    y_measured = np.random.random((2 * M, o))
+
+    objective = ParameterIdentificationObjective(M, n, h, time_measured,
+                                                 y_measured,
+                                                 output_indices=(3, 1))
+
+    model_time = np.linspace(0.0, (M - 1) * h, num=M)
+    y_interpolated = np.array([np.interp(model_time, time_measured, y)
+                               for y in y_measured.T])
+    expected = h * np.sum((x_model[:, [3, 1]].T - y_interpolated)**2)
+
+    cost = objective.objective(free)
+
+    np.testing.assert_allclose(cost, expected)
+
+    grad = objective.gradient(free)
+
+    expected_grad = np.zeros_like(free)
+    delta = 1e-8
+    for i in range(len(free)):
+        free_copy = free.copy()
+        free_copy[i] = free_copy[i] + delta
+        perturbed = objective.objective(free_copy)
+        expected_grad[i] = (perturbed - cost) / delta
+
+    np.testing.assert_allclose(grad, expected_grad, atol=1e-6)
+
+    # The objective is quadratic, so its Hessian is exact.
+    rows, cols = objective.hessian_indices()
+    hessian = np.zeros((len(free), len(free)))
+    hessian[rows, cols] = objective.hessian(free)
+
+    # The gradient array is reused, so it is copied.
+    grad = objective.gradient(free).copy()
+    expected_hessian = np.zeros_like(hessian)
+    for i in range(len(free)):
+        free_copy = free.copy()
+        free_copy[i] = free_copy[i] + delta
+        expected_hessian[:, i] = (objective.gradient(free_copy) - grad) / delta
+
+    np.testing.assert_allclose(hessian, expected_hessian, atol=1e-6)
+
+    # The measurements are read from a memory mapped file.
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        mapped = ParameterIdentificationObjective(M, n, h, time_measured,
+                                                  y_measured,
+                                                  output_indices=(3, 1),
+                                                  memmap_dir=tmp_dir)
+        assert isinstance(mapped._y_interpolated, np.memmap)
+        np.testing.assert_allclose(mapped.objective(free), cost)
+        np.testing.assert_allclose(mapped.gradient(free), grad)
+        del mapped
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_LeastSquaresObjective():
+
+    num_free = 6
+    h = 0.01
+    measured = np.random.random(4)
+
+    def residual(free):
+        return np.array([free[0] * free[3] - measured[0],
+                         np.sin(free[1]) - measured[1],
+                         free[1] * free[2] + free[5]**2 - measured[2],
+                         free[5] - measured[3]])
+
+    # The partial derivative of the second residual with respect to free[1]
+    # is given in two parts, which are summed.
+    rows = np.array([0, 0, 1, 2, 2, 2, 3, 2])
+    cols = np.array([0, 3, 1, 1, 2, 5, 5, 2])
+
+    def residual_jacobian(free):
+        return np.array([free[3], free[0], np.cos(free[1]), free[2],
+                         0.5 * free[1], 2.0 * free[5], 1.0, 0.5 * free[1]])
+
+    objective = LeastSquaresObjective(residual, residual_jacobian,
+                                      (rows, cols), weight=h)
+
+    free = np.random.random(num_free)
+
+    jacobian = np.zeros((4, num_free))
+    np.add.at(jacobian, (rows, cols), residual_jacobian(free))
+
+    cost = objective.objective(free)
+
+    np.testing.assert_allclose(cost, h * np.sum(residual(free)**2))
+
+    grad = objective.gradient(free)
+
+    np.testing.assert_allclose(grad, 2.0 * h * jacobian.T.dot(residual(free)))
+
+    expected_grad = np.zeros_like(free)
+    delta = 1e-8
+    for i in range(len(free)):
+        free_copy = free.copy()
+        free_copy[i] = free_copy[i] + delta
+        expected_grad[i] = (objective.objective(free_copy) - cost) / delta
+
+    np.testing.assert_allclose(grad, expected_grad, atol=1e-6)
+
+    hess_rows, hess_cols = objective.hessian_indices()
+    assert np.all(hess_rows >= hess_cols)
+    # free[4] does not appear in the residuals.
+    assert 4 not in hess_rows and 4 not in hess_cols
+
+    hessian = np.zeros((num_free, num_free))
+    hessian[hess_rows, hess_cols] = objective.hessian(free)
+
+    np.testing.assert_allclose(hessian,
+                               np.tril(2.0 * h * jacobian.T.dot(jacobian)))
@@ -0,0 +1,94 @@
+#!/usr/bin/env python
+
+from collections import OrderedDict
+
+import numpy as np
+import sympy as sym
+
+from .. import utils
+from ..receding_horizon import RecedingHorizonController
+
+
+def test_RecedingHorizonController():
+
+    m, c, k, t = sym.symbols('m, c, k, t')
+    x, v, f, d = [s(t) for s in sym.symbols('x, v, f, d', cls=sym.Function)]
+
+    state_symbols = (x, v)
+
+    eom = sym.Matrix([x.diff() - v,
+                      m * v.diff() + c * v + k * x - f - d])
+
+    num_nodes = 11
+    interval_value = 0.1
+
+    def obj(free):
+        return interval_value * np.sum(free**2)
+
+    def obj_grad(free):
+        return 2.0 * interval_value * free
+
+    disturbance = np.zeros(num_nodes)
+    disturbance[-1] = 1.0
+
+    controller = RecedingHorizonController(
+        obj, obj_grad, eom, state_symbols, num_nodes, interval_value,
+        max_iterations=50,
+        known_parameter_map=OrderedDict([(m, 1.0), (c, 0.5), (k, 2.0)]),
+        known_trajectory_map={d: disturbance},
+        bounds={f: (-5.0, 5.0)})
+    controller.problem.addOption('print_level', 0)
+
+    try:
+        controller.step([1.0, 0.0])
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('The first step requires an initial guess.')
+
+    try:
+        controller.timing_statistics()
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('There are no steps to report.')
+
+    solution, info = controller.step([1.0, 0.0],
+                                     initial_guess=np.zeros(3 * num_nodes))
+    assert info['status'] == 0
+    np.testing.assert_allclose(solution[[0, num_nodes]], [1.0, 0.0],
+                               atol=1e-8)
+
+    num_compiled = utils.module_counter
+    prob = controller.problem
+
+    for i in range(3):
+        measured = solution[[1, num_nodes + 1]]
+        solution, info = controller.step(measured)
+        assert info['status'] == 0
+        np.testing.assert_allclose(solution[[0, num_nodes]], measured,
+                                   atol=1e-8)
+
+    # Nothing is rebuilt or recompiled between steps.
+    assert controller.problem is prob
+    assert utils.module_counter == num_compiled
+
+    # The known trajectories are shifted one node per step.
+    expected = np.zeros(num_nodes)
+    expected[-4:] = 1.0
+    np.testing.assert_allclose(
+        prob.collocator.known_trajectory_map[d], expected)
+
+    # and can be replaced.
+    solution, info = controller.step(solution[[1, num_nodes + 1]],
+                                     known_trajectory_map={d: disturbance})
+    np.testing.assert_allclose(
+        prob.collocator.known_trajectory_map[d], disturbance)
+
+    stats = controller.timing_statistics()
+    assert stats['num_steps'] == 5
+    assert len(controller.step_durations) == 5
+    assert stats['max_duration'] >= stats['mean_duration'] > 0.0
+    assert stats['max_iterations'] <= 50
+    # The warm started steps take fewer iterations than the cold start.
+    assert max(controller.step_iterations[1:]) < controller.step_iterations[0]
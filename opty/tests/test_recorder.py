@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+
+import os
+import shutil
+import tempfile
+from unittest import SkipTest
+
+import numpy as np
+import sympy as sym
+
+from ..direct_collocation import Problem
+from ..recorder import IterateRecorder, load_recording, _import_h5py
+
+
+def _solve_and_record(path):
+    """Solves a problem twice with recorders writing to the path and checks
+    the recording."""
+
+    m, c, k, t = sym.symbols('m, c, k, t')
+    x, v, f = [s(t) for s in sym.symbols('x, v, f', cls=sym.Function)]
+
+    state_symbols = (x, v)
+
+    eom = sym.Matrix([x.diff() - v,
+                      m * v.diff() + c * v + k * x - f])
+
+    num_nodes = 21
+    interval_value = 0.1
+    duration = (num_nodes - 1) * interval_value
+
+    def obj(free):
+        return np.sum(free[2 * num_nodes:]**2)
+
+    def obj_grad(free):
+        grad = np.zeros_like(free)
+        grad[2 * num_nodes:] = 2.0 * free[2 * num_nodes:]
+        return grad
+
+    instance_constraints = (x.func(0.0), v.func(0.0),
+                            x.func(duration) - 1.0, v.func(duration))
+
+    prob = Problem(obj, obj_grad, eom, state_symbols, num_nodes,
+                   interval_value,
+                   known_parameter_map={m: 1.0, c: 0.5, k: 2.0},
+                   instance_constraints=instance_constraints)
+    prob.addOption('print_level', 0)
+
+    tmp_dir = tempfile.mkdtemp()
+
+    try:
+        path = os.path.join(tmp_dir, path)
+
+        prob.recorder = IterateRecorder(path, primal_interval=2,
+                                        chunk_size=3)
+
+        solution, info = prob.solve(np.zeros(prob.num_free))
+        num_iterations = len(prob.obj_value)
+
+        # A new recorder appends to the store.
+        prob.recorder = IterateRecorder(path, primal_interval=0)
+        prob.solve(warm_start=True)
+
+        recording = load_recording(path)
+
+        iterates = recording['iterates']
+        first = iterates['solve'] == 0
+        assert first.sum() == num_iterations
+        np.testing.assert_allclose(iterates['iteration'][first],
+                                   np.arange(num_iterations))
+        np.testing.assert_allclose(iterates['objective'][first],
+                                   prob.obj_value[:num_iterations])
+        assert np.all(np.diff(iterates['time'][first]) >= 0.0)
+        assert set(iterates['solve']) == set([0, 1])
+
+        primal = recording['primal']
+        assert np.all(primal['solve'] == 0)
+        np.testing.assert_allclose(primal['iteration'],
+                                   np.arange(0, num_iterations, 2))
+        assert primal['x'].shape == (len(primal['iteration']),
+                                     prob.num_free)
+        np.testing.assert_allclose(primal['x'][0], 0.0)
+        # The recorded iterates have the recorded objective values.
+        for i, free in zip(primal['iteration'], primal['x']):
+            np.testing.assert_allclose(obj(free), iterates['objective'][i])
+
+        results = recording['results']
+        np.testing.assert_allclose(results['solve'], [0, 1])
+        np.testing.assert_allclose(results['status'], [0, 0])
+        np.testing.assert_allclose(results['solution'][0], solution)
+        assert results['max_constraint_violation'][0] < 1e-6
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_IterateRecorder():
+    _solve_and_record('iterates')
+
+
+def test_IterateRecorder_hdf5():
+    try:
+        _import_h5py()
+    except ImportError:
+        raise SkipTest('h5py is not installed.')
+    _solve_and_record('iterates.h5')
+
+
+def test_IterateRecorder_path_constraints():
+
+    m, c, k, t = sym.symbols('m, c, k, t')
+    x, v, f = [s(t) for s in sym.symbols('x, v, f', cls=sym.Function)]
+
+    eom = sym.Matrix([x.diff() - v,
+                      m * v.diff() + c * v + k * x - f])
+
+    num_nodes = 21
+    interval_value = 0.1
+    duration = (num_nodes - 1) * interval_value
+
+    def obj(free):
+        return np.sum(free[2 * num_nodes:]**2)
+
+    def obj_grad(free):
+        grad = np.zeros_like(free)
+        grad[2 * num_nodes:] = 2.0 * free[2 * num_nodes:]
+        return grad
+
+    # The power of the actuator is bounded but the bounds are not active.
+    prob = Problem(obj, obj_grad, eom, (x, v), num_nodes, interval_value,
+                   known_parameter_map={m: 1.0, c: 0.5, k: 2.0},
+                   instance_constraints=(x.func(0.0), v.func(0.0),
+                                         x.func(duration) - 1.0,
+                                         v.func(duration)),
+                   path_constraints=(f * v,),
+                   path_constraint_bounds=[(-10.0, 10.0)])
+    prob.addOption('print_level', 0)
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        path = os.path.join(tmp_dir, 'iterates')
+        prob.recorder = IterateRecorder(path)
+        solution, info = prob.solve(np.zeros(prob.num_free))
+
+        power = np.asarray(info['g'])[-num_nodes:]
+        assert np.max(np.abs(power)) > 1e-2
+
+        results = load_recording(path)['results']
+        assert results['max_constraint_violation'][0] < 1e-6
+    finally:
+        shutil.rmtree(tmp_dir)
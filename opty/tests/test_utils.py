@@ -1,5 +1,9 @@
 #!/usr/bin/env python
 
+import os
+import shutil
+import tempfile
+
 import numpy as np
 from numpy import testing
 import sympy as sym
@@ -67,6 +71,61 @@ def test_parse_free():
     np.testing.assert_allclose(expected_input_traj, input_traj)
 
 
+def test_interpolate_free():
+
+    n = 2
+    r = 1
+    time = np.linspace(0.0, 1.0, num=3)
+    new_time = np.linspace(0.0, 1.0, num=5)
+
+    free = np.array([0.0, 1.0, 2.0,  # x
+                     2.0, 4.0, 6.0,  # v
+                     1.0, 1.0, 3.0,  # f
+                     7.0, 8.0])  # constants
+
+    new_free = utils.interpolate_free(free, n, r, time, new_time)
+
+    expected = np.array([0.0, 0.5, 1.0, 1.5, 2.0,
+                         2.0, 3.0, 4.0, 5.0, 6.0,
+                         1.0, 1.0, 1.0, 2.0, 3.0,
+                         7.0, 8.0])
+
+    np.testing.assert_allclose(new_free, expected)
+
+    # Nodes outside of the original time span hold the end values.
+    new_free = utils.interpolate_free(free, n, 0, time,
+                                      np.array([-1.0, 0.25, 2.0]))
+
+    expected = np.array([0.0, 0.5, 2.0,
+                         2.0, 3.0, 6.0,
+                         1.0, 1.0, 3.0, 7.0, 8.0])
+
+    np.testing.assert_allclose(new_free, expected)
+
+
+def test_shift_free():
+
+    free = np.array([0.0, 1.0, 2.0,  # x
+                     3.0, 4.0, 5.0,  # f
+                     7.0, 8.0])  # constants
+
+    shifted = utils.shift_free(free, 1, 1, 3)
+
+    expected = np.array([1.0, 2.0, 2.0,
+                         4.0, 5.0, 5.0,
+                         7.0, 8.0])
+
+    np.testing.assert_allclose(shifted, expected)
+
+    shifted = utils.shift_free(free, 1, 1, 3, num_nodes=2)
+
+    expected = np.array([2.0, 2.0, 2.0,
+                         5.0, 5.0, 5.0,
+                         7.0, 8.0])
+
+    np.testing.assert_allclose(shifted, expected)
+
+
 def test_ufuncify_matrix():
 
     a, b, c = sym.symbols('a, b, if')
@@ -126,6 +185,174 @@ def test_ufuncify_matrix():
     testing.assert_allclose(f(result, a_vals, b_vals, c_val),
                             eval_matrix_loop_numpy(a_vals, b_vals, c_val))
 
+    # The inputs may be read only or strided and the serial kernels release
+    # the GIL, so they can be evaluated from several threads at once.
+    from concurrent.futures import ThreadPoolExecutor
+
+    f = utils.ufuncify_matrix((a, b, c), sym_mat, const=(c,))
+
+    read_only_a_vals = a_vals.copy()
+    read_only_a_vals.setflags(write=False)
+    strided_b_vals = np.repeat(b_vals, 2)[::2]
+
+    def evaluate(i):
+        return f(np.empty((n, 4)), read_only_a_vals, strided_b_vals, c_val)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for result in executor.map(evaluate, range(8)):
+            testing.assert_allclose(result,
+                                    eval_matrix_loop_numpy(a_vals, b_vals,
+                                                           c_val))
+
+    # The code is split into functions of at most three assignments, the two
+    # intermediates and the elements of the matrix, in their own files.
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        for parallel in (False, True):
+            f = utils.ufuncify_matrix((a, b, c), sym_mat, const=(c,),
+                                      tmp_dir=tmp_dir, parallel=parallel,
+                                      split_size=3)
+
+            result = np.empty((n, 4))
+
+            testing.assert_allclose(f(result, a_vals, b_vals, c_val),
+                                    eval_matrix_loop_numpy(a_vals, b_vals,
+                                                           c_val))
+
+        assert len([name for name in os.listdir(tmp_dir) if
+                    name.endswith('.c') and '_c_' in name]) == 4
+
+        # The work array is allocated once per call of the loop, not by the
+        # routine that is called for each node.
+        for name in os.listdir(tmp_dir):
+            if name.endswith('_c.c'):
+                with open(os.path.join(tmp_dir, name)) as f:
+                    code = f.read()
+                assert 'malloc' not in code
+                assert 'double *work' in code
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_parallel_options():
+
+    from concurrent.futures import ThreadPoolExecutor
+
+    a, b, c = sym.symbols('a, b, c')
+
+    sym_mat = sym.Matrix([[sym.sin(a) * b + c, a * b / c]])
+
+    n = 1000
+    a_vals = np.random.random(n)
+    b_vals = np.random.random(n)
+    c_val = np.random.random()
+
+    serial = utils.ufuncify_matrix((a, b, c), sym_mat, const=(c,))
+    expected = serial(np.empty((n, 2)), a_vals, b_vals, c_val)
+
+    assert utils.parallel_options(serial, num_threads=2) == {}
+
+    try:
+        utils.tune_parallel_options(serial, n)
+    except ValueError:
+        pass
+    else:
+        raise AssertionError('The function is not parallel.')
+
+    f = utils.ufuncify_matrix((a, b, c), sym_mat, const=(c,), parallel=True)
+
+    if not utils.openmp_installed():
+        return
+
+    options = [utils.parallel_options(f, num_threads, schedule) for
+               num_threads, schedule in ((None, None), (2, 'static,3'),
+                                         (3, 'dynamic,16'), (2, 'guided'),
+                                         (1, 'static'))]
+    assert options[2] == {'num_threads': 3, 'schedule_kind': 2,
+                          'chunk_size': 16}
+
+    for kwargs in options:
+        testing.assert_allclose(f(np.empty((n, 2)), a_vals, b_vals, c_val,
+                                  **kwargs), expected)
+
+    # The options only apply to the call, so threads can evaluate the
+    # function with different options at the same time.
+    def evaluate(kwargs):
+        return f(np.empty((n, 2)), a_vals, b_vals, c_val, **kwargs)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        for result in executor.map(evaluate, 4 * options):
+            testing.assert_allclose(result, expected)
+
+    for schedule in ('fastest', 'auto'):
+        try:
+            utils.parallel_options(f, 2, schedule)
+        except ValueError:
+            pass
+        else:
+            raise AssertionError('The schedule is not valid.')
+
+    num_threads, schedule = utils.tune_parallel_options(f, n, duration=0.005)
+    assert num_threads >= 1
+    testing.assert_allclose(
+        f(np.empty((n, 2)), a_vals, b_vals, c_val,
+          **utils.parallel_options(f, num_threads, schedule)), expected)
+
+    assert utils.tune_parallel_options(f, n, num_threads=2,
+                                       schedule='dynamic',
+                                       duration=0.005) == (2, 'dynamic')
+
+
+def test_forward_jacobian():
+
+    a, b, c, d = sym.symbols('a, b, c, d')
+
+    expr = sym.Matrix([sym.sin(a * b) * sym.exp(a * b) + c**2 / (a + b),
+                       sym.exp(a * b) * sym.sqrt(b + c) - d,
+                       d * sym.cos(a * b + c) + (a + b)**3])
+
+    wrt = (a, b, c)
+
+    sub_exprs, jacobian = utils.forward_jacobian(expr, wrt)
+
+    assert jacobian.shape == (3, 3)
+
+    values = {a: 0.3, b: 1.2, c: 0.7, d: -2.1}
+    expected = np.array(expr.jacobian(wrt).xreplace(values), dtype=float)
+
+    for sub_sym, sub_expr in sub_exprs:
+        values[sub_sym] = sub_expr.xreplace(values)
+
+    testing.assert_allclose(np.array(jacobian.xreplace(values), dtype=float),
+                            expected)
+
+    args = (a, b, c, d)
+
+    f = utils.ufuncify_matrix(args, jacobian, const=(d,),
+                              sub_exprs=sub_exprs)
+
+    n = 100
+    a_vals = np.random.random(n)
+    b_vals = np.random.random(n)
+    c_vals = np.random.random(n)
+    d_val = np.random.random()
+
+    result = f(np.empty((n, 9)), a_vals, b_vals, c_vals, d_val)
+
+    partials = sym.lambdify(args, expr.jacobian(wrt), modules='numpy')
+    for i in range(n):
+        testing.assert_allclose(result[i], partials(a_vals[i], b_vals[i],
+                                                    c_vals[i], d_val))
+
+    # The derivatives taken and printed in a process pool are the same.
+    assert utils.forward_jacobian(expr, wrt, max_workers=2) == (sub_exprs,
+                                                               jacobian)
+
+    f = utils.ufuncify_matrix(args, jacobian, const=(d,),
+                              sub_exprs=sub_exprs, max_workers=2)
+    testing.assert_allclose(f(np.empty((n, 9)), a_vals, b_vals, c_vals,
+                              d_val), result)
+
 
 def test_substitute_matrix():
 
@@ -8,12 +8,10 @@ import subprocess
 import importlib
 from functools import wraps
 import warnings
+import weakref
+from collections import OrderedDict
 
 import numpy as np
-import sympy as sm
-plt = sm.external.import_module('matplotlib.pyplot',
-                                __import__kwargs={'fromlist': ['']},
-                                catch=(RuntimeError,))
 
 
 def building_docs():
@@ -30,15 +28,25 @@ def building_docs():
         return True
 
 
+def _import_pyplot():
+    """Returns matplotlib.pyplot or None if matplotlib is not installed.
+    Importing it is deferred to the first plot as it is slow and may start a
+    GUI backend."""
+    import sympy as sm
+    return sm.external.import_module('matplotlib.pyplot',
+                                     __import__kwargs={'fromlist': ['']},
+                                     catch=(RuntimeError,))
+
+
 def _optional_plt_dep(func):
     """Decorator that aborts function/method call if matplotlib is not
     installed."""
     @wraps(func)
     def wrapper(*args, **kwargs):
-        if plt is None:
+        if _import_pyplot() is None:
             raise ImportError('Install matplotlib for plotting features.')
         else:
-            func(*args, **kwargs)
+            return func(*args, **kwargs)
     return wrapper
 
 
@@ -48,8 +56,58 @@ def state_derivatives(states):
     return [state.diff() for state in states]
 
 
+def _memmap_array(array, directory, name):
+    """Writes the array to the NumPy file ``<name>.npy`` in the directory
+    and returns a read only memory map of the file, so that its values are
+    paged in from disk as they are read instead of held in memory. An
+    existing file is replaced without changing any open memory maps of
+    it."""
+
+    array = np.asarray(array)
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    path = os.path.join(directory, name + '.npy')
+
+    # The new file is written next to the old one and moved over it.
+    fd, tmp_path = tempfile.mkstemp(prefix=name, suffix='.npy',
+                                    dir=directory)
+    os.close(fd)
+    try:
+        mapped = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                           dtype=array.dtype,
+                                           shape=array.shape)
+        mapped[...] = array
+        mapped.flush()
+        del mapped
+        getattr(os, 'replace', os.rename)(tmp_path, path)
+    except Exception:
+        os.remove(tmp_path)
+        raise
+
+    return np.load(path, mmap_mode='r')
+
+
+def _writable_by_others(path):
+    """Returns true if the file or directory at the path is owned by
+    another user or can be written by its group or by others, i.e. if
+    someone else could have put what it holds there. Always false on
+    platforms without POSIX owners, e.g. Windows."""
+    import stat
+
+    if not hasattr(os, 'getuid'):
+        return False
+
+    status = os.stat(path)
+
+    return (status.st_uid != os.getuid() or
+            bool(status.st_mode & (stat.S_IWGRP | stat.S_IWOTH)))
+
+
 def f_minus_ma(mass_matrix, forcing_vector, states):
     """Returns Fr + Fr* from the mass_matrix and forcing vector."""
+    import sympy as sm
 
     xdot = sm.Matrix(state_derivatives(states))
 
@@ -96,43 +154,179 @@ def parse_free(free, n, r, N):
     return free_states, free_specified, free_constants
 
 
-_c_template = """\
+def interpolate_free(free, n, r, time, new_time):
+    """Returns a free parameters vector with the state and free specified
+    input trajectories linearly interpolated from one set of node times to
+    another. The constants are passed through unchanged.
+
+    Parameters
+    ----------
+    free : ndarray, shape(n * N + r * N + q)
+        The free parameters of the system.
+    n : integer
+        The number of states.
+    r : integer
+        The number of free specified inputs.
+    time : ndarray, shape(N,)
+        The monotonically increasing times of the N nodes in ``free``.
+    new_time : ndarray, shape(M,)
+        The times of the M nodes to interpolate to. Values outside of the
+        range of ``time`` are held at the first or last node value.
+
+    Returns
+    -------
+    new_free : ndarray, shape(n * M + r * M + q)
+        The free parameters of the system at the new node times.
+
+    """
+
+    states, specified, constants = parse_free(free, n, r, len(time))
+
+    if r == 0:
+        trajectories = states
+    else:
+        trajectories = np.vstack((states, specified))
+
+    new_trajectories = np.array([np.interp(new_time, time, traj)
+                                 for traj in trajectories])
+
+    return np.hstack((new_trajectories.flatten(), constants))
+
+
+def shift_free(free, n, r, N, num_nodes=1):
+    """Returns a free parameters vector with the state and free specified
+    input trajectories shifted earlier in time by a number of nodes. The
+    last node values are repeated to fill the end of the trajectories and
+    the constants are passed through unchanged.
+
+    Parameters
+    ----------
+    free : ndarray, shape(n * N + r * N + q)
+        The free parameters of the system.
+    n : integer
+        The number of states.
+    r : integer
+        The number of free specified inputs.
+    N : integer
+        The number of time steps.
+    num_nodes : integer, optional
+        The number of nodes to shift the trajectories by.
+
+    Returns
+    -------
+    shifted_free : ndarray, shape(n * N + r * N + q)
+        The shifted free parameters of the system.
+
+    """
+
+    len_trajectories = (n + r) * N
+
+    trajectories = free[:len_trajectories].reshape((n + r, N))
+
+    shifted = np.empty_like(trajectories)
+    shifted[:, :N - num_nodes] = trajectories[:, num_nodes:]
+    shifted[:, N - num_nodes:] = trajectories[:, -1:]
+
+    return np.hstack((shifted.flatten(), free[len_trajectories:]))
+
+
+_c_head_template = """\
 #include <math.h>
 #include "{file_prefix}_h.h"
-
-void {routine_name}(double matrix[{matrix_output_size}], {input_args})
+{includes}
+{signature}
 {{
-{eval_code}
-}}
 """
 
-_h_template = """\
-void {routine_name}(double matrix[{matrix_output_size}], {input_args});
+_c_split_template = """\
+#include "{file_prefix}_h.h"
+
+{signature}
+{{
+{calls}
+}}
 """
 
 _cython_template = """\
 import numpy as np
-from cython.parallel import prange
+from cython.parallel import prange, threadid
 cimport numpy as np
 cimport cython
-
-cdef extern from "{file_prefix}_h.h"{head_gil}:
+{parallel_head}
+cdef extern from "{file_prefix}_h.h" nogil:
     void {routine_name}(double matrix[{matrix_output_size}], {input_args})
 
 @cython.boundscheck(False)
 @cython.wraparound(False)
-def {routine_name}_loop(np.ndarray[np.double_t, ndim=2] matrix, {numpy_typed_input_args}):
+def {routine_name}_loop(np.ndarray[np.double_t, ndim=2, mode='c'] matrix, {numpy_typed_input_args}{option_args}):
 
     cdef int n = matrix.shape[0]
 
     cdef int i
 
-    for i in {loop_sig}:
-        {routine_name}(&matrix[i, 0], {indexed_input_args})
+{loop}
 
     return matrix.reshape(n, {num_rows}, {num_cols})
 """
 
+# The node loops of the Cython template, which release the GIL in both cases
+# so that kernels can be evaluated concurrently from several threads.
+#
+# The number of threads and the schedule of the parallel loop are arguments
+# of each call, see parallel_options(), and the schedule is a clause of the
+# loop. Nothing is stored in the module or in OpenMP's runtime schedule, so
+# threads that call the function with different options do not interfere.
+_parallel_loop_template = """\
+    cdef int threads = num_threads
+    cdef int chunk = chunk_size
+
+    if threads < 1:
+        threads = omp_get_max_threads()
+
+    # OpenMP's default chunks, i.e. one per thread for static scheduling.
+    if chunk < 1:
+        if schedule_kind == 1:
+            chunk = max((n + threads - 1) // threads, 1)
+        else:
+            chunk = 1
+{work_array}
+    if schedule_kind == 2:
+        for i in prange(n, nogil=True, num_threads=threads,
+                        schedule='dynamic', chunksize=chunk):
+            {call}
+    elif schedule_kind == 3:
+        for i in prange(n, nogil=True, num_threads=threads,
+                        schedule='guided', chunksize=chunk):
+            {call}
+    else:
+        for i in prange(n, nogil=True, num_threads=threads,
+                        schedule='static', chunksize=chunk):
+            {call}"""
+
+_parallel_head_template = """\
+from openmp cimport omp_get_max_threads
+
+array_args = ({array_args})
+matrix_size = {matrix_output_size}
+"""
+
+# The trailing arguments of the parallel loop, see parallel_options().
+_parallel_option_args = ('int num_threads=0', 'int schedule_kind=1',
+                         'int chunk_size=0')
+
+_serial_loop_template = """\
+{work_array}
+    with nogil:
+        for i in range(n):
+            {call}"""
+
+# The work array of split code, which holds the intermediates, is allocated
+# once per call of the loop and each thread uses its own part of it.
+_work_array_template = """
+    cdef np.ndarray[np.double_t, ndim=1, mode='c'] work_array = np.empty({work_size} * {num_parts})
+    cdef double *work = &work_array[0]
+"""
+
 _setup_template = """\
 import numpy
 from distutils.core import setup
@@ -141,7 +335,7 @@ from Cython.Build import cythonize
 
 extension = Extension(name="{file_prefix}",
                       sources=["{file_prefix}.pyx",
-                               "{file_prefix}_c.c"],
+                               {c_sources}],
                       extra_compile_args=[{compile_args}],
                       extra_link_args=[{link_args}],
                       include_dirs=[numpy.get_include()])
@@ -152,6 +346,24 @@ setup(name="{routine_name}",
 
 module_counter = 0
 
+# The number of assignments that are printed to C code and written to the
+# source files at once by ufuncify_matrix().
+_code_chunk_size = 1000
+
+# Maps the functions returned by ufuncify_matrix() to the file name and the
+# contents of their compiled extension module so that they can be saved
+# after the generated files are removed, see Problem.save().
+_shared_objects = weakref.WeakKeyDictionary()
+
+# Maps the functions returned by ufuncify_matrix() with OpenMP to whether
+# each of their arguments is an array and the size of their matrix, see
+# tune_parallel_options().
+_parallel_kernels = weakref.WeakKeyDictionary()
+
+# The OpenMP loop schedule kinds, numbered as in omp_sched_t. Cython's
+# prange() does not support the 'auto' schedule clause.
+_schedule_kinds = {'static': 1, 'dynamic': 2, 'guided': 3}
+
 
 def openmp_installed():
     """Returns true if openmp is installed, false if not.
@@ -193,7 +405,280 @@ int main() {
     return True if exit == 0 else False
 
 
-def ufuncify_matrix(args, expr, const=None, tmp_dir=None, parallel=False):
+def _imap_chunks(func, items, max_workers=None, chunk_size=None):
+    """Yields the lists that func returns for consecutive chunks of at most
+    chunk_size items. If max_workers is greater than one, the chunks are
+    mapped in a pool of that many processes. The results are yielded in the
+    order of items regardless of the number of processes."""
+
+    parallel = max_workers is not None and max_workers > 1 and len(items) > 1
+
+    if chunk_size is None:
+        chunk_size = len(items)
+    if parallel:
+        # A few chunks per process balance the load of items of unequal
+        # size.
+        num_chunks = min(len(items), 4 * max_workers)
+        chunk_size = min(chunk_size, -(-len(items) // num_chunks))
+    chunk_size = max(chunk_size, 1)
+
+    chunks = (items[i:i + chunk_size] for i in
+              range(0, len(items), chunk_size))
+
+    if parallel:
+        from concurrent.futures import ProcessPoolExecutor
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            for result in executor.map(func, chunks):
+                yield result
+    else:
+        for chunk in chunks:
+            yield func(chunk)
+
+
+def _map_chunks(func, items, max_workers=None):
+    """Returns the concatenated lists that func returns for chunks of items,
+    see _imap_chunks()."""
+    results = []
+    for result in _imap_chunks(func, items, max_workers):
+        results.extend(result)
+    return results
+
+
+def _partial_derivatives(items):
+    """Returns the partial derivatives of each expression in items, a list
+    of tuples of the expression, the intermediate it is assigned to or None,
+    and the symbols to differentiate with respect to."""
+    partials = []
+    for e, reduced_sym, syms in items:
+        gradient = []
+        for s in syms:
+            partial = e.diff(s)
+            if partial != 0 and reduced_sym is not None:
+                # e.g. the derivative of exp(x) is the intermediate itself
+                partial = partial.xreplace({e: reduced_sym})
+            gradient.append(partial)
+        partials.append(gradient)
+    return partials
+
+
+def _ccode_assignments(assignments):
+    """Returns the C code lines of a list of tuples of the variable to
+    assign to and the expression."""
+    import sympy as sm
+    return [sm.ccode(e, assign_to) for assign_to, e in assignments]
+
+
+def _c_signature(name, args):
+    """Returns the C function signature with the arguments after the first
+    aligned on separate lines."""
+    spacer = ',\n' + ' ' * len('void {}('.format(name))
+    return 'void {}({}, {})'.format(name, args[0], spacer.join(args[1:]))
+
+
+def _write_c_code(d, args, assignments, num_sub_exprs, max_workers=None,
+                  split_size=None):
+    """Prints the assignments of ufuncify_matrix() to C code in chunks and
+    writes each chunk to the C source files in the current directory before
+    the next one is printed, so the code is never held in memory at once.
+    Returns the names of the C source files and the declarations for the
+    header file.
+
+    Parameters
+    ----------
+    d : dictionary
+        The template values of ufuncify_matrix().
+    args : iterable of sympy.Symbol
+        The arguments of the routine.
+    assignments : list of tuples of sympy.Symbol and sympy.Expr
+        The intermediates followed by the matrix elements to assign.
+    num_sub_exprs : integer
+        The number of intermediates at the start of assignments.
+    max_workers : integer, optional
+        The number of processes that print the code.
+    split_size : integer, optional
+        If given, the assignments are split into functions of at most this
+        many assignments, each in its own source file, which the routine
+        calls in order. The intermediates are then stored in a work array
+        of d['work_size'] elements, instead of on the stack, which the
+        caller passes to the routine as its second argument and which is
+        shared between the functions.
+
+    """
+    import sympy as sm
+
+    routine = d['routine_name']
+    matrix_arg = 'double matrix[{}]'.format(d['matrix_output_size'])
+    arg_names = [sm.ccode(a) for a in args]
+    input_args = [matrix_arg] + ['double {}'.format(a) for a in arg_names]
+
+    if split_size is None:
+        signatures = [_c_signature(routine, input_args)]
+        file_names = ['{}_c.c'.format(d['file_prefix'])]
+        includes = ''
+    else:
+        num_parts = -(-len(assignments) // split_size)
+        names = ['{}_{}'.format(routine, i) for i in range(num_parts)]
+        part_args = [matrix_arg, 'double *work'] + input_args[1:]
+        signatures = [_c_signature(name, part_args) for name in names]
+        file_names = ['{}_c_{}.c'.format(d['file_prefix'], i) for i in
+                      range(num_parts)]
+
+        # The intermediates are elements of the work array in the functions.
+        work_file_name = '{}_work.h'.format(d['file_prefix'])
+        with open(work_file_name, 'w') as f:
+            for i, (sym, _) in enumerate(assignments[:num_sub_exprs]):
+                f.write('#define {} work[{}]\n'.format(sm.ccode(sym), i))
+        includes = '#include "{}"\n'.format(work_file_name)
+
+    f = None
+    i = 0
+    try:
+        for lines in _imap_chunks(_ccode_assignments, assignments,
+                                  max_workers, _code_chunk_size):
+            for line in lines:
+                if split_size is None:
+                    part = 0
+                else:
+                    part = i // split_size
+                if f is None or (split_size is not None and
+                                 i % split_size == 0):
+                    if f is not None:
+                        f.write('}\n')
+                        f.close()
+                    f = open(file_names[part], 'w')
+                    f.write(_c_head_template.format(
+                        file_prefix=d['file_prefix'], includes=includes,
+                        signature=signatures[part]))
+                if split_size is None and i < num_sub_exprs:
+                    line = 'double ' + line
+                f.write('    ' + '\n    '.join(line.split('\n')) + '\n')
+                i += 1
+        f.write('}\n')
+    finally:
+        if f is not None:
+            f.close()
+
+    if split_size is not None:
+        calls = ['    {}({});'.format(name, ', '.join(['matrix', 'work'] +
+                                                        arg_names))
+                 for name in names]
+        file_names.insert(0, '{}_c.c'.format(d['file_prefix']))
+        with open(file_names[0], 'w') as f:
+            f.write(_c_split_template.format(
+                file_prefix=d['file_prefix'],
+                signature=_c_signature(routine, part_args),
+                calls='\n'.join(calls)))
+        signatures.append(_c_signature(routine, part_args))
+
+    return file_names, [signature + ';' for signature in signatures]
+
+
+def forward_jacobian(expr, wrt, max_workers=None):
+    """Returns the Jacobian of a matrix of expressions with respect to a
+    sequence of symbols, differentiated in forward mode over the common
+    subexpressions of the matrix instead of the expanded expressions.
+
+    Parameters
+    ----------
+    expr : sympy.Matrix, shape(m, 1)
+        A column matrix of expressions.
+    wrt : sequence of sympy.Symbol, len(n)
+        The symbols to differentiate with respect to.
+    max_workers : integer, optional
+        If greater than one, the partial derivatives of the subexpressions
+        are taken in a pool of this many processes. The result does not
+        depend on the number of processes.
+
+    Returns
+    -------
+    sub_exprs : list of tuples of sympy.Symbol and sympy.Expr
+        The intermediate expressions, in the order they must be evaluated.
+        These are the common subexpressions of expr and their partial
+        derivatives.
+    jacobian : sympy.Matrix, shape(m, n)
+        The Jacobian in terms of wrt, the other symbols in expr, and the
+        intermediates.
+
+    Notes
+    -----
+    The partial derivative of each common subexpression with respect to the
+    symbols it directly contains is taken once and its derivatives with
+    respect to wrt are accumulated with the chain rule through the
+    derivatives of the subexpressions it contains. So the derivatives reuse
+    the intermediates of expr and the size of the Jacobian code grows with
+    the size of expr and the number of symbols each intermediate depends on
+    rather than with the size of the fully expanded derivatives.
+
+    The partial derivatives are independent of each other and are taken
+    first, possibly in parallel, and then combined in order.
+
+    """
+    import sympy as sm
+
+    replacements, reduced = sm.cse(expr, sm.numbered_symbols('z_'))
+    reduced = reduced[0]
+
+    wrt_set = set(wrt)
+    derivative_symbols = sm.numbered_symbols('dz_')
+
+    # The symbols in wrt and the intermediates that depend on them.
+    dependent = set(wrt)
+    for sym, e in replacements:
+        if not e.free_symbols.isdisjoint(dependent):
+            dependent.add(sym)
+
+    def dependent_symbols(e):
+        return sorted([s for s in e.free_symbols if s in dependent],
+                      key=sm.default_sort_key)
+
+    items = ([(e, sym, dependent_symbols(e)) for sym, e in replacements] +
+             [(e, None, dependent_symbols(e)) for e in reduced])
+    partials = _map_chunks(_partial_derivatives, items, max_workers)
+
+    sub_exprs = []
+
+    # Maps each intermediate to its non-zero derivatives with respect to
+    # the symbols in wrt.
+    derivatives = {}
+
+    def intermediate(e):
+        if e.is_Atom or (e.is_Mul and len(e.args) == 2 and
+                         e.args[0].is_Number and e.args[1].is_Atom):
+            return e
+        sym = next(derivative_symbols)
+        sub_exprs.append((sym, e))
+        return sym
+
+    def differentiate(k):
+        gradient = {}
+        for s, partial in zip(items[k][2], partials[k]):
+            if s in wrt_set:
+                chain = {s: sm.S.One}
+            else:
+                chain = derivatives.get(s)
+            if not chain or partial == 0:
+                continue
+            partial = intermediate(partial)
+            for w, d in chain.items():
+                gradient[w] = gradient.get(w, sm.S.Zero) + partial * d
+        return gradient
+
+    for k, (sym, e) in enumerate(replacements):
+        sub_exprs.append((sym, e))
+        gradient = differentiate(k)
+        derivatives[sym] = {w: intermediate(d) for w, d in gradient.items()}
+
+    jacobian = sm.zeros(reduced.shape[0], len(wrt))
+    for i in range(reduced.shape[0]):
+        gradient = differentiate(len(replacements) + i)
+        for j, w in enumerate(wrt):
+            jacobian[i, j] = gradient.get(w, sm.S.Zero)
+
+    return sub_exprs, jacobian
+
+
+def ufuncify_matrix(args, expr, const=None, tmp_dir=None, parallel=False,
+                    sub_exprs=None, max_workers=None, split_size=None):
     """Returns a function that evaluates a matrix of expressions in a tight
     loop.
 
@@ -215,6 +700,21 @@ def ufuncify_matrix(args, expr, const=None, tmp_dir=None, parallel=False):
         If True and openmp is installed, the generated code will be
         parallelized across threads. This is only useful when expr are
         extremely large.
+    sub_exprs : list of tuples of sympy.Symbol and sympy.Expr, optional
+        Intermediate expressions in the order they must be evaluated, e.g.
+        from forward_jacobian(), that expr is written in terms of. If given,
+        expr is not reduced with common subexpression elimination.
+    max_workers : integer, optional
+        If greater than one, the expressions are printed to C code in a
+        pool of this many processes. The generated code does not depend on
+        the number of processes.
+    split_size : integer, optional
+        If given, the generated C code is split into functions of at most
+        this many assignments, each in its own file, which bounds the
+        memory the compiler needs for very large matrices. The code is
+        always written to disk in chunks as it is printed. The
+        intermediates are then held in an array that is allocated once per
+        call of the function, with a part for each thread if parallel.
 
     """
 
@@ -223,6 +723,8 @@ def ufuncify_matrix(args, expr, const=None, tmp_dir=None, parallel=False):
     # not sure if this current version counts sequentially.
     global module_counter
 
+    import sympy as sm
+
     matrix_size = expr.shape[0] * expr.shape[1]
 
     file_prefix_base = 'ufuncify_matrix'
@@ -263,36 +765,58 @@ def ufuncify_matrix(args, expr, const=None, tmp_dir=None, parallel=False):
             warnings.warn(msg)
 
     if parallel and openmp:
-        d['loop_sig'] = "prange(n, nogil=True)"
-        d['head_gil'] = " nogil"
+        loop_template = _parallel_loop_template
+        d['parallel_head'] = _parallel_head_template.format(
+            array_args=''.join(['{}, '.format(const is None or a not in const)
+                                for a in args]), **d)
         d['compile_args'] = "'-fopenmp'"
         d['link_args'] = "'-fopenmp'"
     else:
-        d['loop_sig'] = "range(n)"
-        d['head_gil'] = ""
+        loop_template = _serial_loop_template
+        d['parallel_head'] = ''
         d['compile_args'] = ""
         d['link_args'] = ""
 
     matrix_sym = sm.MatrixSymbol('matrix', expr.shape[0], expr.shape[1])
 
-    sub_exprs, simple_mat = sm.cse(expr, sm.numbered_symbols('z_'))
-
-    sub_expr_code = '\n'.join(['double ' + sm.ccode(sub_expr[1], sub_expr[0])
-                               for sub_expr in sub_exprs])
-
-    matrix_code = sm.ccode(simple_mat[0], matrix_sym)
+    if sub_exprs is None:
+        sub_exprs, simple_mat = sm.cse(expr, sm.numbered_symbols('z_'))
+    else:
+        simple_mat = [expr]
 
-    d['eval_code'] = '    ' + '\n    '.join((sub_expr_code + '\n' +
-                                             matrix_code).split('\n'))
+    # The intermediates and the matrix elements are printed one assignment
+    # at a time, in row-major order for the matrix.
+    assignments = [(sym, e) for sym, e in sub_exprs]
+    for i in range(expr.shape[0]):
+        for j in range(expr.shape[1]):
+            assignments.append((matrix_sym[i, j], simple_mat[0][i, j]))
 
     c_indent = len('void {routine_name}('.format(**d))
     c_arg_spacer = ',\n' + ' ' * c_indent
 
     input_args = ['double {}'.format(sm.ccode(a)) for a in args]
-    d['input_args'] = c_arg_spacer.join(input_args)
 
     cython_input_args = []
     indexed_input_args = []
+
+    if split_size is None:
+        d['work_array'] = ''
+    else:
+        # The split routine takes the work array of the intermediates after
+        # the matrix.
+        d['work_size'] = max(len(sub_exprs), 1)
+        input_args.insert(0, 'double *work')
+        if parallel and openmp:
+            num_parts = 'threads'
+            indexed_input_args.append(
+                '&work[threadid() * {}]'.format(d['work_size']))
+        else:
+            num_parts = 1
+            indexed_input_args.append('work')
+        d['work_array'] = _work_array_template.format(num_parts=num_parts,
+                                                      **d)
+
+    d['input_args'] = c_arg_spacer.join(input_args)
     for a in args:
         if const is not None and a in const:
             typ = 'double'
@@ -309,19 +833,35 @@ def ufuncify_matrix(args, expr, const=None, tmp_dir=None, parallel=False):
 
     d['numpy_typed_input_args'] = cython_arg_spacer.join(cython_input_args)
 
-    d['indexed_input_args'] = ',\n'.join(indexed_input_args)
+    if parallel and openmp:
+        d['option_args'] = ''.join([cython_arg_spacer + a for a in
+                                    _parallel_option_args])
+    else:
+        d['option_args'] = ''
 
-    files = {}
-    files[d['file_prefix'] + '_c.c'] = _c_template.format(**d)
-    files[d['file_prefix'] + '_h.h'] = _h_template.format(**d)
-    files[d['file_prefix'] + '.pyx'] = _cython_template.format(**d)
-    files[d['file_prefix'] + '_setup.py'] = _setup_template.format(**d)
+    d['call'] = '{}(&matrix[i, 0], {})'.format(d['routine_name'],
+                                               ',\n'.join(indexed_input_args))
+
+    d['loop'] = loop_template.format(**d)
 
     workingdir = os.getcwd()
     os.chdir(codedir)
 
     try:
         sys.path.append(codedir)
+
+        c_files, declarations = _write_c_code(d, args, assignments,
+                                              len(sub_exprs), max_workers,
+                                              split_size)
+
+        d['c_sources'] = (',\n' + ' ' * 31).join(['"{}"'.format(f) for f in
+                                                  c_files])
+
+        files = {}
+        files[d['file_prefix'] + '_h.h'] = '\n'.join(declarations) + '\n'
+        files[d['file_prefix'] + '.pyx'] = _cython_template.format(**d)
+        files[d['file_prefix'] + '_setup.py'] = _setup_template.format(**d)
+
         for filename, code in files.items():
             with open(filename, 'w') as f:
                 f.write(code)
@@ -329,6 +869,962 @@ def ufuncify_matrix(args, expr, const=None, tmp_dir=None, parallel=False):
                '--inplace']
         subprocess.call(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
         cython_module = importlib.import_module(d['file_prefix'])
+        with open(cython_module.__file__, 'rb') as f:
+            shared_object = f.read()
+    finally:
+        module_counter += 1
+        sys.path.remove(codedir)
+        os.chdir(workingdir)
+        if tmp_dir is None:
+            shutil.rmtree(codedir)
+
+    func = getattr(cython_module, d['routine_name'] + '_loop')
+
+    _shared_objects[func] = (os.path.basename(cython_module.__file__),
+                             shared_object)
+    _register_parallel_kernel(func, cython_module)
+
+    return func
+
+
+def _load_ufuncified_matrix(file_name, shared_object):
+    """Returns the function in a compiled extension module made by
+    ufuncify_matrix() given the module's file name and contents, without
+    SymPy or a compiler. The module must have been compiled for this
+    platform and Python version."""
+
+    module_name = file_name.split('.')[0]
+
+    codedir = tempfile.mkdtemp(".ufuncify_load")
+    path = os.path.join(codedir, file_name)
+
+    try:
+        with open(path, 'wb') as f:
+            f.write(shared_object)
+        try:
+            from importlib.machinery import ExtensionFileLoader
+            from importlib.util import spec_from_loader, module_from_spec
+        except ImportError:  # Python 2
+            import imp
+            module = imp.load_dynamic(module_name, path)
+        else:
+            # The module is not added to sys.modules as a module with the
+            # same name may have been compiled in this process.
+            loader = ExtensionFileLoader(module_name, path)
+            module = module_from_spec(spec_from_loader(module_name, loader))
+            loader.exec_module(module)
+    finally:
+        shutil.rmtree(codedir, ignore_errors=True)
+
+    func = getattr(module, 'eval_matrix_loop')
+
+    _shared_objects[func] = (file_name, shared_object)
+    _register_parallel_kernel(func, module)
+
+    return func
+
+
+def _register_parallel_kernel(func, module):
+    array_args = getattr(module, 'array_args', None)
+    if array_args is not None:
+        _parallel_kernels[func] = (array_args, module.matrix_size)
+
+
+def parallel_options(func, num_threads=None, schedule=None):
+    """Returns the keyword arguments that set the number of threads and the
+    loop schedule of a function returned by ufuncify_matrix() that is
+    parallelized with OpenMP when it is called with them. The options only
+    apply to that call, so callers in different threads can use different
+    options.
+
+    Parameters
+    ----------
+    func : function
+        A function returned by ufuncify_matrix().
+    num_threads : integer, optional
+        The number of threads. Defaults to OpenMP's default, typically the
+        number of cores.
+    schedule : string, optional
+        The schedule of the loop over the nodes in the format of
+        ``OMP_SCHEDULE``, i.e. ``'static'``, ``'dynamic'``, or
+        ``'guided'``, optionally followed by a comma and the chunk size,
+        e.g. ``'dynamic,16'``. Defaults to ``'static'``.
+
+    Returns
+    -------
+    options : dictionary
+        The keyword arguments ``num_threads``, ``schedule_kind``, and
+        ``chunk_size`` of the function, e.g.
+        ``func(matrix, *args, **options)``. Empty if the function is not
+        parallelized, in which case the options are ignored.
+
+    """
+    if func not in _parallel_kernels:
+        return {}
+
+    kind, chunk = (schedule or 'static').partition(',')[::2]
+    try:
+        kind = _schedule_kinds[kind.strip()]
+    except KeyError:
+        raise ValueError('{} is not an OpenMP schedule.'.format(schedule))
+
+    return {'num_threads': num_threads or 0, 'schedule_kind': kind,
+            'chunk_size': int(chunk or 0)}
+
+
+def tune_parallel_options(func, num_nodes, num_threads=None, schedule=None,
+                          duration=0.02):
+    """Returns the number of threads and the loop schedule for which a
+    function returned by ufuncify_matrix() that is parallelized with OpenMP
+    evaluates a number of nodes the fastest, see parallel_options().
+
+    Parameters
+    ----------
+    func : function
+        A function returned by ufuncify_matrix().
+    num_nodes : integer
+        The number of nodes the function evaluates.
+    num_threads : integer, optional
+        If given, only schedules with this number of threads are compared.
+        Otherwise one thread, which runs the loop serially, is compared to
+        powers of two up to the number of cores.
+    schedule : string, optional
+        If given, only this schedule is compared. Otherwise static
+        scheduling with the default chunks and dynamic and guided scheduling
+        with chunks of about an eighth of each thread's nodes are compared.
+    duration : float, optional
+        The approximate time in seconds each option is evaluated for.
+
+    Returns
+    -------
+    num_threads : integer
+        The fastest number of threads.
+    schedule : string
+        The fastest schedule.
+
+    Raises
+    ------
+    ValueError
+        If the function is not parallelized.
+
+    """
+    import multiprocessing
+    from timeit import default_timer
+
+    try:
+        array_args, matrix_size = _parallel_kernels[func]
+    except KeyError:
+        raise ValueError('The function is not parallelized with OpenMP.')
+
+    if num_threads is None:
+        num_cores = multiprocessing.cpu_count()
+        thread_counts = [2**i for i in range(num_cores.bit_length()) if
+                         2**i < num_cores] + [num_cores]
+    else:
+        thread_counts = [num_threads]
+
+    options = []
+    for threads in thread_counts:
+        if schedule is not None:
+            options.append((threads, schedule))
+        elif threads == 1:
+            options.append((threads, 'static'))
+        else:
+            chunk = max(1, num_nodes // (8 * threads))
+            options += [(threads, 'static'),
+                        (threads, 'dynamic,{}'.format(chunk)),
+                        (threads, 'guided,{}'.format(chunk))]
+
+    matrix = np.empty((num_nodes, matrix_size))
+    args = [np.random.random(num_nodes) if is_array else np.random.random()
+            for is_array in array_args]
+
+    def evaluate(number, kwargs):
+        start = default_timer()
+        for i in range(number):
+            func(matrix, *args, **kwargs)
+        return (default_timer() - start) / number
+
+    times = []
+    for threads, sched in options:
+        kwargs = parallel_options(func, threads, sched)
+        # The options are evaluated for about the same duration and the
+        # fastest of three repetitions is kept.
+        number = max(1, int(duration / 3 / max(evaluate(1, kwargs), 1e-9)))
+        times.append(min([evaluate(number, kwargs) for i in range(3)]))
+
+    return options[int(np.argmin(times))]
+
+
+# The C code and Cython module of ufuncify_nlp(). The header defines the
+# IPOPT types of the callbacks, which were renamed in IPOPT 3.14.
+_nlp_h_template = """\
+#include "IpStdCInterface.h"
+
+#if IPOPT_VERSION_MAJOR > 3 || \\
+    (IPOPT_VERSION_MAJOR == 3 && IPOPT_VERSION_MINOR >= 14)
+typedef ipnumber opty_number;
+typedef ipindex opty_index;
+typedef bool opty_bool;
+#else
+typedef Number opty_number;
+typedef Index opty_index;
+typedef Bool opty_bool;
+#endif
+
+#define OPTY_NUM_FREE {num_free}
+#define OPTY_NUM_CONSTRAINTS {num_constraints}
+#define OPTY_NUM_JACOBIAN {num_jacobian}
+#define OPTY_NUM_HESSIAN {num_hessian}
+
+double opty_nlp_objective(const double *known, const double *x);
+void opty_nlp_gradient(const double *known, const double *x, double *grad);
+void opty_nlp_constraints(const double *known, const double *x, double *g);
+void opty_nlp_jacobian_structure(opty_index *rows, opty_index *cols);
+void opty_nlp_jacobian(const double *known, const double *x,
+                       double *values);
+void opty_nlp_hessian_structure(opty_index *rows, opty_index *cols);
+void opty_nlp_hessian(const double *known, const double *x,
+                      double obj_factor, const double *lagrange,
+                      double *values);
+IpoptProblem opty_nlp_create(double *x_L, double *x_U, double *g_L,
+                             double *g_U);
+int opty_nlp_solve(IpoptProblem problem, const double *known, double *x,
+                   double *g, double *obj_val, double *mult_g,
+                   double *mult_x_L, double *mult_x_U, double **obj_values,
+                   int *num_iterations);
+"""
+
+_nlp_c_head_template = """\
+#include <math.h>
+#include <stdlib.h>
+#include "{file_prefix}_h.h"
+
+#define OPTY_MAX_VARIABLES {max_variables}
+#define OPTY_MAX_KNOWN {max_known}
+#define OPTY_MAX_EXPRS {max_exprs}
+#define OPTY_MAX_VALUES {max_values}
+#define OPTY_NUM_BLOCKS {num_blocks}
+
+/* The expressions of a block are evaluated at each of its nodes from the
+   free and known values at index base + node * step. The Jacobian and the
+   Hessian hold the non-zero partial derivatives of a node's expressions
+   with respect to its free values, the latter summed over the expressions
+   weighted by their multipliers. */
+typedef struct {{
+    int num_nodes;
+    int num_variables;
+    const int *variable_base;
+    const int *variable_step;
+    int num_known;
+    const int *known_base;
+    const int *known_step;
+    int num_exprs;
+    const int *row_base;
+    const int *row_step;
+    int num_jacobian;
+    const int *jacobian_expr;
+    const int *jacobian_variable;
+    int num_hessian;
+    const int *hessian_first;
+    const int *hessian_second;
+    void (*values)(const double *w, const double *k, double *out);
+    void (*jacobian)(const double *w, const double *k, double *out);
+    void (*hessian)(const double *w, const double *k, const double *lam,
+                    double *out);
+}} opty_block;
+"""
+
+_nlp_c_block_template = """
+static const int block_{index}_variable_base[] = {{{variable_base}}};
+static const int block_{index}_variable_step[] = {{{variable_step}}};
+static const int block_{index}_known_base[] = {{{known_base}}};
+static const int block_{index}_known_step[] = {{{known_step}}};
+static const int block_{index}_row_base[] = {{{row_base}}};
+static const int block_{index}_row_step[] = {{{row_step}}};
+static const int block_{index}_jacobian_expr[] = {{{jacobian_expr}}};
+static const int block_{index}_jacobian_variable[] = {{{jacobian_variable}}};
+static const int block_{index}_hessian_first[] = {{{hessian_first}}};
+static const int block_{index}_hessian_second[] = {{{hessian_second}}};
+
+static void block_{index}_values(const double *w, const double *k, double *out)
+{{
+{values}
+}}
+
+static void block_{index}_jacobian(const double *w, const double *k,
+                             double *out)
+{{
+{jacobian}
+}}
+
+static void block_{index}_hessian(const double *w, const double *k,
+                            const double *lam, double *out)
+{{
+{hessian}
+}}
+"""
+
+_nlp_c_block_entry_template = """\
+    {{{num_nodes}, {num_variables},
+     block_{index}_variable_base, block_{index}_variable_step,
+     {num_known}, block_{index}_known_base, block_{index}_known_step,
+     {num_exprs}, block_{index}_row_base, block_{index}_row_step,
+     {num_jacobian}, block_{index}_jacobian_expr,
+     block_{index}_jacobian_variable,
+     {num_hessian}, block_{index}_hessian_first,
+     block_{index}_hessian_second,
+     block_{index}_values, block_{index}_jacobian, block_{index}_hessian}}"""
+
+# The first block is the objective and the others are the constraints.
+_nlp_c_driver = """
+static void gather(const opty_block *b, int i, const double *known,
+                   const double *x, double *w, double *k)
+{
+    int j;
+    for (j = 0; j < b->num_variables; j++)
+        w[j] = x[b->variable_base[j] + i * b->variable_step[j]];
+    for (j = 0; j < b->num_known; j++)
+        k[j] = known[b->known_base[j] + i * b->known_step[j]];
+}
+
+static int variable_index(const opty_block *b, int i, int j)
+{
+    return b->variable_base[j] + i * b->variable_step[j];
+}
+
+static int row_index(const opty_block *b, int i, int e)
+{
+    return b->row_base[e] + i * b->row_step[e];
+}
+
+double opty_nlp_objective(const double *known, const double *x)
+{
+    const opty_block *b = &blocks[0];
+    double w[OPTY_MAX_VARIABLES], k[OPTY_MAX_KNOWN];
+    double value, total = 0.0;
+    int i;
+
+    for (i = 0; i < b->num_nodes; i++) {
+        gather(b, i, known, x, w, k);
+        b->values(w, k, &value);
+        total += value;
+    }
+    return total;
+}
+
+void opty_nlp_gradient(const double *known, const double *x, double *grad)
+{
+    const opty_block *b = &blocks[0];
+    double w[OPTY_MAX_VARIABLES], k[OPTY_MAX_KNOWN], out[OPTY_MAX_VALUES];
+    int i, j;
+
+    for (j = 0; j < OPTY_NUM_FREE; j++)
+        grad[j] = 0.0;
+    for (i = 0; i < b->num_nodes; i++) {
+        gather(b, i, known, x, w, k);
+        b->jacobian(w, k, out);
+        for (j = 0; j < b->num_jacobian; j++)
+            grad[variable_index(b, i, b->jacobian_variable[j])] += out[j];
+    }
+}
+
+void opty_nlp_constraints(const double *known, const double *x, double *g)
+{
+    const opty_block *b;
+    double w[OPTY_MAX_VARIABLES], k[OPTY_MAX_KNOWN], out[OPTY_MAX_EXPRS];
+    int c, i, e;
+
+    for (c = 1; c < OPTY_NUM_BLOCKS; c++) {
+        b = &blocks[c];
+        for (i = 0; i < b->num_nodes; i++) {
+            gather(b, i, known, x, w, k);
+            b->values(w, k, out);
+            for (e = 0; e < b->num_exprs; e++)
+                g[row_index(b, i, e)] = out[e];
+        }
+    }
+}
+
+void opty_nlp_jacobian_structure(opty_index *rows, opty_index *cols)
+{
+    const opty_block *b;
+    int c, i, j, l = 0;
+
+    for (c = 1; c < OPTY_NUM_BLOCKS; c++) {
+        b = &blocks[c];
+        for (i = 0; i < b->num_nodes; i++) {
+            for (j = 0; j < b->num_jacobian; j++, l++) {
+                rows[l] = row_index(b, i, b->jacobian_expr[j]);
+                cols[l] = variable_index(b, i, b->jacobian_variable[j]);
+            }
+        }
+    }
+}
+
+void opty_nlp_jacobian(const double *known, const double *x, double *values)
+{
+    const opty_block *b;
+    double w[OPTY_MAX_VARIABLES], k[OPTY_MAX_KNOWN];
+    int c, i, l = 0;
+
+    for (c = 1; c < OPTY_NUM_BLOCKS; c++) {
+        b = &blocks[c];
+        for (i = 0; i < b->num_nodes; i++) {
+            gather(b, i, known, x, w, k);
+            b->jacobian(w, k, &values[l]);
+            l += b->num_jacobian;
+        }
+    }
+}
+
+/* The Hessian entries of all nodes are listed separately and IPOPT sums
+   the values of the entries with the same row and column. */
+void opty_nlp_hessian_structure(opty_index *rows, opty_index *cols)
+{
+    const opty_block *b;
+    int c, i, j, first, second, l = 0;
+
+    for (c = 0; c < OPTY_NUM_BLOCKS; c++) {
+        b = &blocks[c];
+        for (i = 0; i < b->num_nodes; i++) {
+            for (j = 0; j < b->num_hessian; j++, l++) {
+                first = variable_index(b, i, b->hessian_first[j]);
+                second = variable_index(b, i, b->hessian_second[j]);
+                rows[l] = first > second ? first : second;
+                cols[l] = first > second ? second : first;
+            }
+        }
+    }
+}
+
+void opty_nlp_hessian(const double *known, const double *x,
+                      double obj_factor, const double *lagrange,
+                      double *values)
+{
+    const opty_block *b;
+    double w[OPTY_MAX_VARIABLES], k[OPTY_MAX_KNOWN], lam[OPTY_MAX_EXPRS];
+    int c, i, e, l = 0;
+
+    for (c = 0; c < OPTY_NUM_BLOCKS; c++) {
+        b = &blocks[c];
+        for (i = 0; i < b->num_nodes; i++) {
+            gather(b, i, known, x, w, k);
+            for (e = 0; e < b->num_exprs; e++)
+                lam[e] = c == 0 ? obj_factor : lagrange[row_index(b, i, e)];
+            b->hessian(w, k, lam, &values[l]);
+            l += b->num_hessian;
+        }
+    }
+}
+
+/* The known values and the objective values of the iterations, which the
+   callbacks are passed by IPOPT. */
+typedef struct {
+    const double *known;
+    double *obj_values;
+    int num_iterations;
+    int capacity;
+} opty_nlp_data;
+
+static opty_bool eval_f(opty_index n, opty_number *x, opty_bool new_x,
+                        opty_number *obj_value, UserDataPtr user_data)
+{
+    *obj_value = opty_nlp_objective(((opty_nlp_data *) user_data)->known, x);
+    return 1;
+}
+
+static opty_bool eval_grad_f(opty_index n, opty_number *x, opty_bool new_x,
+                             opty_number *grad_f, UserDataPtr user_data)
+{
+    opty_nlp_gradient(((opty_nlp_data *) user_data)->known, x, grad_f);
+    return 1;
+}
+
+static opty_bool eval_g(opty_index n, opty_number *x, opty_bool new_x,
+                        opty_index m, opty_number *g, UserDataPtr user_data)
+{
+    opty_nlp_constraints(((opty_nlp_data *) user_data)->known, x, g);
+    return 1;
+}
+
+static opty_bool eval_jac_g(opty_index n, opty_number *x, opty_bool new_x,
+                            opty_index m, opty_index nele_jac,
+                            opty_index *iRow, opty_index *jCol,
+                            opty_number *values, UserDataPtr user_data)
+{
+    if (values == NULL)
+        opty_nlp_jacobian_structure(iRow, jCol);
+    else
+        opty_nlp_jacobian(((opty_nlp_data *) user_data)->known, x, values);
+    return 1;
+}
+
+static opty_bool eval_h(opty_index n, opty_number *x, opty_bool new_x,
+                        opty_number obj_factor, opty_index m,
+                        opty_number *lambda, opty_bool new_lambda,
+                        opty_index nele_hess, opty_index *iRow,
+                        opty_index *jCol, opty_number *values,
+                        UserDataPtr user_data)
+{
+    if (values == NULL)
+        opty_nlp_hessian_structure(iRow, jCol);
+    else
+        opty_nlp_hessian(((opty_nlp_data *) user_data)->known, x, obj_factor,
+                         lambda, values);
+    return 1;
+}
+
+static opty_bool intermediate(opty_index alg_mod, opty_index iter_count,
+                              opty_number obj_value, opty_number inf_pr,
+                              opty_number inf_du, opty_number mu,
+                              opty_number d_norm,
+                              opty_number regularization_size,
+                              opty_number alpha_du, opty_number alpha_pr,
+                              opty_index ls_trials, UserDataPtr user_data)
+{
+    opty_nlp_data *data = (opty_nlp_data *) user_data;
+    double *obj_values;
+    int capacity;
+
+    if (data->num_iterations == data->capacity) {
+        capacity = data->capacity > 0 ? 2 * data->capacity : 64;
+        obj_values = realloc(data->obj_values, capacity * sizeof(double));
+        if (obj_values == NULL)
+            return 1;
+        data->obj_values = obj_values;
+        data->capacity = capacity;
+    }
+    data->obj_values[data->num_iterations++] = obj_value;
+    return 1;
+}
+
+IpoptProblem opty_nlp_create(double *x_L, double *x_U, double *g_L,
+                             double *g_U)
+{
+    IpoptProblem problem = CreateIpoptProblem(
+        OPTY_NUM_FREE, x_L, x_U, OPTY_NUM_CONSTRAINTS, g_L, g_U,
+        OPTY_NUM_JACOBIAN, OPTY_NUM_HESSIAN, 0, eval_f, eval_g, eval_grad_f,
+        eval_jac_g, eval_h);
+    if (problem != NULL)
+        SetIntermediateCallback(problem, intermediate);
+    return problem;
+}
+
+/* Solves the problem, which holds the bounds and options, from the initial
+   guess in x. The objective values of the iterations are returned in an
+   array that the caller frees. */
+int opty_nlp_solve(IpoptProblem problem, const double *known, double *x,
+                   double *g, double *obj_val, double *mult_g,
+                   double *mult_x_L, double *mult_x_U, double **obj_values,
+                   int *num_iterations)
+{
+    opty_nlp_data data;
+    int status;
+
+    data.known = known;
+    data.obj_values = NULL;
+    data.num_iterations = 0;
+    data.capacity = 0;
+
+    status = IpoptSolve(problem, x, g, obj_val, mult_g, mult_x_L, mult_x_U,
+                        &data);
+
+    *obj_values = data.obj_values;
+    *num_iterations = data.num_iterations;
+    return status;
+}
+"""
+
+_nlp_cython_template = """\
+import numpy as np
+cimport numpy as np
+from libc.stdlib cimport free
+
+np.import_array()
+
+cdef extern from "{file_prefix}_h.h" nogil:
+    ctypedef int opty_index
+    ctypedef void *IpoptProblem
+    double opty_nlp_objective(const double *known, const double *x)
+    void opty_nlp_gradient(const double *known, const double *x, double *grad)
+    void opty_nlp_constraints(const double *known, const double *x, double *g)
+    void opty_nlp_jacobian_structure(opty_index *rows, opty_index *cols)
+    void opty_nlp_jacobian(const double *known, const double *x,
+                           double *values)
+    void opty_nlp_hessian_structure(opty_index *rows, opty_index *cols)
+    void opty_nlp_hessian(const double *known, const double *x,
+                          double obj_factor, const double *lagrange,
+                          double *values)
+    IpoptProblem opty_nlp_create(double *x_L, double *x_U, double *g_L,
+                                 double *g_U)
+    int opty_nlp_solve(IpoptProblem problem, const double *known, double *x,
+                       double *g, double *obj_val, double *mult_g,
+                       double *mult_x_L, double *mult_x_U,
+                       double **obj_values, int *num_iterations)
+    void FreeIpoptProblem(IpoptProblem problem)
+    bint AddIpoptStrOption(IpoptProblem problem, char *keyword, char *val)
+    bint AddIpoptNumOption(IpoptProblem problem, char *keyword, double val)
+    bint AddIpoptIntOption(IpoptProblem problem, char *keyword,
+                           opty_index val)
+    bint SetIpoptProblemScaling(IpoptProblem problem, double obj_scaling,
+                                double *x_scaling, double *g_scaling)
+
+num_free = {num_free}
+num_constraints = {num_constraints}
+num_jacobian = {num_jacobian}
+num_hessian = {num_hessian}
+
+
+cdef double *data(np.ndarray array, int size) except NULL:
+    if array.shape[0] != size:
+        raise ValueError('Expected an array of size {{}}.'.format(size))
+    return <double *> np.PyArray_DATA(array)
+
+
+def _array(values):
+    return np.ascontiguousarray(values, dtype=float)
+
+
+def _indices(size):
+    return np.empty(size, dtype='i{{}}'.format(sizeof(opty_index)))
+
+
+def objective(known, x):
+    known, x = _array(known), _array(x)
+    return opty_nlp_objective(data(known, known.shape[0]),
+                              data(x, num_free))
+
+
+def gradient(known, x):
+    known, x = _array(known), _array(x)
+    cdef np.ndarray grad = np.empty(num_free)
+    opty_nlp_gradient(data(known, known.shape[0]), data(x, num_free),
+                      data(grad, num_free))
+    return grad
+
+
+def constraints(known, x):
+    known, x = _array(known), _array(x)
+    cdef np.ndarray g = np.empty(num_constraints)
+    opty_nlp_constraints(data(known, known.shape[0]), data(x, num_free),
+                         <double *> np.PyArray_DATA(g))
+    return g
+
+
+def jacobian_structure():
+    cdef np.ndarray rows = _indices(num_jacobian)
+    cdef np.ndarray cols = _indices(num_jacobian)
+    opty_nlp_jacobian_structure(<opty_index *> np.PyArray_DATA(rows),
+                                <opty_index *> np.PyArray_DATA(cols))
+    return rows.astype(int), cols.astype(int)
+
+
+def jacobian(known, x):
+    known, x = _array(known), _array(x)
+    cdef np.ndarray values = np.empty(num_jacobian)
+    opty_nlp_jacobian(data(known, known.shape[0]), data(x, num_free),
+                      <double *> np.PyArray_DATA(values))
+    return values
+
+
+def hessian_structure():
+    cdef np.ndarray rows = _indices(num_hessian)
+    cdef np.ndarray cols = _indices(num_hessian)
+    opty_nlp_hessian_structure(<opty_index *> np.PyArray_DATA(rows),
+                               <opty_index *> np.PyArray_DATA(cols))
+    return rows.astype(int), cols.astype(int)
+
+
+def hessian(known, x, lagrange, double obj_factor):
+    known, x, lagrange = _array(known), _array(x), _array(lagrange)
+    cdef np.ndarray values = np.empty(num_hessian)
+    data(lagrange, num_constraints)
+    opty_nlp_hessian(data(known, known.shape[0]), data(x, num_free),
+                     obj_factor, <double *> np.PyArray_DATA(lagrange),
+                     <double *> np.PyArray_DATA(values))
+    return values
+
+
+def solve(known, x, lower_bound, upper_bound, con_lower_bound,
+          con_upper_bound, mult_g, mult_x_L, mult_x_U, options=(),
+          scaling=None):
+    \"\"\"Solves the problem from the initial guess x with IPOPT, which
+    calls the compiled functions without the GIL. The initial guess and
+    the multipliers are overwritten with the solution and its multipliers.
+    Returns the status, the objective value, the constraint values, and the
+    objective values of the iterations.\"\"\"
+
+    cdef np.ndarray x_L = _array(lower_bound)
+    cdef np.ndarray x_U = _array(upper_bound)
+    cdef np.ndarray g_L = _array(con_lower_bound)
+    cdef np.ndarray g_U = _array(con_upper_bound)
+    cdef np.ndarray known_values = _array(known)
+    cdef np.ndarray g = np.empty(num_constraints)
+    cdef np.ndarray x_scaling, g_scaling
+    cdef double obj_val = 0.0
+    cdef double *obj_values = NULL
+    cdef int num_iterations = 0
+    cdef int status
+    cdef bint valid
+
+    cdef double *known_ptr = data(known_values, known_values.shape[0])
+    cdef double *x_ptr = data(x, num_free)
+    cdef double *g_ptr = <double *> np.PyArray_DATA(g)
+    cdef double *mult_g_ptr = data(mult_g, num_constraints)
+    cdef double *mult_x_L_ptr = data(mult_x_L, num_free)
+    cdef double *mult_x_U_ptr = data(mult_x_U, num_free)
+
+    cdef IpoptProblem problem = opty_nlp_create(
+        data(x_L, num_free), data(x_U, num_free),
+        data(g_L, num_constraints), data(g_U, num_constraints))
+    if problem == NULL:
+        raise ValueError('The IPOPT problem could not be created.')
+
+    try:
+        for name, value in options:
+            key = name.encode('ascii')
+            if isinstance(value, (bytes, str)):
+                if not isinstance(value, bytes):
+                    value = value.encode('ascii')
+                valid = AddIpoptStrOption(problem, key, value)
+            elif isinstance(value, (int, np.integer)):
+                valid = AddIpoptIntOption(problem, key, value)
+            else:
+                valid = AddIpoptNumOption(problem, key, value)
+            if not valid:
+                raise ValueError('Invalid IPOPT option {{}}: {{}}.'.format(
+                    name, value))
+
+        if scaling is not None:
+            obj_scaling, x_scaling, g_scaling = scaling
+            x_scaling = _array(x_scaling)
+            g_scaling = _array(g_scaling)
+            SetIpoptProblemScaling(problem, obj_scaling,
+                                   data(x_scaling, num_free),
+                                   data(g_scaling, num_constraints))
+
+        with nogil:
+            status = opty_nlp_solve(problem, known_ptr, x_ptr, g_ptr,
+                                    &obj_val, mult_g_ptr, mult_x_L_ptr,
+                                    mult_x_U_ptr, &obj_values,
+                                    &num_iterations)
+    finally:
+        FreeIpoptProblem(problem)
+
+    values = np.array([obj_values[i] for i in range(num_iterations)])
+    free(obj_values)
+
+    return status, obj_val, g, values
+"""
+
+
+def _ipopt_build_args():
+    """Returns the compiler and linker arguments of IPOPT's C interface
+    found with pkg-config."""
+    args = []
+    for option in ('--cflags', '--libs'):
+        try:
+            output = subprocess.check_output(['pkg-config', option, 'ipopt'],
+                                             stderr=subprocess.STDOUT)
+        except (OSError, subprocess.CalledProcessError):
+            msg = ('IPOPT was not found with pkg-config, which is required '
+                   'to compile the NLP.')
+            raise ImportError(msg)
+        args.append(output.decode().split())
+    return args
+
+
+def _nlp_block_code(block):
+    """Returns the C code of the assignments of the values, the non-zero
+    partial derivatives, and the Hessian of the expressions of a block of
+    ufuncify_nlp() and the indices of the partial derivatives."""
+    import sympy as sm
+
+    exprs = list(block['exprs'])
+    variables = [v[0] for v in block['variables']]
+    known = [k[0] for k in block['known']]
+
+    # The non-zero partial derivatives by expression and then variable.
+    jacobian = []
+    for e, expr in enumerate(exprs):
+        syms = expr.free_symbols
+        jacobian += [(e, j, expr.diff(w)) for j, w in enumerate(variables)
+                     if w in syms]
+
+    # The lower triangle, in the order of the variables, of the sum of the
+    # Hessians of the expressions weighted by their multipliers.
+    lam = sm.MatrixSymbol('lam', max(len(exprs), 1), 1)
+    hessian = OrderedDict()
+    for e, j, partial in jacobian:
+        syms = partial.free_symbols
+        for l in range(j + 1):
+            if variables[l] in syms:
+                second = partial.diff(variables[l])
+                if second != 0:
+                    hessian[(j, l)] = (hessian.get((j, l), sm.S.Zero) +
+                                       lam[e, 0] * second)
+    hessian = OrderedDict(sorted(hessian.items()))
+
+    w = sm.MatrixSymbol('w', max(len(variables), 1), 1)
+    k = sm.MatrixSymbol('k', max(len(known), 1), 1)
+    arrays = dict([(s, w[j, 0]) for j, s in enumerate(variables)] +
+                  [(s, k[j, 0]) for j, s in enumerate(known)])
+
+    def code(values):
+        out = sm.MatrixSymbol('out', max(len(values), 1), 1)
+        # The symbols are replaced by the array elements after the common
+        # subexpressions are found, which would otherwise include the
+        # arrays.
+        sub_exprs, reduced = sm.cse(values, sm.numbered_symbols('z_'))
+        lines = ['double ' + line for line in _ccode_assignments(
+            [(sym, e.xreplace(arrays)) for sym, e in sub_exprs])]
+        lines += _ccode_assignments([(out[i, 0], sm.sympify(v).xreplace(
+            arrays)) for i, v in enumerate(reduced)])
+        return '\n'.join(['    ' + part for line in lines
+                          for part in line.split('\n')])
+
+    return {'values': code(exprs),
+            'jacobian': code([p for _, _, p in jacobian]),
+            'hessian': code(list(hessian.values())),
+            'jacobian_expr': [e for e, _, _ in jacobian],
+            'jacobian_variable': [j for _, j, _ in jacobian],
+            'hessian_first': [j for j, _ in hessian.keys()],
+            'hessian_second': [l for _, l in hessian.keys()]}
+
+
+def ufuncify_nlp(objective, constraints, num_free, num_constraints,
+                 tmp_dir=None):
+    """Returns a compiled extension module that evaluates the objective,
+    the constraints, their non-zero partial derivatives, and the Hessian
+    of the Lagrangian of a nonlinear program and solves it with IPOPT's C
+    interface, which calls the compiled functions directly.
+
+    Parameters
+    ----------
+    objective : dictionary
+        The block of the objective, whose single expression is summed over
+        its nodes.
+    constraints : list of dictionaries
+        The blocks of the constraints.
+    num_free : integer
+        The number of free variables.
+    num_constraints : integer
+        The number of constraints.
+    tmp_dir : string, optional
+        The path to a directory in which to store the generated files. If
+        None then the files will be not be retained after the module is
+        compiled.
+
+    Notes
+    -----
+    A block is a dictionary of:
+
+    - ``exprs``, the expressions evaluated at each of its nodes,
+    - ``num_nodes``, the number of nodes,
+    - ``variables``, a list of the symbols of the free variables in the
+      expressions and the base and step of their index in the free vector,
+      i.e. the index at the ith node is base + i * step,
+    - ``known``, the same for the symbols of the known values, indexed in
+      the array of known values passed to the module's functions,
+    - ``rows``, the base and step of the index of each expression in the
+      constraints, which is not used for the objective.
+
+    The partial derivatives are taken of each node's expressions with
+    respect to its variables and only the non-zero ones are evaluated and
+    listed in the sparse Jacobian and Hessian. IPOPT requires the exact
+    Hessian, so the program should be small enough to differentiate twice.
+
+    The module can only be built if IPOPT's headers and library are found
+    with pkg-config, otherwise an ImportError is raised.
+
+    """
+    global module_counter
+
+    compile_args, link_args = _ipopt_build_args()
+
+    if tmp_dir is None:
+        codedir = tempfile.mkdtemp(".ufuncify_compile")
+    else:
+        codedir = os.path.abspath(tmp_dir)
+
+    if not os.path.exists(codedir):
+        os.makedirs(codedir)
+
+    file_prefix = 'ufuncify_nlp_{}'.format(module_counter)
+    while os.path.exists(os.path.join(codedir, file_prefix + '.pyx')):
+        module_counter += 1
+        file_prefix = 'ufuncify_nlp_{}'.format(module_counter)
+
+    blocks = [objective] + list(constraints)
+    codes = [_nlp_block_code(block) for block in blocks]
+
+    def c_array(values):
+        # Arrays of length zero are not valid C.
+        return ', '.join([str(int(v)) for v in values]) or '0'
+
+    num_jacobian = 0
+    num_hessian = 0
+    block_code = []
+    block_entries = []
+    for i, (block, code) in enumerate(zip(blocks, codes)):
+        rows = block.get('rows') or []
+        d = dict(code, index=i, num_nodes=block['num_nodes'],
+                 num_variables=len(block['variables']),
+                 num_known=len(block['known']),
+                 num_exprs=len(block['exprs']),
+                 num_jacobian=len(code['jacobian_expr']),
+                 num_hessian=len(code['hessian_first']))
+        for name, indices in (('variable', block['variables']),
+                              ('known', block['known']),
+                              ('row', [(None,) + tuple(r) for r in rows])):
+            d[name + '_base'] = c_array([idx[1] for idx in indices])
+            d[name + '_step'] = c_array([idx[2] for idx in indices])
+        for name in ('jacobian_expr', 'jacobian_variable', 'hessian_first',
+                     'hessian_second'):
+            d[name] = c_array(code[name])
+        block_code.append(_nlp_c_block_template.format(**d))
+        block_entries.append(_nlp_c_block_entry_template.format(**d))
+        if i > 0:
+            num_jacobian += block['num_nodes'] * d['num_jacobian']
+        num_hessian += block['num_nodes'] * d['num_hessian']
+
+    d = {'file_prefix': file_prefix,
+         'routine_name': 'nlp',
+         'num_free': num_free,
+         'num_constraints': num_constraints,
+         'num_jacobian': num_jacobian,
+         'num_hessian': num_hessian,
+         'num_blocks': len(blocks),
+         'max_variables': max([len(b['variables']) for b in blocks] + [1]),
+         'max_known': max([len(b['known']) for b in blocks] + [1]),
+         'max_exprs': max([len(b['exprs']) for b in blocks] + [1]),
+         'max_values': max([len(c['jacobian_expr']) for c in codes] + [1]),
+         'c_sources': '"{}_c.c"'.format(file_prefix),
+         'compile_args': ', '.join([repr(a) for a in compile_args]),
+         'link_args': ', '.join([repr(a) for a in link_args])}
+
+    files = {}
+    files[file_prefix + '_h.h'] = _nlp_h_template.format(**d)
+    files[file_prefix + '_c.c'] = (
+        _nlp_c_head_template.format(**d) + ''.join(block_code) +
+        '\nstatic const opty_block blocks[OPTY_NUM_BLOCKS] = {\n' +
+        ',\n'.join(block_entries) + '\n};\n' + _nlp_c_driver)
+    files[file_prefix + '.pyx'] = _nlp_cython_template.format(**d)
+    files[file_prefix + '_setup.py'] = _setup_template.format(**d)
+
+    workingdir = os.getcwd()
+    os.chdir(codedir)
+
+    try:
+        sys.path.append(codedir)
+        for filename, code in files.items():
+            with open(filename, 'w') as f:
+                f.write(code)
+        cmd = [sys.executable, file_prefix + '_setup.py', 'build_ext',
+               '--inplace']
+        subprocess.call(cmd, stderr=subprocess.STDOUT, stdout=subprocess.PIPE)
+        module = importlib.import_module(file_prefix)
     finally:
         module_counter += 1
         sys.path.remove(codedir)
@@ -336,7 +1832,7 @@ def ufuncify_matrix(args, expr, const=None, tmp_dir=None, parallel=False):
         if tmp_dir is None:
             shutil.rmtree(codedir)
 
-    return getattr(cython_module, d['routine_name'] + '_loop')
+    return module
 
 
 def controllable(a, b):
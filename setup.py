@@ -20,6 +20,7 @@ setup(
                       'sympy>=1.0.0',
                       'cython>=0.20.1',
                       'ipopt>=0.1.7',  # cyipopt
+                      'futures; python_version < "3.0"',
                       ],
     extras_require={'examples': ['pydy>=0.3.0',
                                  'matplotlib>=1.3.1',
@@ -31,8 +32,7 @@ setup(
                             'numpydoc',
                             ],
                     },
-    tests_require=['nose'],
-    test_suite='nose.collector',
+    tests_require=['pytest', 'nose'],
     classifiers=['Programming Language :: Python',
                  'Programming Language :: Python :: 2.7',
                  'Programming Language :: Python :: 3.5',